@@ -12,21 +12,44 @@ ontology data as features that can be generated by SnomedOntologyLookup and RxOn
 import os
 import re
 import sys
+from array import array
 from collections import defaultdict
 from pathlib import Path
 
-import pandas as pd
-
-from MLDataProcessing import load_dict_json
+from AtcHierarchy import AtcHierarchy
+from IngredientClosure import IngredientClosure
+from Instrumentation import get_metrics, reset_metrics, emit_metrics, profile_stage
+from MLDataProcessing import load_dict_json, save_to_json
+from Sharding import parse_shard, in_shard, shard_work_dir, AGGREGATE_PARTIAL_FILE, AGGREGATE_PARTIAL_INFO_FILE
+import ReportTable
+from ReportTable import REPORT_TABLE_FILE
+from FeatureKey import default_codec, column_key, FAMILY, NEGATED, SNOMED, RXNORM, ATC, UNKNOWN
 
 # disregard_negation_when_adding_original_codes is used to add original codes if negation detection is inconsistent or detrimental
+@profile_stage('aggregate')
 def main(work_dir = None, add_rxnorm_ATC = True, convert_rxcui_to_ingred = True, add_snomed_ontology = True,
-         keep_rxnorm_after_conversion = True, disregard_negation_when_adding_original_codes = True):
+         keep_rxnorm_after_conversion = True, disregard_negation_when_adding_original_codes = True,
+         input_format = 'txt', shard = None, hash_features = 0, hash_reverse_map_size = 0, atc_levels = None):
     while work_dir is None or Path(work_dir).exists() is False:
         work_dir = input("Please enter working directory: ")
 
+    import pandas as pd
+
     work_dir = Path(work_dir)
     reports_dir = work_dir / "output"
+    metrics = reset_metrics('aggregate')
+
+    # shard (i, N) or 'i/N': only aggregate the reports of hash partition i out of N, saving the added values as
+    # rows (section, report_id, code, value) to work_dir/shards/i-of-N (merged with Sharding.reduce_aggregate)
+    shard = parse_shard(shard)
+    partial_rows = [] if shard is not None and not hash_features else None
+
+    # hash_features > 0: hash the codes of each report into hash_features columns (FeatureHashing) instead of one
+    # column per code, saved as _feature_matrix_hashed_.npz (no section matrices, no vocabulary pass)
+    hashed_builder = None
+    if hash_features:
+        from FeatureHashing import HashedFeatureSpace, HashedMatrixBuilder
+        hashed_builder = HashedMatrixBuilder(HashedFeatureSpace(hash_features, reverse_map_size=hash_reverse_map_size))
 
     rxcodes_as_a_fraction_of_all = False
     combine_all_sections = True
@@ -38,121 +61,87 @@ def main(work_dir = None, add_rxnorm_ATC = True, convert_rxcui_to_ingred = True,
 
 
 
-    pathlist = Path(reports_dir).glob('*.txt')
-
     # include missing entries in DF
-    NUM_REPORTS = find_max_report_id(reports_dir)
-    df_sections = {}
+    # input_format 'table' reads the single report table written by JsonBasedReader(output_format='table')
+    report_table = reports_dir / REPORT_TABLE_FILE
+    if input_format == 'table':
+        NUM_REPORTS = ReportTable.max_report_id(report_table)
+        print("Final Report # found: ", str(NUM_REPORTS))
+    else:
+        NUM_REPORTS = find_max_report_id(reports_dir)
+    matrices = SectionMatrices(NUM_REPORTS)
 
     # load json data for snomed/rxnorm ontologies
-    cui_to_ingredients = load_dict_json(work_dir / 'data' / 'rxcui_ingredient.json', create_local_if_not_found=True)
-    rxcui_to_atc = load_dict_json(work_dir / 'data' / 'rxcui_atc.json', create_local_if_not_found=True)
-    snomed_to_ancestors = load_dict_json(work_dir / 'data' / 'snomed_ancestor_inferred.json', create_local_if_not_found=True)
-    valid_rxnorm_codes = load_dict_json('rxcui_found.json', create_local_if_not_found=True)
-    valid_snomed_codes = load_dict_json('snomed_found.json', create_local_if_not_found=True)
+    tables = OntologyTables.load(work_dir)
 
     print("Loading data from: " + str(reports_dir))
 
-    for id in range(1, NUM_REPORTS+1):
-        saved_rx_codes = defaultdict(lambda: defaultdict(int))
-        saved_sn_codes = defaultdict(lambda: defaultdict(int))
-        rx_count = 0
-        try:
-            curr = pd.read_csv(str(reports_dir) + "\\REPORT" + str(id) + ".txt")
-            if (id % 100 == 0):
-                print("Working on File: " + str(id))
-
-            for i in range(len(curr)):
-                # print(i, curr.ix[i]['code'], curr.ix[i]['count'], curr.ix[i]['negation'])
-
-                full_code = str(curr.ix[i]['code'])  # use String format after added Family tag to codes
-                if len(full_code) > 7 and full_code[7] == '_':
-                    section = full_code[0:7]
-                    code = full_code[8:]
-                else:
-                    section = "00000-0"
-                    code = full_code
-
-
-                count = curr.ix[i]['count']
-                neg_count = curr.ix[i]['negation']  #old method
-
-
-                if code[:2] == 'F-':
-                    code = code[2:]
-                    family_history = True
-                else:
-                    family_history = False
-
-                neg_status = False
-                if disregard_negation_when_adding_original_codes is False:
-                    if count > 0 and neg_count/count >= negation_ratio_req:
-                        neg_status = True
-
-                # if code[-1] == 'n':
-                #     code = code[:-1]
-                #     neg_status = True
-
-
-                if code in valid_rxnorm_codes:
-                    if convert_rxcui_to_ingred:
-                        convert_success = False
-                        if code in cui_to_ingredients and cui_to_ingredients[code]:
-                            convert_success = True
-                            ingredient_codes = cui_to_ingredients[code]
-                            for ingredient in ingredient_codes:
-                                temp_code = 'F-' * family_history + ingredient
-                                save_code_based_on_negation_settings(saved_rx_codes, section, temp_code, neg_status,
-                                                                     neg_count, count,
-                                                                     disregard_negation_when_adding_original_codes)
-
-                    # check to see if we should add original code
-                    if convert_rxcui_to_ingred == False or (convert_success == False or keep_rxnorm_after_conversion):
-                        temp_code = 'F-' * family_history + code
-                        save_code_based_on_negation_settings(saved_rx_codes, section, temp_code, neg_status,
-                                                             neg_count, count,
-                                                             disregard_negation_when_adding_original_codes)
-                    if add_rxnorm_ATC:
-                        if code in rxcui_to_atc and not neg_status:
-                            ATC_list = rxcui_to_atc[code]
-                            add_ATC_list(saved_rx_codes, section, ATC_list, 1)
-                    if code in rxcui_to_atc or code in cui_to_ingredients:
-                        rx_count += 1
-                # snomed check for ontology
-                elif code in valid_snomed_codes:
-                    # add the base code
-
-                    temp_code = 'F-' * family_history + code
-                    save_code_based_on_negation_settings(saved_sn_codes, section, temp_code, neg_status,
-                                                         neg_count, count,
-                                                         disregard_negation_when_adding_original_codes)
-                    # look to see if ontology exists and should be added
-                    if add_snomed_ontology and code in snomed_to_ancestors and snomed_to_ancestors[code]:
-                        ancestors = snomed_to_ancestors[code]
-                        for ancestor in ancestors:
-                            temp_code = 'F-' * family_history + str(ancestor)
-                            save_code_based_on_negation_settings(saved_sn_codes, section, temp_code, neg_status,
-                                                                 neg_count, count,
-                                                                 disregard_negation_when_adding_original_codes)
-
-                else: #other code:  - will save in snomed section
-                    temp_code = 'F-' * family_history + code
-                    save_code_based_on_negation_settings(saved_sn_codes, section, temp_code, neg_status,
-                                                         neg_count, count,
-                                                         disregard_negation_when_adding_original_codes)
-            if rxcodes_as_a_fraction_of_all:
-                add_saved_codes(saved_rx_codes, id, df_sections, NUM_REPORTS, rx_count)
-            else:
-                add_saved_codes(saved_rx_codes, id, df_sections, NUM_REPORTS)
-            add_saved_codes(saved_sn_codes, id, df_sections, NUM_REPORTS)
+    if input_format == 'table':
+        reports = ReportTable.iter_reports(report_table)
+    else:
+        reports = iter_report_files(reports_dir, NUM_REPORTS, shard)
+
+    for id, rows in reports:
+        if not in_shard(id, shard):
+            continue
+        if (id % 100 == 0):
+            print("Working on File: " + str(id))
+        metrics.count('reports')
+        metrics.count('rows', len(rows))
+
+        saved_rx_codes, saved_sn_codes, rx_count = expand_report_codes(
+            rows, tables, add_rxnorm_ATC=add_rxnorm_ATC, convert_rxcui_to_ingred=convert_rxcui_to_ingred,
+            add_snomed_ontology=add_snomed_ontology, keep_rxnorm_after_conversion=keep_rxnorm_after_conversion,
+            disregard_negation_when_adding_original_codes=disregard_negation_when_adding_original_codes,
+            negation_ratio_req=negation_ratio_req, atc_levels=atc_levels)
+        if hashed_builder is not None:
+            hashed_builder.add_report(id, hashed_builder.space.transform_codes((saved_rx_codes, saved_sn_codes)))
+            continue
+        if rxcodes_as_a_fraction_of_all:
+            add_saved_codes(saved_rx_codes, id, matrices, rx_count, partial_rows=partial_rows)
+        else:
+            add_saved_codes(saved_rx_codes, id, matrices, partial_rows=partial_rows)
+        add_saved_codes(saved_sn_codes, id, matrices, partial_rows=partial_rows)
+
+    if hashed_builder is not None:
+        from FeatureHashing import save_hashed_matrix
+        matrix = hashed_builder.to_matrix(NUM_REPORTS)
+        out_dir = work_dir
+        if shard is not None:
+            out_dir = shard_work_dir(work_dir, shard)
+            os.makedirs(out_dir, exist_ok=True)
+        save_hashed_matrix(out_dir, matrix, hashed_builder.space, NUM_REPORTS,
+                           aggregate_settings={'add_rxnorm_ATC': add_rxnorm_ATC,
+                                               'convert_rxcui_to_ingred': convert_rxcui_to_ingred,
+                                               'add_snomed_ontology': add_snomed_ontology,
+                                               'keep_rxnorm_after_conversion': keep_rxnorm_after_conversion,
+                                               'disregard_negation_when_adding_original_codes':
+                                                   disregard_negation_when_adding_original_codes,
+                                               'atc_levels': atc_levels})
+        metrics.count('hashed_nnz', matrix.nnz)
+        emit_metrics('aggregate', out_dir)
+        return
 
-        except IOError:
-            print("-error with file: " + str(id))
-            print(str(sys.exc_info()))
+    if shard is not None:
+        shard_dir = shard_work_dir(work_dir, shard)
+        os.makedirs(shard_dir, exist_ok=True)
+        pd.DataFrame(partial_rows, columns=['section', 'report_id', 'code', 'value']).to_csv(
+            shard_dir / AGGREGATE_PARTIAL_FILE, index=False)
+        save_to_json({'num_reports': NUM_REPORTS, 'shard': list(shard)}, shard_dir / AGGREGATE_PARTIAL_INFO_FILE)
+        metrics.count('partial_rows', len(partial_rows))
+        emit_metrics('aggregate', shard_dir)
+        return
 
+    save_section_matrices(matrices.to_frames(), work_dir, combine_all_sections, metrics)
+    emit_metrics('aggregate', work_dir)
 
 
+# writes section_fm/<section>.csv for each section and the combined _feature_matrix_all_sections_.csv
+def save_section_matrices(df_sections, work_dir, combine_all_sections=True, metrics=None):
+    work_dir = Path(work_dir)
+    metrics = metrics or get_metrics('aggregate')
     os.makedirs(work_dir / "section_fm", exist_ok=True)
+    metrics.count('sections', len(df_sections))
 
     for key in df_sections.keys():
         filename = work_dir / "section_fm" / (str(key) + ".csv")
@@ -176,14 +165,125 @@ def main(work_dir = None, add_rxnorm_ATC = True, convert_rxcui_to_ingred = True,
 
 
         print("File saved: " + str(file_location))
+        metrics.count('features', full_fm.shape[1])
+
+
+def load_ingredient_closure(data):
+    """rxcui -> ingredients, from the closure arrays of RxOntologyLookup unless rxcui_ingredient.json is more recent
+    (e.g. edited or written by SyntheticBundles)"""
+    ingredient_file = data / 'rxcui_ingredient.json'
+    closure_file = data / 'rxcui_ingredient_closure.npz'
+    if closure_file.exists() and (not ingredient_file.exists() or
+                                  closure_file.stat().st_mtime >= ingredient_file.stat().st_mtime):
+        return IngredientClosure.load(closure_file)
+    return load_dict_json(ingredient_file, create_local_if_not_found=True)
+
+
+class OntologyTables():
+    """Snomed-CT/RxNorm lookup outputs used to expand the codes of a report (see expand_report_codes)."""
+    def __init__(self, cui_to_ingredients, rxcui_to_atc, snomed_to_ancestors, valid_rxnorm_codes, valid_snomed_codes):
+        self.cui_to_ingredients = cui_to_ingredients
+        self.rxcui_to_atc = rxcui_to_atc
+        self.atc = AtcHierarchy(rxcui_to_atc)
+        self.snomed_to_ancestors = snomed_to_ancestors
+        self.valid_rxnorm_codes = valid_rxnorm_codes
+        self.valid_snomed_codes = valid_snomed_codes
+
+    @classmethod
+    def load(cls, work_dir):
+        data = Path(work_dir) / 'data'
+        return cls(load_ingredient_closure(data),
+                   load_dict_json(data / 'rxcui_atc.json', create_local_if_not_found=True),
+                   load_dict_json(data / 'snomed_ancestor_inferred.json', create_local_if_not_found=True),
+                   load_dict_json(data / 'rxcui_found.json', create_local_if_not_found=True),
+                   load_dict_json(data / 'snomed_found.json', create_local_if_not_found=True))
+
+
+# expands the (section, code, family flag, count, negation count) rows of one report with ingredients, ATC classes and
+# Snomed-CT ancestors, returns the counts to add per section ({section: {feature key: count}}, see FeatureKey) for
+# rxnorm and for other codes, and the number of rxnorm codes with ontology data
+def expand_report_codes(rows, tables, add_rxnorm_ATC = True, convert_rxcui_to_ingred = True, add_snomed_ontology = True,
+                        keep_rxnorm_after_conversion = True, disregard_negation_when_adding_original_codes = True,
+                        negation_ratio_req = 0.8, atc_levels = None):
+    cui_to_ingredients = tables.cui_to_ingredients
+    rxcui_to_atc = tables.rxcui_to_atc
+    atc = tables.atc
+    snomed_to_ancestors = tables.snomed_to_ancestors
+    valid_rxnorm_codes = tables.valid_rxnorm_codes
+    valid_snomed_codes = tables.valid_snomed_codes
+    code_key = default_codec.code_key
+
+    saved_rx_codes = defaultdict(lambda: defaultdict(int))
+    saved_sn_codes = defaultdict(lambda: defaultdict(int))
+    rx_count = 0
+    for section, code, family_history, count, neg_count in rows:
+        section_key = default_codec.section_key(section)
+        base_key = section_key | FAMILY if family_history else section_key
+        neg_status = False
+        if disregard_negation_when_adding_original_codes is False:
+            if count > 0 and neg_count/count >= negation_ratio_req:
+                neg_status = True
+
+        # if code[-1] == 'n':
+        #     code = code[:-1]
+        #     neg_status = True
+
+
+        if code in valid_rxnorm_codes:
+            if convert_rxcui_to_ingred:
+                convert_success = False
+                if code in cui_to_ingredients and cui_to_ingredients[code]:
+                    convert_success = True
+                    ingredient_codes = cui_to_ingredients[code]
+                    for ingredient in ingredient_codes:
+                        temp_code = base_key | code_key(ingredient, RXNORM)
+                        save_code_based_on_negation_settings(saved_rx_codes, section, temp_code, neg_status,
+                                                             neg_count, count,
+                                                             disregard_negation_when_adding_original_codes)
+
+            # check to see if we should add original code
+            if convert_rxcui_to_ingred == False or (convert_success == False or keep_rxnorm_after_conversion):
+                temp_code = base_key | code_key(code, RXNORM)
+                save_code_based_on_negation_settings(saved_rx_codes, section, temp_code, neg_status,
+                                                     neg_count, count,
+                                                     disregard_negation_when_adding_original_codes)
+            if add_rxnorm_ATC:
+                # each ATC class of the drug once (atc_levels: only the classes of these levels, 1-4)
+                if code in atc and not neg_status:
+                    for atc_class in atc.classes(code, atc_levels):
+                        saved_rx_codes[section][section_key | code_key(atc_class, ATC)] += 1
+            if code in rxcui_to_atc or code in cui_to_ingredients:
+                rx_count += 1
+        # snomed check for ontology
+        elif code in valid_snomed_codes:
+            # add the base code
+
+            temp_code = base_key | code_key(code, SNOMED)
+            save_code_based_on_negation_settings(saved_sn_codes, section, temp_code, neg_status,
+                                                 neg_count, count,
+                                                 disregard_negation_when_adding_original_codes)
+            # look to see if ontology exists and should be added
+            if add_snomed_ontology and code in snomed_to_ancestors and snomed_to_ancestors[code]:
+                ancestors = snomed_to_ancestors[code]
+                for ancestor in ancestors:
+                    temp_code = base_key | code_key(str(ancestor), SNOMED)
+                    save_code_based_on_negation_settings(saved_sn_codes, section, temp_code, neg_status,
+                                                         neg_count, count,
+                                                         disregard_negation_when_adding_original_codes)
 
+        else: #other code:  - will save in snomed section
+            temp_code = base_key | code_key(code, UNKNOWN)
+            save_code_based_on_negation_settings(saved_sn_codes, section, temp_code, neg_status,
+                                                 neg_count, count,
+                                                 disregard_negation_when_adding_original_codes)
+    return saved_rx_codes, saved_sn_codes, rx_count
 
 
 def save_code_based_on_negation_settings(saved_codes, section, code, neg_status, neg_count, count, disregard_negation_when_adding_original_codes):
     if disregard_negation_when_adding_original_codes is False:
-        save_code(saved_codes, section, code + 'n' * neg_status, count)
+        save_code(saved_codes, section, code | NEGATED if neg_status else code, count)
     else:
-        save_code(saved_codes, section, code + 'n', neg_count)
+        save_code(saved_codes, section, code | NEGATED, neg_count)
         new_count = max(0,count - neg_count)
         save_code(saved_codes, section, code, new_count)
 
@@ -194,7 +294,7 @@ def save_code(saved_codes, section, code, count=1):
         saved_codes[section][code] += count
 
 
-def add_saved_codes(saved_codes,id, df_sections, last_id, reduction_factor = 1):
+def add_saved_codes(saved_codes,id, matrices, reduction_factor = 1, partial_rows = None):
     if reduction_factor <= 0:
         reduction_factor = 1
     for section, new_dict in saved_codes.items():
@@ -202,22 +302,69 @@ def add_saved_codes(saved_codes,id, df_sections, last_id, reduction_factor = 1):
             value = saved_codes[section][code]
             if reduction_factor != 1:
                 value /= reduction_factor
-            add_code(section, id, code, df_sections, last_id, value)
-
-
-def add_code(section, id, code, df_sections, last_id, count=1):
-    if section not in df_sections.keys():
-        # create new dataframe if necessary
-        df_sections[section] = pd.DataFrame("",columns=[],index=range(1, last_id+1))
-    df_sections[section].loc[id,code] = count
-
+            if partial_rows is not None:
+                partial_rows.append((section, id, default_codec.name(code), value))
+            else:
+                matrices.add(section, id, code, value)
+
+
+class SectionMatrices():
+    """Values of the section feature matrices (report id x feature), indexed by feature key until to_frames."""
+    def __init__(self, num_reports):
+        self.num_reports = num_reports
+        self.columns = {}       # section -> {column key: column}, in the order the features were added
+        self.entries = {}       # section -> (report rows, columns, values)
+
+    def add(self, section, id, key, value):
+        columns = self.columns.get(section)
+        if columns is None:
+            columns = self.columns[section] = {}
+            self.entries[section] = (array('q'), array('q'), array('d'))
+        column = columns.setdefault(column_key(key), len(columns))
+        rows, cols, values = self.entries[section]
+        rows.append(id - 1)
+        cols.append(column)
+        values.append(value)
+
+    def to_frames(self):
+        """{section: DataFrame} indexed by report id (1 to num_reports) with the legacy feature names as columns, NaN
+        where nothing was added, the last value added wins"""
+        import numpy as np
+        import pandas as pd
+        frames = {}
+        for section, columns in self.columns.items():
+            rows, cols, values = (np.frombuffer(a, dtype=dtype) for a, dtype in
+                                  zip(self.entries[section], (np.int64, np.int64, np.float64)))
+            cells = rows * len(columns) + cols
+            _, last = np.unique(cells[::-1], return_index=True)
+            last = len(cells) - 1 - last
+            matrix = np.full((self.num_reports, len(columns)), np.nan)
+            matrix[rows[last], cols[last]] = values[last]
+            frames[section] = pd.DataFrame(matrix, index=range(1, self.num_reports + 1),
+                                           columns=[default_codec.name(key) for key in columns])
+        return frames
+
+
+# yields (report id, rows) from the REPORTn.txt files of JsonBasedReader, rows as (section, code, family flag, count,
+# negation count) like ReportTable.iter_reports
+def iter_report_files(reports_dir, num_reports, shard=None):
+    import pandas as pd
+    for id in range(1, num_reports+1):
+        if not in_shard(id, shard):
+            continue
+        try:
+            curr = pd.read_csv(reports_dir / ("REPORT" + str(id) + ".txt"))
+        except IOError:
+            print("-error with file: " + str(id))
+            print(str(sys.exc_info()))
+            continue
 
-def add_ATC_list(saved_codes, section,ATC_list,count):
-    if not ATC_list:
-        return
-    for ATC in ATC_list:
-        for subcode in [ATC[0:1], ATC[0:3], ATC[0:4], ATC[0:5]]:
-            saved_codes[section][subcode] += count
+        rows = []
+        for full_code, count, neg_count in zip(curr['code'], curr['count'], curr['negation']):
+            # use String format after added Family tag to codes
+            section, family_history, code = default_codec.split(str(full_code))
+            rows.append((section, code, family_history, count, neg_count))
+        yield id, rows
 
 
 def find_max_report_id(path):
@@ -238,4 +385,17 @@ def find_max_report_id(path):
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Aggregate the JsonBasedReader outputs into section feature matrices")
+    parser.add_argument('work_dir', nargs='?')
+    parser.add_argument('--shard', help="i/N: only aggregate hash partition i of N (see Sharding.py)")
+    parser.add_argument('--report-table', action='store_true', help="read the single report table")
+    parser.add_argument('--hash-features', type=int, default=0,
+                        help="hash the codes into this many columns instead of one column per code (FeatureHashing)")
+    parser.add_argument('--reverse-map-size', type=int, default=0,
+                        help="with --hash-features, keep up to this many code names per hashed column")
+    parser.add_argument('--atc-levels', type=int, nargs='+', choices=[1, 2, 3, 4],
+                        help="only add the ATC classes of these levels (default: all)")
+    args = parser.parse_args()
+    main(args.work_dir, input_format='table' if args.report_table else 'txt', shard=args.shard,
+         hash_features=args.hash_features, hash_reverse_map_size=args.reverse_map_size, atc_levels=args.atc_levels)
\ No newline at end of file
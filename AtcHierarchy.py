@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""AtcHierarchy.py
+
+ATC classes of the RxCUIs (rxcui_atc.json of RxOntologyLookup), expanded once into their ancestor classes.
+
+The ATC codes found are level 4 classes (e.g. 'C09AA', level 5 drugs are not looked up); their classes at levels 1-4
+are the prefixes of length 1, 3, 4 and 5 ('C', 'C09', 'C09A', 'C09AA').  Instead of slicing every code of every
+occurrence, the level table (class -> parent, class -> level) is built once, and each RxCUI is mapped to the
+deduplicated ids of all its ancestor classes: a drug with several ATC codes in the same group (multi ingredient drugs,
+or the same code listed twice) counts each class once.
+
+Example:
+    atc = AtcHierarchy.from_file(work_dir / 'data' / 'rxcui_atc.json')
+    atc.classes('197361')              -> ('C', 'C09', 'C09A', 'C09AA')
+    atc.classes('197361', levels=(1,)) -> ('C',)
+"""
+
+
+from collections import Counter
+
+from MLDataProcessing import load_dict_json
+
+ATC_PREFIX_LENGTHS = (1, 3, 4, 5)      # levels 1 to 4
+ATC_LEVELS = (1, 2, 3, 4)
+
+
+class AtcHierarchy():
+    def __init__(self, rxcui_to_atc):
+        self.class_codes = []       # class id -> ATC class
+        self.class_ids = {}         # ATC class -> class id
+        self.levels = []            # class id -> level (1-4)
+        self.parents = []           # class id -> parent class id (-1 for level 1)
+        code_ancestors = {}         # ATC code found -> ids of its classes
+        self.rxcui_classes = {}     # rxcui -> tuple of deduplicated class ids
+
+        for rxcui, atc_codes in rxcui_to_atc.items():
+            class_ids = {}      # first seen order: the classes of the first ATC code (level 1 to 4), then the next
+            for atc_code in atc_codes or ():
+                if atc_code not in code_ancestors:
+                    code_ancestors[atc_code] = self._insert(atc_code)
+                class_ids.update(dict.fromkeys(code_ancestors[atc_code]))
+            if class_ids:
+                self.rxcui_classes[rxcui] = tuple(class_ids)
+        self._codes = {}
+
+    @classmethod
+    def from_file(cls, rxcui_atc_file):
+        return cls(load_dict_json(rxcui_atc_file, create_local_if_not_found=True))
+
+    def _insert(self, atc_code):
+        """Adds the classes of an ATC code to the level table, returns their ids"""
+        ids = []
+        parent = -1
+        for level, length in zip(ATC_LEVELS, ATC_PREFIX_LENGTHS):
+            if len(atc_code) < length:
+                break
+            prefix = atc_code[:length]
+            class_id = self.class_ids.get(prefix)
+            if class_id is None:
+                class_id = len(self.class_codes)
+                self.class_ids[prefix] = class_id
+                self.class_codes.append(prefix)
+                self.levels.append(level)
+                self.parents.append(parent)
+            ids.append(class_id)
+            parent = class_id
+        return ids
+
+    def __contains__(self, rxcui):
+        return rxcui in self.rxcui_classes
+
+    def __len__(self):
+        return len(self.class_codes)
+
+    def class_ids_of(self, rxcui, levels=None):
+        """Deduplicated class ids of an rxcui, only those of the given levels if levels is set"""
+        ids = self.rxcui_classes.get(rxcui, ())
+        if levels is None or not ids:
+            return ids
+        return tuple(i for i in ids if self.levels[i] in levels)
+
+    def classes(self, rxcui, levels=None):
+        """Deduplicated ATC classes of an rxcui, e.g. ('C', 'C09', 'C09A', 'C09AA') (cached per rxcui and levels)"""
+        key = (rxcui, None if levels is None else tuple(levels))
+        codes = self._codes.get(key)
+        if codes is None:
+            codes = self._codes[key] = tuple(self.class_codes[i] for i in self.class_ids_of(rxcui, levels))
+        return codes
+
+    def parent(self, atc_class):
+        parent_id = self.parents[self.class_ids[atc_class]]
+        return self.class_codes[parent_id] if parent_id >= 0 else None
+
+    def class_counts(self, levels=None):
+        """Number of rxcuis in each ATC class (each rxcui counted once per class)"""
+        counts = Counter()
+        for rxcui in self.rxcui_classes:
+            counts.update(self.class_codes[i] for i in self.class_ids_of(rxcui, levels))
+        return counts
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark.py
+
+Times the main pipeline stages on synthetic corpora (see SyntheticBundles) of increasing size, fully offline.
+
+For each corpus size the bundles and a gold standard are generated into a scratch work directory, then
+JsonBasedReader.main, the ontology lookups (with local stand-ins for the remote APIs), AggregateReportsBySection.main,
+combine_list_dfs, normalize_df_columns and rfecv_classifier are timed.  The results are printed as a table and saved
+to benchmark_results.json in the output directory, so runs before and after a change can be compared.
+
+Example:
+    python Benchmark.py --sizes 1000 10000 100000 --out-dir bench/
+"""
+
+
+import argparse
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+import pandas as pd
+
+import SyntheticBundles
+from MLDataProcessing import save_to_json, log_settings
+
+DEFAULT_SIZES = (1000, 10000)
+STAGES = ('generate', 'json_reader', 'lookups', 'aggregate', 'combine_list_dfs', 'normalize_df_columns',
+          'rfecv_classifier')
+
+
+class StageTimer():
+    def __init__(self):
+        self.results = {}
+
+    def time(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.results[name] = time.perf_counter() - start
+        logging.info("%s: %.3f s" % (name, self.results[name]))
+        return result
+
+
+def load_section_fms(work_dir):
+    fm_by_section = []
+    for path in sorted(Path(work_dir / 'section_fm').glob('*.csv')):
+        fm_by_section.append(pd.read_csv(path, index_col=0).fillna(0))
+    return fm_by_section
+
+
+def run_lookups(work_dir, snomed_depth=2):
+    import RxOntologyLookup
+    import SnomedOntologyLookup
+    RxOntologyLookup.main(work_dir)
+    SnomedOntologyLookup.main(work_dir, depth=snomed_depth)
+
+
+def benchmark_size(n_reports, out_dir, seed=0, bundle_settings=None, skip=(), model='dt', keep=False,
+                   vocabulary_settings=None):
+    """Generates a corpus of n_reports and times each stage on it, returns {stage: seconds}.
+    vocabulary_settings: SyntheticVocabulary arguments (n_snomed, n_rxnorm)"""
+    import AggregateReportsBySection
+    import JsonBasedReader
+    from MLDataProcessing import combine_list_dfs, get_ML_parameters, normalize_df_columns
+    from RunClassification import rfecv_classifier
+
+    bundle_settings = bundle_settings or {}
+    vocabulary_settings = vocabulary_settings or {}
+    run_dir = Path(out_dir) / ('n' + str(n_reports))
+    data_dir = run_dir / 'bundles'
+    work_dir = run_dir / 'work'
+    os.makedirs(work_dir / 'data', exist_ok=True)
+    timer = StageTimer()
+
+    vocabulary = SyntheticBundles.SyntheticVocabulary(seed=seed, **vocabulary_settings)
+    timer.time('generate', SyntheticBundles.generate_corpus, data_dir, n_reports, vocabulary=vocabulary, seed=seed,
+               **bundle_settings)
+    SyntheticBundles.generate_gold(work_dir / 'GOLD_multiclass.csv', n_reports, seed=seed)
+    SyntheticBundles.install_local_lookups(vocabulary)
+
+    timer.time('json_reader', JsonBasedReader.main, data_dir=data_dir, work_dir=work_dir)
+    if 'lookups' not in skip:
+        timer.time('lookups', run_lookups, work_dir)
+    else:
+        SyntheticBundles.save_local_ontology(vocabulary, work_dir)
+    timer.time('aggregate', AggregateReportsBySection.main, work_dir)
+
+    fm_by_section = load_section_fms(work_dir)
+    full_fm = timer.time('combine_list_dfs', combine_list_dfs, fm_by_section)
+    normalized = timer.time('normalize_df_columns', normalize_df_columns, full_fm, tf=(lambda x: x ** (1 / 3)))
+
+    if 'rfecv_classifier' not in skip:
+        gold = pd.read_csv(work_dir / 'GOLD_multiclass.csv', index_col=0)
+        gold = gold.reindex(normalized.index)
+        task = [x for x in gold if x not in ['test', 'train']][0]
+        labels = (gold[task] == 'Y').astype(int)
+        train = gold['train'] == 1
+        timer.time('rfecv_classifier', rfecv_classifier, model, normalized[train], labels[train],
+                   normalized[~train], CV_=3, fraction_feat_to_keep=0.1, LM_params=get_ML_parameters())
+
+    results = dict(timer.results)
+    results['n_reports'] = n_reports
+    results['n_features'] = int(full_fm.shape[1])
+    results['bundle_mb'] = sum(p.stat().st_size for p in data_dir.glob('*.json')) / 1e6
+    if not keep:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return results
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, out_dir='benchmark', seed=0, bundle_settings=None, skip=(), model='dt',
+                   keep=False, vocabulary_settings=None):
+    out_dir = Path(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    log_settings(filename=str(out_dir / "benchmark.log"), filemode='w')
+
+    all_results = []
+    for n_reports in sizes:
+        logging.info("Benchmarking %d reports" % n_reports)
+        all_results.append(benchmark_size(n_reports, out_dir, seed=seed, bundle_settings=bundle_settings,
+                                          skip=skip, model=model, keep=keep,
+                                          vocabulary_settings=vocabulary_settings))
+
+    print_table(all_results)
+    save_to_json(all_results, out_dir / 'benchmark_results.json', indent=4, print_save_loc=True)
+    return all_results
+
+
+def print_table(all_results):
+    print(("%24s" + "%12s" * len(all_results)) % (('stage (s)',) + tuple(str(r['n_reports']) for r in all_results)))
+    for stage in STAGES:
+        values = [('%12.3f' % r[stage]) if stage in r else '%12s' % '-' for r in all_results]
+        print('%24s' % stage + ''.join(values))
+    print('%24s' % 'features' + ''.join('%12d' % r['n_features'] for r in all_results))
+    print('%24s' % 'bundle MB' + ''.join('%12.1f' % r['bundle_mb'] for r in all_results))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the pipeline stages on synthetic FHIR bundles")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help="number of reports of each corpus, e.g. 1000 10000 100000")
+    parser.add_argument('--out-dir', default='benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sections', type=int, default=8, help="sections per report")
+    parser.add_argument('--resources', type=int, default=6, help="average resources per section")
+    parser.add_argument('--negation-rate', type=float, default=0.1)
+    parser.add_argument('--n-snomed', type=int, default=2000, help="Snomed-CT codes in the synthetic vocabulary")
+    parser.add_argument('--n-rxnorm', type=int, default=500, help="RxNorm codes in the synthetic vocabulary")
+    parser.add_argument('--model', default='dt', help="model used to time rfecv_classifier")
+    parser.add_argument('--skip', nargs='*', default=[], choices=['lookups', 'rfecv_classifier'],
+                        help="stages to leave out (the local ontology is written directly if lookups are skipped)")
+    parser.add_argument('--keep', action='store_true', help="keep the generated bundles and work directories")
+    args = parser.parse_args()
+
+    run_benchmarks(args.sizes, args.out_dir, seed=args.seed, skip=args.skip, model=args.model, keep=args.keep,
+                   bundle_settings={'n_sections': args.sections, 'resources_per_section': args.resources,
+                                    'negation_rate': args.negation_rate},
+                   vocabulary_settings={'n_snomed': args.n_snomed, 'n_rxnorm': args.n_rxnorm})
@@ -10,15 +10,27 @@ Main method is out-dated (originally set-up to evaluate RunClassifier output res
 
 
 
-#ignore warnings
-def warn(*args, **kwargs):
-    pass
 import warnings
-warnings.warn = warn
-
-from sklearn.metrics import f1_score, precision_score, recall_score
 from pathlib import Path
 
+
+# sklearn.metrics is imported on first use.  Only UndefinedMetricWarning (no predicted/gold samples of a class, the
+# score is set to 0) is ignored, and only inside these calls
+def _metric(name):
+    def score(*args, **kwargs):
+        import sklearn.metrics
+        from sklearn.exceptions import UndefinedMetricWarning
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UndefinedMetricWarning)
+            return getattr(sklearn.metrics, name)(*args, **kwargs)
+    score.__name__ = name
+    return score
+
+
+f1_score = _metric('f1_score')
+precision_score = _metric('precision_score')
+recall_score = _metric('recall_score')
+
 work_dir = Path("")
 GOLD_FILE = work_dir / "GOLD_multiclass.csv"
 
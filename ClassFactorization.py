@@ -5,12 +5,20 @@
 
 Using a user defined dictionary, will convert text labels of a class into an "int" value for more convenience
 when running ML algorithms.  e.g. 'Y' to 1, 'N' to 0
+
+factorize_gold can be imported to factorize a gold standard DataFrame in memory.  The whole label table is mapped in
+one pass using categorical codes, integer labels are kept as they are and everything else is set to -1.
 """
 
 
-import pandas as pd
+from collections import Counter
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
+
+from Instrumentation import reset_metrics, emit_metrics
+
 protected_key_words = ['train', 'test']
 conversion = {'Y': 1, 'N': 0, 'Q': 2, 'U': 3}
 
@@ -26,12 +34,60 @@ def _data_multi_factorize(*args):
 
     if x in conversion:
         return conversion[x]
-    elif isinstance(x, int):
-        pass
+    elif isinstance(x, (int, np.integer)):
+        return x
     else:
         return -1
 
 
+def factorize_gold(df, conversion_dict=None, skip_columns=None):
+    """Converts the text labels of every task column in the gold standard to integers in one pass.
+
+    Labels found in conversion_dict are mapped to their values, integer labels are kept as they are and anything
+    else becomes -1 (ignored by classifiers later on).  Task columns are stored as the smallest integer type that
+    fits (int8 for the usual labels).
+
+    :return: (factorized DataFrame, {task: Counter of unmapped values}).  Blank cells are not reported as unmapped.
+    """
+    if conversion_dict is None:
+        conversion_dict = conversion
+    if skip_columns is None:
+        skip_columns = protected_key_words
+
+    tasks = [task for task in df.columns if task not in skip_columns]
+    out = df.copy()
+    if not tasks:
+        return out, {}
+
+    labels = df[tasks].to_numpy(dtype=object)
+    flat = labels.ravel(order='F')  # column by column so each task is a contiguous block
+
+    # categorical codes index into the converted values, code -1 (not in dictionary) picks up the trailing -1
+    categories = list(conversion_dict.keys())
+    lookup = np.array([conversion_dict[c] for c in categories] + [-1], dtype=np.int64)
+    codes = pd.Categorical(flat, categories=categories).codes
+    values = lookup[codes]
+
+    # keep integer labels (ints, integral floats or integer strings from a mixed column)
+    unmapped = codes == -1
+    numeric = pd.to_numeric(pd.Series(flat[unmapped], dtype=object), errors='coerce').to_numpy(dtype=float)
+    is_int = ~np.isnan(numeric) & (numeric == np.round(numeric))
+    values[np.flatnonzero(unmapped)[is_int]] = numeric[is_int].astype(np.int64)
+    unmapped[np.flatnonzero(unmapped)[is_int]] = False
+
+    blank = pd.isna(pd.Series(flat, dtype=object)).to_numpy()
+    report_mask = unmapped & ~blank
+
+    n_rows = len(df)
+    unmapped_report = {}
+    for i, task in enumerate(tasks):
+        block = slice(i * n_rows, (i + 1) * n_rows)
+        out[task] = pd.to_numeric(pd.Series(values[block], index=df.index), downcast='integer')
+        if report_mask[block].any():
+            unmapped_report[task] = Counter(flat[block][report_mask[block]])
+
+    return out, unmapped_report
+
 
 def main(gold_csv = None, conversion_dict = None, work_dir = None):
     while gold_csv is None or Path(gold_csv).exists() is False:
@@ -45,15 +101,17 @@ def main(gold_csv = None, conversion_dict = None, work_dir = None):
         global conversion
         conversion = conversion_dict
 
+    metrics = reset_metrics('class_factorization')
     df = pd.read_csv(gold_csv, index_col=0)
+    metrics.count('labels', df.size)
 
     print("Columns: ")
     print(list(df.columns))
 
-    for task in df.columns:
-        if task in protected_key_words:
-            continue
-        df[task] = df[task].apply(_data_multi_factorize)
+    df, unmapped = factorize_gold(df, conversion, protected_key_words)
+    metrics.count('labels_unmapped', sum(sum(values.values()) for values in unmapped.values()))
+    for task, values in unmapped.items():
+        print("Unmapped labels set to -1 in", task, ":", dict(values))
     print(df.head())
 
     if work_dir is None:
@@ -63,6 +121,7 @@ def main(gold_csv = None, conversion_dict = None, work_dir = None):
     df.to_csv(path_out)
 
     print("Factorized Gold Standard saved to: ", str(path_out))
+    emit_metrics('class_factorization', work_dir if work_dir is not None else gold_csv.parent)
 
 if __name__ == '__main__':
     main()
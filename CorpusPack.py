@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""CorpusPack.py
+
+Packs a directory of FHIR JSON Resource Bundles into one indexed container file, so the readers do one open and one
+memory map instead of a glob plus an open per bundle.
+
+Layout (little endian):
+    header   8s magic 'FHIRPAK1', uint32 flags (1 = zlib compressed payloads), uint32 unused,
+             uint64 number of records, uint64 offset of the index
+    payloads the bundles one after another, raw JSON bytes or zlib streams
+    index    number of records x (uint64 offset, uint64 length) of the payloads
+    names    uint64 length + utf-8 record names (bundle file stems) joined by newlines
+
+Records are in report number order (as JsonBasedReader reads a directory).  CorpusPack memory maps the file and
+reads records by offset; shard(i, n) gives the contiguous record range of worker i out of n, so workers can split a
+pack without copying it.  JsonBasedReader.main accepts a pack file in place of the data directory.
+
+Example:
+    python CorpusPack.py pack <bundle dir> <corpus.fhirpack> [--zlib]
+    python CorpusPack.py list <corpus.fhirpack>
+"""
+
+
+import json
+import mmap
+import os
+import struct
+import zlib
+from pathlib import Path
+
+from Sharding import report_sort_key
+
+PACK_SUFFIX = '.fhirpack'
+MAGIC = b'FHIRPAK1'
+FLAG_ZLIB = 1
+
+_header = struct.Struct('<8sIIQQ')
+_index_entry = struct.Struct('<QQ')
+_length = struct.Struct('<Q')
+
+
+def is_pack(path):
+    path = Path(path)
+    if not path.is_file():
+        return False
+    with open(path, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def pack_corpus(data_dir, pack_file, compress=False, level=6, pattern='*.json'):
+    """Writes all bundles of data_dir into pack_file, returns the number of records."""
+    paths = sorted(Path(data_dir).glob(pattern), key=lambda p: report_sort_key(p.stem))
+    flags = FLAG_ZLIB if compress else 0
+    index = []
+    names = []
+    with open(pack_file, 'wb') as fp:
+        fp.write(_header.pack(MAGIC, flags, 0, 0, 0))  # rewritten once the index offset is known
+        for path in paths:
+            with open(path, 'rb') as bundle:
+                payload = bundle.read()
+            if compress:
+                payload = zlib.compress(payload, level)
+            index.append((fp.tell(), len(payload)))
+            names.append(path.stem)
+            fp.write(payload)
+
+        index_offset = fp.tell()
+        for entry in index:
+            fp.write(_index_entry.pack(*entry))
+        names_blob = '\n'.join(names).encode('utf-8')
+        fp.write(_length.pack(len(names_blob)))
+        fp.write(names_blob)
+
+        fp.seek(0)
+        fp.write(_header.pack(MAGIC, flags, 0, len(index), index_offset))
+    print("Packed %d bundles into: %s" % (len(index), str(pack_file)))
+    return len(index)
+
+
+class CorpusPack():
+    def __init__(self, pack_file):
+        self.path = Path(pack_file)
+        self._fp = open(self.path, 'rb')
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.flags, _, n_records, index_offset = _header.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(str(pack_file) + " is not a corpus pack")
+        self.compressed = bool(self.flags & FLAG_ZLIB)
+        self._index_offset = index_offset
+        names_offset = index_offset + n_records * _index_entry.size
+        (names_length,) = _length.unpack_from(self._mm, names_offset)
+        start = names_offset + _length.size
+        names = self._mm[start:start + names_length].decode('utf-8')
+        self.names = names.split('\n') if n_records else []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if getattr(self, '_mm', None) is not None:
+            self._mm.close()
+            self._mm = None
+        self._fp.close()
+
+    def record_span(self, i):
+        """(offset, length) of the payload of record i."""
+        if not 0 <= i < len(self):
+            raise IndexError("record %d out of range" % i)
+        return _index_entry.unpack_from(self._mm, self._index_offset + i * _index_entry.size)
+
+    def record_size(self, i):
+        return self.record_span(i)[1]
+
+    def read(self, i):
+        """Returns the JSON bytes of record i."""
+        offset, length = self.record_span(i)
+        payload = self._mm[offset:offset + length]
+        if self.compressed:
+            payload = zlib.decompress(payload)
+        return payload
+
+    def load(self, i):
+        return json.loads(self.read(i))
+
+    def shard(self, i, n):
+        """Contiguous (start, stop) record range of shard i out of n (0 <= i < n)."""
+        if not 0 <= i < n:
+            raise ValueError("shard %d out of range for %d shards" % (i, n))
+        return len(self) * i // n, len(self) * (i + 1) // n
+
+    def iter_records(self, start=0, stop=None, select=None):
+        """Yields (name, payload size, bundle dict) for the records in [start, stop), only those whose name passes
+        select(name) if given (checked before the record is read)."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for i in range(start, stop):
+            if select is None or select(self.names[i]):
+                yield self.names[i], self.record_size(i), self.load(i)
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 3 and sys.argv[1] == 'pack':
+        pack_corpus(sys.argv[2], sys.argv[3], compress='--zlib' in sys.argv[4:])
+    elif len(sys.argv) > 2 and sys.argv[1] == 'list':
+        with CorpusPack(sys.argv[2]) as pack:
+            print("%d records, %s, %.1f MB" % (len(pack), 'zlib' if pack.compressed else 'raw',
+                                               os.path.getsize(sys.argv[2]) / 1e6))
+            for i, name in enumerate(pack.names):
+                print(name, pack.record_size(i))
+    else:
+        exit("usage: python CorpusPack.py pack <bundle dir> <pack file> [--zlib] | list <pack file>")
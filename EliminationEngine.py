@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""EliminationEngine.py
+
+Recursive feature elimination with a geometric schedule, used by FeatureElimination in place of the
+RFECV -> RFE -> RFE sequence of RunClassification.rfecv_classifier.
+
+rfecv_classifier removes a fixed step of (1 - fraction) / CV_ of the columns per iteration, every RFECV fold and the
+following RFE calls redo the whole elimination from scratch.  Here a single elimination path is followed:
+    - each level keeps ratio times the columns of the previous one (down to min_features), so the number of levels
+      grows with log(n_features) instead of n_features
+    - at each level one model is fitted per CV fold, the mean fold accuracy is the score of the level and the mean
+      importance of the fold models (feature_importances_ or |coef_|) ranks the columns for the next level, no extra
+      fit is needed for the ranking
+    - linear models (coef_) are warm started from the model of the same fold at the previous level, restricted to
+      the columns still kept (only used by solvers supporting warm_start, liblinear ignores it)
+    - the elimination stops once the score has not improved for patience levels among the levels with at most
+      max_features columns
+The selected level is the best scoring one with at most max_features columns (ties go to fewer columns), the final
+estimator is fitted on all the training rows of its columns.  The whole score vs number of features curve is kept.
+As in rfecv_classifier (RFECV failing -> RFE), too few reports per class for cv folds lowers the number of folds, and
+without at least 2 folds the elimination runs without CV: one model per level fitted on all the rows (the scores are
+training accuracies), stopping at the first level with at most max_features columns.
+
+Example:
+    result = eliminate(clf, train[features], train[task], min_features=40, max_features=60)
+    preds = result.predict(test[features])
+"""
+
+
+import logging
+
+
+class EliminationResult():
+    def __init__(self, features, support, curve, n_fits, estimator):
+        self.features = features        # selected features, in their original order
+        self.support = support          # boolean mask over the input columns
+        self.curve = curve              # [{'n_features', 'score', 'score_std'}] one entry per level evaluated
+        self.n_fits = n_fits
+        self.estimator = estimator      # fitted on the selected features (numpy input, in order)
+
+    @property
+    def n_features(self):
+        return len(self.features)
+
+    def predict(self, X):
+        """X: DataFrame with the selected features as columns, or array of all the input columns"""
+        import numpy as np
+        X = X[self.features].to_numpy() if hasattr(X, 'columns') else np.asarray(X)[:, self.support]
+        return self.estimator.predict(X)
+
+
+def geometric_schedule(n_features, min_features=1, ratio=0.7):
+    """Number of columns of each level: n_features, then ratio times the previous one (at least one column less),
+    ending with min_features"""
+    if not 0 < ratio < 1:
+        raise ValueError("ratio must be between 0 and 1, got " + str(ratio))
+    min_features = max(1, min(min_features, n_features))
+    counts = [n_features]
+    while counts[-1] > min_features:
+        counts.append(max(min_features, min(counts[-1] - 1, int(counts[-1] * ratio))))
+    return counts
+
+
+def feature_importances(estimator):
+    import numpy as np
+    if hasattr(estimator, 'feature_importances_'):
+        return np.asarray(estimator.feature_importances_, dtype=float)
+    if hasattr(estimator, 'coef_'):
+        coef = np.asarray(estimator.coef_, dtype=float)
+        return np.abs(coef).sum(axis=0) if coef.ndim > 1 else np.abs(coef)
+    raise ValueError("%s has no coef_ or feature_importances_, can not be used for feature elimination"
+                     % type(estimator).__name__)
+
+
+def _warm_start(estimator, previous, kept):
+    """Starts a linear model from the coefficients of previous (fitted on the columns of the previous level), kept:
+    positions of the columns still used among the previous ones"""
+    if previous is None or not hasattr(previous, 'coef_') or 'warm_start' not in estimator.get_params():
+        return estimator
+    if getattr(estimator, 'solver', None) == 'liblinear':
+        return estimator
+    estimator.set_params(warm_start=True)
+    estimator.coef_ = previous.coef_[:, kept] if previous.coef_.ndim > 1 else previous.coef_[kept]
+    estimator.intercept_ = previous.intercept_
+    return estimator
+
+
+def eliminate(estimator, X, y, min_features=1, max_features=None, cv=3, ratio=0.7, patience=2):
+    """Eliminates the columns of DataFrame X for the classes y, returns an EliminationResult"""
+    import numpy as np
+    from sklearn.base import clone
+    from sklearn.model_selection import StratifiedKFold
+
+    feature_names = list(X.columns)
+    X = X.to_numpy(dtype=float)
+    y = np.asarray(y)
+    max_features = len(feature_names) if max_features is None else max_features
+
+    # StratifiedKFold needs some class with at least n_splits reports
+    n_splits = min(cv, int(np.unique(y, return_counts=True)[1].max(initial=0)))
+    if n_splits >= 2:
+        if n_splits < cv:
+            logging.warning("elimination: too few reports per class for %d folds, using %d" % (cv, n_splits))
+        folds = list(StratifiedKFold(n_splits=n_splits).split(X, y))
+    else:
+        logging.warning("elimination: too few reports per class for CV, eliminating without CV")
+        folds = [(np.arange(len(y)), np.arange(len(y)))]
+
+    columns = np.arange(X.shape[1])      # columns of the current level
+    previous_models = [None] * len(folds)
+    importance = None                    # mean importance of the columns of the previous level
+    curve = []
+    n_fits = 0
+    best, best_score, stale = None, None, 0
+
+    schedule = geometric_schedule(len(feature_names), min_features, ratio)
+    for level, n_columns in enumerate(schedule):
+        if level > 0:
+            # keep the n_columns most important columns of the previous level, in their original order
+            kept = np.sort(np.argsort(-importance, kind='stable')[:n_columns])
+            columns = columns[kept]
+        else:
+            kept = None
+
+        scores = []
+        importance = np.zeros(len(columns))
+        models = []
+        for fold, (train_index, valid_index) in enumerate(folds):
+            model = clone(estimator)
+            if kept is not None:
+                model = _warm_start(model, previous_models[fold], kept)
+            model.fit(X[np.ix_(train_index, columns)], y[train_index])
+            n_fits += 1
+            scores.append(np.mean(model.predict(X[np.ix_(valid_index, columns)]) == y[valid_index]))
+            importance += feature_importances(model)
+            models.append(model)
+        previous_models = models
+
+        score = float(np.mean(scores))
+        curve.append({'n_features': int(n_columns), 'score': score, 'score_std': float(np.std(scores))})
+        logging.debug("elimination level %d: %d features, score %.4f" % (level, n_columns, score))
+
+        if n_columns > max_features:
+            continue
+        if n_splits < 2:
+            best = columns
+            break
+        if best is None or score >= best_score:
+            best, best_score, stale = columns, score, 0
+        else:
+            stale += 1
+            if stale >= patience:
+                break
+
+    if best is None:   # max_features below min_features: keep the last level
+        best = columns
+
+    final = clone(estimator)
+    final.fit(X[:, best], y)
+    n_fits += 1
+
+    support = np.zeros(len(feature_names), dtype=bool)
+    support[best] = True
+    features = [feature_names[i] for i in best]
+    logging.info("elimination: %d -> %d features, %d levels of %d, %d fits"
+                 % (len(feature_names), len(features), len(curve), len(schedule), n_fits))
+    return EliminationResult(features, support, curve, n_fits, final)
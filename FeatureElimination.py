@@ -12,20 +12,29 @@ from collections import defaultdict
 from MLDataProcessing import combine_list_dfs, save_to_json
 from itertools import combinations
 from RunClassification import rfe_classifier, rfecv_classifier, set_up_classifier
-import pandas as pd
-from MLDataProcessing import get_ML_parameters, rearrange_for_testing, log_settings, normalize_df_columns
+from MLDataProcessing import get_ML_parameters, SplitIndex, log_settings
 import CalculatePerformance
+from Instrumentation import reset_metrics, emit_metrics, profile_stage
+from ModelRegistry import ModelRegistry, REGISTRY_DIR, fit_normalizer, normalize
+from FeaturePrefilter import cached_prefilter
+from EliminationEngine import eliminate
 
 
-def main(work_dir=None, model='rf', set_of_classes=(0, 1, 2, 3)):
+@profile_stage('feature_elimination')
+def main(work_dir=None, model='rf', set_of_classes=(0, 1, 2, 3), aggregate_settings=None, input_format='columns',
+         prefilter_factor=10, elimination='geometric', gold_file=None):
+    import pandas as pd
+
     while work_dir is None or Path(work_dir).exists() is False:
         print("Unable to locate directory.")
         work_dir = input("Please enter working directory: ")
 
     # folder with features split by section
     work_dir = Path(work_dir)
+    metrics = reset_metrics('feature_elimination')
     DATA_DIR = work_dir/'section_fm'
-    GOLD_FILE = work_dir/'GOLD_multiclass.csv'
+    # factorized gold written by ClassFactorization (<gold csv stem>_multiclass.csv)
+    GOLD_FILE = Path(gold_file) if gold_file is not None else work_dir/'GOLD_multiclass.csv'
 
 
 
@@ -37,19 +46,30 @@ def main(work_dir=None, model='rf', set_of_classes=(0, 1, 2, 3)):
         params = get_ML_parameters(use_default=True)
 
 
-    logging.info("Loading Data from: " + str(DATA_DIR))
-
-    pathlist = Path(DATA_DIR).glob('*.csv')
-
     fm_by_section = {}
     lionc = []
     sections_writen = defaultdict(bool) # default = false
+    hashing = None
+
+    # input_format 'hashed' trains on the non empty columns of the hashed feature matrix (FeatureHashing)
+    if input_format == 'hashed':
+        from FeatureHashing import load_hashed_matrix, hashed_frame, HASHED_FM_FILE
+        logging.info("Loading Data from: " + str(work_dir / HASHED_FM_FILE))
+        matrix, hashed_info = load_hashed_matrix(work_dir)
+        fm_by_section['hashed'] = hashed_frame(matrix)
+        lionc.append('hashed')
+        hashing = hashed_info['hashing']
+        aggregate_settings = aggregate_settings or hashed_info['aggregate_settings']
+    else:
+        logging.info("Loading Data from: " + str(DATA_DIR))
+
+        pathlist = Path(DATA_DIR).glob('*.csv')
 
-    for path in pathlist:
-        section_name = path.stem
-        lionc.append(section_name)
-        fm_by_section[section_name] = pd.read_csv(path,index_col=0)
-        fm_by_section[section_name].fillna(0, inplace=True)
+        for path in pathlist:
+            section_name = path.stem
+            lionc.append(section_name)
+            fm_by_section[section_name] = pd.read_csv(path,index_col=0)
+            fm_by_section[section_name].fillna(0, inplace=True)
 
     if len(lionc) < 1:
         logging.error("No files found at: " + str(DATA_DIR))
@@ -63,9 +83,19 @@ def main(work_dir=None, model='rf', set_of_classes=(0, 1, 2, 3)):
 
     frac_features_for_running_f1 = 0.01
 
+    # prefilter_factor > 0: before RFE/RFECV, keep prefilter_factor times the number of features the elimination
+    # ends with, using the document frequency, variance and chi2 filters of FeaturePrefilter (cached per task)
+    prefilter_settings = {'min_df': 2, 'max_df': 1.0, 'min_variance': 0.0, 'score': 'chi2'}
+    logging.info("prefilter_factor: " + str(prefilter_factor) + " settings: " + str(prefilter_settings))
+
 
     #set the following to use either RFECV or RFE
     run_f1_with_rfecv = True
+    # elimination 'geometric': EliminationEngine (geometric steps, one CV path, early stopping), 'rfecv': sklearn
+    # RFECV/RFE as in rfecv_classifier.  Both keep between 1/max_ratio_diff and max_ratio_diff times the target
+    max_ratio_diff = 1.2
+    elimination_curves = {}
+    logging.info("elimination: " + str(elimination))
     logging.info("frac_features_for_running_f1: " + str(frac_features_for_running_f1) + " with CV?: " + str(run_f1_with_rfecv))
     no_feature_elim = False  # if run_f1_with_rfecv == False can try to run without Feature elim
 
@@ -74,6 +104,7 @@ def main(work_dir=None, model='rf', set_of_classes=(0, 1, 2, 3)):
     logging.info("model to run: " + str(model))
 
     rfecv_top_features = {}
+    registry = ModelRegistry(work_dir / REGISTRY_DIR)
     NUM_SECT_TO_COMBINE = len(lionc)  # add all sections
     sect_combinations = combinations(lionc,NUM_SECT_TO_COMBINE)
 
@@ -85,9 +116,26 @@ def main(work_dir=None, model='rf', set_of_classes=(0, 1, 2, 3)):
 
         merged = combine_list_dfs(section_list)
 
-        merged = normalize_df_columns(merged,0,tf=(lambda x: x ** (1/3)))
+        registry.save_manifest(model=model, vocabulary=list(merged.columns), aggregate_settings=aggregate_settings,
+                               hashing=hashing)
 
-        train, test, features = rearrange_for_testing(merged, gold)
+        # filter features if desired, once for all the tasks
+        features = merged.columns
+        if hashing is None:
+            features = [f for f in features if len(f)!=2]
+        # features = [f for f in features if f[-1] != 'n']
+
+        # train/test rows and valid classes of every task found once, data is the only copy of the matrix: the tasks
+        # get row slices of it, and take only the valid rows and prefiltered columns they use
+        split = SplitIndex(gold, merged.index, set_of_classes)
+        data = split.arrange(merged, features)
+
+        # cube root and min-max normalizer fitted on the training rows only (the test rows can fall outside [0, 1]),
+        # applied to all the rows and saved with the models to score new reports
+        data_min, data_max = fit_normalizer(data.iloc[:split.n_train])
+        scale = pd.DataFrame([data_min, data_max], columns=data.columns)
+        data = pd.DataFrame(normalize(data.to_numpy(dtype=float), scale.to_numpy()), index=data.index,
+                            columns=data.columns, copy=False)
 
         p_avg, r_avg, f1_avg, f1_macro_avg = 0, 0, 0, 0
 
@@ -98,25 +146,62 @@ def main(work_dir=None, model='rf', set_of_classes=(0, 1, 2, 3)):
 
 
         for task in tasks:
-            train, test, features = rearrange_for_testing(merged, gold, task, set_of_classes)
-            # filter features if desired
-            features = [f for f in features if len(f)!=2]
-            # features = [f for f in features if f[-1] != 'n']
-
-            if run_f1_with_rfecv:
-                preds, feat_important,num_feat = rfecv_classifier(model, train_data=train[features], train_class=train[task], test_data=test[features], CV_=3, fraction_feat_to_keep=frac_features_for_running_f1, LM_params=params, save_model=True)
+            features = data.columns
+            train_block, train_rows, train_y, test_block, test_rows, test_y = split.split_rows(data, task)
+
+            metrics.count('tasks')
+            metrics.count('features_in', len(features))
+            fraction_to_keep = frac_features_for_running_f1
+            if prefilter_factor:
+                n_to_keep = max(1, int(frac_features_for_running_f1 * len(features)))
+                with metrics.timer('prefilter'):
+                    features, counts = cached_prefilter(work_dir, task, train_block, train_y, rows=train_rows,
+                                                        max_features=prefilter_factor * n_to_keep,
+                                                        **prefilter_settings)
+                logging.info("task: " + str(task) + " prefilter: " + str(counts))
+                if not features:
+                    # e.g. min_df=2 with every code found in a single report: eliminate from all the features
+                    logging.warning("task: " + str(task) + " prefilter kept no feature, using all " +
+                                    str(len(data.columns)))
+                    features = data.columns
+                metrics.count('features_after_prefilter', len(features))
+                # same number of features kept in the end, as a fraction of the prefiltered columns
+                fraction_to_keep = min(1.0, (n_to_keep + 0.5) / len(features))
+            # views of data when all the rows are valid and no column was prefiltered, else a single take
+            columns = None if len(features) == len(data.columns) else features
+            train = SplitIndex.take(train_block, train_rows, columns)
+            test = SplitIndex.take(test_block, test_rows, columns)
+            if run_f1_with_rfecv and elimination == 'geometric':
+                n_target = max(1, int(fraction_to_keep * len(features)))
+                with metrics.timer('elimination'):
+                    result = eliminate(set_up_classifier(model, 3, params), train, train_y, cv=3,
+                                       min_features=max(1, int(n_target / max_ratio_diff + 0.5)),
+                                       max_features=int(n_target * max_ratio_diff))
+                    preds = result.predict(test)
+                metrics.count('elimination_fits', result.n_fits)
+                feat_important = result.features
+                rfecv_top_features[task] = feat_important
+                elimination_curves[task] = result.curve
+                registry.save_task(task, result.estimator, feat_important, scale[feat_important].to_numpy(),
+                                   info={'num_features': result.n_features, 'train_reports': len(train),
+                                         'elimination_fits': result.n_fits})
+            elif run_f1_with_rfecv:
+                with metrics.timer('rfecv'):
+                    preds, feat_important,num_feat,estimator = rfecv_classifier(model, train_data=train, train_class=train_y, test_data=test, CV_=3, fraction_feat_to_keep=fraction_to_keep, LM_params=params, save_model=True)
                 rfecv_top_features[task] = feat_important
+                registry.save_task(task, estimator, feat_important, scale[feat_important].to_numpy(),
+                                   info={'num_features': int(num_feat), 'train_reports': len(train)})
             elif no_feature_elim:
                 clf = set_up_classifier(model, 0, LM_params=params)
-                clf.fit(train[features], train[task])
-                preds = clf.predict(test[features])
+                clf.fit(train, train_y)
+                preds = clf.predict(test)
             else:
-                preds, feat_important,num_feat = rfe_classifier(model, train_data=train[features], train_class=train[task].astype(int), test_data=test[features], CV_=10, fraction_feat_to_keep=frac_features_for_running_f1, LM_params=params)
+                preds, feat_important,num_feat = rfe_classifier(model, train_data=train, train_class=train_y.astype(int), test_data=test, CV_=10, fraction_feat_to_keep=fraction_to_keep, LM_params=params)
 
 
 
 
-            results = CalculatePerformance.calculate_metrics(list(test[task]), list(preds), set_of_classes,output_type='values')
+            results = CalculatePerformance.calculate_metrics(list(test_y), list(preds), set_of_classes,output_type='values')
             f1 = results[4]
             f1_macro = results[5]
 
@@ -124,8 +209,8 @@ def main(work_dir=None, model='rf', set_of_classes=(0, 1, 2, 3)):
             f1_macro_avg += f1_macro/len(tasks)
 
 
-            results = CalculatePerformance.calculate_metrics(list(test[task]), list(preds), set_of_classes,output_type='values')
-            logging.info("task: " + str(task) + ' ' + CalculatePerformance.calculate_metrics(list(test[task]), list(preds),set_of_classes,output_type='text').strip())
+            results = CalculatePerformance.calculate_metrics(list(test_y), list(preds), set_of_classes,output_type='values')
+            logging.info("task: " + str(task) + ' ' + CalculatePerformance.calculate_metrics(list(test_y), list(preds),set_of_classes,output_type='text').strip())
 
 
 
@@ -133,8 +218,11 @@ def main(work_dir=None, model='rf', set_of_classes=(0, 1, 2, 3)):
 
     file_name = work_dir / 'models' / 'top_features.json'
     save_to_json(rfecv_top_features,file_name)
+    if elimination_curves:
+        save_to_json(elimination_curves, work_dir / 'models' / 'elimination_curves.json')
 
     logging.info("Averages: f1: %.6f, f1_macro: %.6f" % (f1_avg, f1_macro_avg))
+    emit_metrics('feature_elimination', work_dir)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""FeatureHashing.py
+
+Hashing trick feature mode for AggregateReportsBySection: instead of one column per distinct code (which needs the
+vocabulary of the whole corpus and grows with it), each expanded code of a report is hashed into a fixed number of
+columns.  Reports are processed one at a time from the streamed JsonBasedReader outputs, no vocabulary pass is needed
+and the memory used does not depend on the number of distinct codes.
+
+The hash is the one of sklearn's FeatureHasher (signed murmurhash3_32 of the feature name, column abs(h) % n_features,
+sign of h with alternate_sign), so the same names give the same columns as FeatureHasher(n_features).  Feature names
+are the codes as in _feature_matrix_all_sections_.csv (sections summed); with_sections=True also adds
+'<section>_<code>' features for the per section values.
+
+Outputs (work dir):
+    _feature_matrix_hashed_.npz    reports x n_features scipy sparse matrix, row i is report i + 1
+    _feature_matrix_hashed_.json   settings, number of reports and the optional sampled reverse map
+                                   (column -> first reverse_map_size feature names hashed to it)
+
+FeatureElimination(input_format='hashed') trains on the non empty columns ('h<column>'), ModelRegistry scores new
+reports with the same hashing.
+
+Example:
+    python AggregateReportsBySection.py <work dir> --hash-features 262144
+"""
+
+
+from collections import defaultdict
+from functools import lru_cache
+from pathlib import Path
+
+from MLDataProcessing import save_to_json, load_dict_json
+from FeatureKey import default_codec
+
+HASHED_FM_FILE = '_feature_matrix_hashed_.npz'
+HASHED_INFO_FILE = '_feature_matrix_hashed_.json'
+DEFAULT_N_FEATURES = 1 << 18
+COLUMN_PREFIX = 'h'
+HASH_CACHE_SIZE = 1 << 16     # bounded cache of recently hashed names
+
+
+def column_name(column):
+    return COLUMN_PREFIX + str(column)
+
+
+class HashedFeatureSpace():
+    def __init__(self, n_features=DEFAULT_N_FEATURES, alternate_sign=False, with_sections=False,
+                 reverse_map_size=0):
+        from sklearn.utils import murmurhash3_32
+
+        if n_features < 1:
+            raise ValueError("n_features must be positive, got " + str(n_features))
+        self.n_features = int(n_features)
+        self.alternate_sign = alternate_sign
+        self.with_sections = with_sections
+        self.reverse_map_size = reverse_map_size
+        self.reverse_map = defaultdict(list)
+
+        @lru_cache(maxsize=HASH_CACHE_SIZE)
+        def hash_name(name):
+            h = murmurhash3_32(name, seed=0)
+            return abs(h) % self.n_features, (-1.0 if alternate_sign and h < 0 else 1.0)
+        self.hash_name = hash_name
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings['n_features'], settings.get('alternate_sign', False),
+                   settings.get('with_sections', False), settings.get('reverse_map_size', 0))
+
+    def settings(self):
+        return {'n_features': self.n_features, 'alternate_sign': self.alternate_sign,
+                'with_sections': self.with_sections, 'reverse_map_size': self.reverse_map_size}
+
+    def _add(self, values, name, count):
+        column, sign = self.hash_name(name)
+        values[column] += sign * count
+        if self.reverse_map_size:
+            names = self.reverse_map[column]
+            if len(names) < self.reverse_map_size and name not in names:
+                names.append(name)
+
+    def transform_codes(self, saved_codes_list):
+        """saved_codes_list: per section feature key counts as returned by expand_report_codes, returns
+        {column: value}, the legacy feature names are hashed"""
+        name = default_codec.name
+        values = defaultdict(float)
+        for saved_codes in saved_codes_list:
+            for section, codes in saved_codes.items():
+                for code, count in codes.items():
+                    self._add(values, name(code), count)
+                    if self.with_sections:
+                        self._add(values, section + '_' + name(code), count)
+        return values
+
+
+class HashedMatrixBuilder():
+    """Accumulates the hashed rows of reports given in increasing report id order into CSR arrays."""
+    def __init__(self, space):
+        from array import array
+        self.space = space
+        self.indptr = array('q', [0])
+        self.indices = array('i')
+        self.data = array('d')
+        self.n_rows = 0
+
+    def add_report(self, report_id, values):
+        """values: {column: value} of report report_id (ids start at 1, missing reports get empty rows)"""
+        if report_id <= self.n_rows:
+            raise ValueError("Reports must be added in increasing id order, got %d after %d" % (report_id,
+                                                                                              self.n_rows))
+        while self.n_rows < report_id - 1:
+            self.indptr.append(len(self.indices))
+            self.n_rows += 1
+        for column in sorted(values):
+            if values[column] != 0:
+                self.indices.append(column)
+                self.data.append(values[column])
+        self.indptr.append(len(self.indices))
+        self.n_rows += 1
+
+    def to_matrix(self, num_reports=None):
+        import numpy as np
+        from scipy import sparse
+        while num_reports is not None and self.n_rows < num_reports:
+            self.indptr.append(len(self.indices))
+            self.n_rows += 1
+        return sparse.csr_matrix((np.frombuffer(self.data, dtype=np.float64),
+                                  np.frombuffer(self.indices, dtype=np.int32),
+                                  np.frombuffer(self.indptr, dtype=np.int64)),
+                                 shape=(self.n_rows, self.space.n_features))
+
+
+def save_hashed_matrix(work_dir, matrix, space, num_reports, aggregate_settings=None):
+    from scipy import sparse
+    work_dir = Path(work_dir)
+    sparse.save_npz(work_dir / HASHED_FM_FILE, matrix)
+    info = {'hashing': space.settings(), 'num_reports': num_reports, 'nnz': int(matrix.nnz),
+            'aggregate_settings': aggregate_settings or {},
+            'reverse_map': {str(column): names for column, names in sorted(space.reverse_map.items())}}
+    save_to_json(info, work_dir / HASHED_INFO_FILE)
+    print("File saved: " + str(work_dir / HASHED_FM_FILE))
+
+
+def load_hashed_matrix(work_dir):
+    """Returns (reports x n_features CSR matrix, info)"""
+    from scipy import sparse
+    work_dir = Path(work_dir)
+    return sparse.load_npz(work_dir / HASHED_FM_FILE).tocsr(), load_dict_json(work_dir / HASHED_INFO_FILE)
+
+
+def hashed_frame(matrix, index=None):
+    """Dense DataFrame of the non empty columns of a hashed matrix (columns 'h<column>', rows index or 1..n)"""
+    import numpy as np
+    import pandas as pd
+    used = np.unique(matrix.indices)
+    index = index if index is not None else range(1, matrix.shape[0] + 1)
+    return pd.DataFrame(matrix[:, used].toarray(), index=index, columns=[column_name(c) for c in used])
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""FeatureKey.py
+
+Integer packed feature keys: the section, code system, code and family history/negation flags of a feature in one
+int, in place of the legacy strings of JsonBasedReader and AggregateReportsBySection ('10160-0_F-12345n': section
+10160-0, family history, code 12345, negated).
+
+Layout of a key (from the least significant bit):
+    code      64 bits   the code as an unsigned int when it is a plain decimal number (Snomed-CT, RxNorm), else the
+                        ASCII bytes of codes up to 8 characters (ATC classes, TEXT flag) or the id of the code in the
+                        codec's string table (INTERNED flag)
+    flags      4 bits   FAMILY, NEGATED, TEXT, INTERNED
+    system     4 bits   UNKNOWN, SNOMED, RXNORM or ATC (the legacy strings do not record it: UNKNOWN when parsed)
+    section   32 bits   id of the section (Lion-C code) in the codec
+
+The flags are set with |, e.g. key | NEGATED.  Keys with the same column_key(key) have the same legacy feature name
+(a column of the section feature matrices).  Section and string ids are given in first seen order by the codec, so keys
+are only meaningful within a process: the matrices and files keep the legacy names (FeatureKeyCodec.name/decode).
+The conversions are memoized in bounded caches (cache_size recent values each), only the section and string tables
+grow with the number of distinct sections and interned codes.
+
+Example:
+    key = default_codec.encode('10160-0_F-12345n')
+    default_codec.section(key), default_codec.code(key), bool(key & FAMILY), bool(key & NEGATED)
+        -> ('10160-0', '12345', True, True)
+    default_codec.decode(key) -> '10160-0_F-12345n'
+"""
+
+
+import threading
+from functools import lru_cache
+
+CODE_BITS = 64
+CODE_MASK = (1 << CODE_BITS) - 1
+FAMILY = 1 << 64
+NEGATED = 1 << 65
+TEXT = 1 << 66
+INTERNED = 1 << 67
+SYSTEM_SHIFT = 68
+SYSTEM_MASK = 0xF << SYSTEM_SHIFT
+SECTION_SHIFT = 72
+SECTION_MASK = 0xFFFFFFFF << SECTION_SHIFT
+CODEC_CACHE_SIZE = 1 << 16      # bounded caches of recently converted codes and names
+
+UNKNOWN, SNOMED, RXNORM, ATC = range(4)     # code systems
+
+DEFAULT_SECTION = '00000-0'
+FAMILY_PREFIX = 'F-'
+NEGATION_SUFFIX = 'n'
+
+
+def column_key(key):
+    """The part of a key identifying its legacy feature name: code and flags (no section, no code system)"""
+    return key & ~(SECTION_MASK | SYSTEM_MASK)
+
+
+def code_system(key):
+    return (key & SYSTEM_MASK) >> SYSTEM_SHIFT
+
+
+class FeatureKeyCodec():
+    """Packs and unpacks feature keys, converts them to and from the legacy strings (cached per recent value)."""
+    def __init__(self, cache_size=CODEC_CACHE_SIZE):
+        self.sections = []          # section id -> section
+        self.section_ids = {}
+        self.strings = []           # string id -> code (INTERNED codes)
+        self.string_ids = {}
+        self._lock = threading.Lock()
+        # (code, system) -> code, flags and system bits; column key -> legacy name; JsonBasedReader code -> parts
+        self.code_key = lru_cache(maxsize=cache_size)(self._code_key)
+        self._column_name = lru_cache(maxsize=cache_size)(self._name_of_column)
+        self.split = lru_cache(maxsize=cache_size)(self._split)
+
+    def _intern(self, value, values, ids):
+        i = ids.get(value)
+        if i is None:
+            with self._lock:
+                i = ids.get(value)
+                if i is None:
+                    i = len(values)
+                    values.append(value)
+                    ids[value] = i
+        return i
+
+    def section_key(self, section):
+        return self._intern(section, self.sections, self.section_ids) << SECTION_SHIFT
+
+    def _code_key(self, code, system=UNKNOWN):
+        """code, flags and system bits of a code (code_key, cached)"""
+        if code.isascii() and code.isdigit() and (code[0] != '0' or code == '0') and int(code) <= CODE_MASK:
+            key = int(code)
+        elif len(code) <= 8 and code.isascii() and code.isprintable():
+            key = TEXT | int.from_bytes(code.encode('ascii'), 'big')
+        else:
+            key = INTERNED | self._intern(code, self.strings, self.string_ids)
+        return key | (system << SYSTEM_SHIFT)
+
+    def key(self, section, code, system=UNKNOWN, family=False, negated=False):
+        return (self.section_key(section) | self.code_key(code, system) | (FAMILY if family else 0) |
+                (NEGATED if negated else 0))
+
+    def section(self, key):
+        return self.sections[key >> SECTION_SHIFT]
+
+    def code(self, key):
+        bits = key & CODE_MASK
+        if key & INTERNED:
+            return self.strings[bits]
+        if key & TEXT:
+            return bits.to_bytes((bits.bit_length() + 7) // 8, 'big').decode('ascii')
+        return str(bits)
+
+    def name(self, key):
+        """Legacy feature name without the section, e.g. 'F-12345n' (a column of the feature matrices)"""
+        return self._column_name(column_key(key))
+
+    def _name_of_column(self, column):
+        return FAMILY_PREFIX * bool(column & FAMILY) + self.code(column) + NEGATION_SUFFIX * bool(column & NEGATED)
+
+    def decode(self, key):
+        """Legacy string '<section>_[F-]<code>[n]'"""
+        return self.section(key) + '_' + self.name(key)
+
+    def _split(self, full_code):
+        """(section, family flag, code) of a JsonBasedReader code '<section>_[F-]<code>' (split, cached, no negation
+        suffix)"""
+        section, sep, code = full_code.partition('_')
+        if not sep:
+            section, code = DEFAULT_SECTION, full_code
+        family = code[:2] == FAMILY_PREFIX
+        return section, family, code[2:] if family else code
+
+    def encode(self, legacy, system=UNKNOWN, negation_suffix=True):
+        """Key of a legacy string '[<section>_][F-]<code>[n]' (a trailing 'n' is the negation if negation_suffix)"""
+        section, family, code = self.split(legacy)
+        negated = negation_suffix and code[-1:] == NEGATION_SUFFIX
+        return self.key(section, code[:-1] if negated else code, system, family, negated)
+
+
+default_codec = FeatureKeyCodec()
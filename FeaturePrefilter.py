@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""FeaturePrefilter.py
+
+Cheap feature pre-selection run before RFE/RFECV, so the elimination only fits models on the columns that survive.
+
+Three filters, all computed column wise at once on a scipy sparse matrix (the feature matrices are mostly zeros):
+    document frequency   keep codes found in at least min_df reports and at most max_df (fraction) of them
+    variance             keep columns with a variance above min_variance
+    class association    rank the remaining columns by chi2 (sklearn.feature_selection.chi2) or by the mutual
+                         information between the presence of the code and the class, keep the max_features best
+
+The kept features stay in their original column order.  cached_prefilter saves the selection of each task to
+work_dir/models/prefilter/<task>.json with a fingerprint of the training data and settings, and reuses it when
+FeatureElimination is run again on the same data.
+"""
+
+
+import hashlib
+import re
+from pathlib import Path
+
+from MLDataProcessing import save_to_json, load_dict_json
+
+PREFILTER_DIR = Path('models') / 'prefilter'
+SCORES = ('chi2', 'mutual_info')
+
+
+def to_sparse(X):
+    """DataFrame/array/sparse matrix -> CSC matrix without stored zeros"""
+    from scipy import sparse
+    if not sparse.issparse(X):
+        X = sparse.csc_matrix(X.to_numpy(dtype=float) if hasattr(X, 'to_numpy') else X)
+    X = sparse.csc_matrix(X, dtype=float)
+    X.eliminate_zeros()
+    return X
+
+
+def document_frequency(X):
+    """Number of rows with a non zero value, per column of a CSC matrix"""
+    import numpy as np
+    return np.diff(X.indptr)
+
+
+def column_variance(X):
+    import numpy as np
+    mean = np.asarray(X.mean(axis=0)).ravel()
+    mean_of_squares = np.asarray(X.multiply(X).mean(axis=0)).ravel()
+    return np.maximum(mean_of_squares - mean ** 2, 0.0)
+
+
+def presence_mutual_information(X, y):
+    """Mutual information (nats) between the presence of each column (value != 0) and the class y"""
+    import numpy as np
+    from scipy import sparse
+
+    n = X.shape[0]
+    classes, y_index = np.unique(np.asarray(y), return_inverse=True)
+    Y = sparse.csr_matrix((np.ones(n), (y_index, np.arange(n))), shape=(len(classes), n))
+    B = X.copy()
+    B.data = np.ones_like(B.data)
+
+    n_present = np.asarray((Y @ B).todense(), dtype=float)           # classes x features
+    n_class = np.asarray(Y.sum(axis=1), dtype=float)                 # classes x 1
+    n_absent = n_class - n_present
+    p_present = n_present.sum(axis=0) / n
+    p_class = n_class / n
+
+    mi = np.zeros(X.shape[1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for joint, marginal in ((n_present / n, p_present), (n_absent / n, 1 - p_present)):
+            terms = joint * np.log(joint / (p_class * marginal))
+            mi += np.nansum(np.where(joint > 0, terms, 0.0), axis=0)
+    return mi
+
+
+def class_scores(X, y, score='chi2'):
+    import numpy as np
+    if score == 'chi2':
+        from sklearn.feature_selection import chi2
+        scores = chi2(X, np.asarray(y))[0]
+    elif score == 'mutual_info':
+        scores = presence_mutual_information(X, y)
+    else:
+        raise ValueError("Unknown prefilter score: %s, expected one of %s" % (score, str(SCORES)))
+    return np.nan_to_num(scores, nan=0.0)
+
+
+def prefilter_features(X, y, feature_names, min_df=2, max_df=1.0, min_variance=0.0, score='chi2',
+                       max_features=None):
+    """Returns (kept feature names in their original order, {filter: number of features left})"""
+    import numpy as np
+
+    X = to_sparse(X)
+    n_rows = X.shape[0]
+    kept = np.ones(X.shape[1], dtype=bool)
+    counts = {'input': int(kept.sum())}
+
+    frequency = document_frequency(X)
+    kept &= (frequency >= min_df) & (frequency <= max_df * n_rows)
+    counts['document_frequency'] = int(kept.sum())
+
+    if min_variance is not None:
+        kept &= column_variance(X) > min_variance
+        counts['variance'] = int(kept.sum())
+
+    if score and max_features is not None and kept.sum() > max_features:
+        candidates = np.flatnonzero(kept)
+        scores = class_scores(X[:, candidates], y, score)
+        best = candidates[np.argsort(-scores, kind='stable')[:max_features]]
+        kept = np.zeros_like(kept)
+        kept[best] = True
+    counts[score or 'score'] = int(kept.sum())
+
+    feature_names = list(feature_names)
+    return [feature_names[i] for i in np.flatnonzero(kept)], counts
+
+
+def _fingerprint(X, columns, index, y, settings):
+    import numpy as np
+    digest = hashlib.sha1()
+    digest.update(repr(sorted(settings.items())).encode('utf-8'))
+    digest.update('\n'.join(map(str, columns)).encode('utf-8'))
+    digest.update('\n'.join(map(str, index)).encode('utf-8'))
+    digest.update(np.asarray(y).astype(float).tobytes())
+    # the values themselves (the stored non zeros of the CSC matrix), not a summary of them
+    X.sort_indices()
+    digest.update(repr(X.shape).encode('utf-8'))
+    for array in (X.indptr.astype(np.int64), X.indices.astype(np.int64), X.data.astype(float)):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def cached_prefilter(work_dir, task, X, y, rows=None, **settings):
+    """prefilter_features for a task's training DataFrame X (only its rows at the given positions if rows is not None,
+    taken on the sparse matrix), cached in work_dir/models/prefilter/<task>.json.
+    Returns (kept feature names, {filter: number of features left})"""
+    cache_file = Path(work_dir) / PREFILTER_DIR / (re.sub(r'[^\w.-]', '_', str(task)) + '.json')
+    matrix, index = to_sparse(X), X.index
+    if rows is not None:
+        matrix, index = to_sparse(matrix[rows]), index[rows]
+    fingerprint = _fingerprint(matrix, X.columns, index, y, settings)
+    if cache_file.exists():
+        cached = load_dict_json(cache_file)
+        if cached.get('fingerprint') == fingerprint:
+            return cached['features'], dict(cached['counts'], cached=True)
+
+    features, counts = prefilter_features(matrix, y, X.columns, **settings)
+    save_to_json({'fingerprint': fingerprint, 'settings': settings, 'counts': counts, 'features': features},
+                 cache_file)
+    return features, counts
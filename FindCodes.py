@@ -6,103 +6,154 @@
 Finds the Snomed and RxNorm codes in json format FHIR Resource bundle.  These should be automatically generated
 when running JsonBasedReader, so there should not be a need to run this.
 
-Requires manually changing the input/output directories.
-"""
-
+The bundles are streamed with JsonStream (any layout, pretty printed or minified, in constant memory) and every
+Coding with a Snomed-CT or RxNorm system is pulled out as a (system, code, text) triple, text being the text of the
+enclosing CodeableConcept or else the display of the Coding.  Files are scanned in parallel.
 
-from MLDataProcessing import save_to_json, log_settings
+Example:
+    python FindCodes.py <resource bundle dir> [save dir]
+"""
 
 
-def main(resource_bundle_dir):
-    from pathlib import Path
-    import operator
-    from collections import defaultdict
-
-    snomed_savefile = 'snomed_found.json'
-    rxnorm_savefile = 'rxcui_found.json'
-
-    rxnorm_count = defaultdict(int)
-    rxnorm_text = {}
-
-    snomed_count = defaultdict(int)
-    snomed_text = {}
-
-    print("Loading data from: " + resource_bundle_dir)
-    pathlist = Path(resource_bundle_dir).glob('*.json')
-    for path in pathlist:
-
-        with open(str(path), 'r', encoding='UTF-8') as fp:
-            line = fp.readline()
-            cnt = 1
-            while line:
-                line = line.strip()
-                if line == '"system": "http://www.nlm.nih.gov/research/umls/rxnorm",':
-                    line = fp.readline().strip()
-                    if line[0:9] == '"code": "':
-                        code = line[9:-1]
-                        rxnorm_count[code] += 1
-                        #try to get text
-                        for _ in range(3):
-                            line = fp.readline().strip()
-                            if line[0:6] == '"text"':
-                                text = line[9:-1]
-                                rxnorm_text[code] = text
-                                break
-                if line == '"system": "http://snomed.info/sct",':
-                    line = fp.readline().strip()
-                    if line[0:9] == '"code": "':
-                        code = line[9:-1]
-                        snomed_count[code] += 1
-                        #try to get text
-                        for _ in range(3):
-                            line = fp.readline().strip()
-                            if line[0:6] == '"text"':
-                                text = line[9:-1]
-                                snomed_text[code] = text
-                                break
-
-                line = fp.readline()
+import logging
+import operator
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
+from JsonStream import iter_json_events
+from MLDataProcessing import save_to_json, log_settings
 
+SNOMED_REFERENCE = 'http://snomed.info/sct'
+RXNORM_REFERENCE = 'http://www.nlm.nih.gov/research/umls/rxnorm'
+CODE_SYSTEMS = (SNOMED_REFERENCE, RXNORM_REFERENCE)
+
+_CODING_KEYS = ('system', 'code', 'display', 'text')
+
+
+def iter_codes(fp, systems=CODE_SYSTEMS):
+    """Yields (system, code, text) for each Coding of the given systems in a JSON document, in document order of
+    the enclosing CodeableConcepts."""
+    stack = []  # one frame per open container: dict for objects (key -> scalar, plus codings), None for arrays
+    for event, value in iter_json_events(fp):
+        if event == 'map_key':
+            stack[-1]['_key'] = value
+        elif event == 'start_map':
+            stack.append({'_key': None})
+        elif event == 'start_array':
+            stack.append(None)
+        elif event == 'end_array':
+            stack.pop()
+        elif event == 'end_map':
+            frame = stack.pop()
+            if frame.get('system') in systems and 'code' in frame:
+                # a Coding: keep it for the enclosing object (the CodeableConcept, which may have its text later)
+                parent = _enclosing_object(stack)
+                coding = (frame['system'], str(frame['code']), frame.get('display', ''))
+                if parent is None:
+                    yield coding
+                else:
+                    parent.setdefault('_codings', []).append(coding)
+            for system, code, display in frame.get('_codings', ()):
+                text = frame.get('text')
+                yield system, code, text if isinstance(text, str) and text else display
+        elif stack and stack[-1] is not None:  # scalar value in an object
+            key = stack[-1]['_key']
+            if key in _CODING_KEYS:
+                stack[-1][key] = value
+
+
+def _enclosing_object(stack):
+    for frame in reversed(stack):
+        if frame is not None:
+            return frame
+    return None
+
+
+def scan_file(path):
+    """Returns (snomed counts, snomed texts, rxnorm counts, rxnorm texts) for one bundle."""
+    snomed_count, rxnorm_count = Counter(), Counter()
+    snomed_text, rxnorm_text = {}, {}
+    with open(str(path), 'r', encoding='UTF-8') as fp:
+        for system, code, text in iter_codes(fp):
+            if system == SNOMED_REFERENCE:
+                count, texts = snomed_count, snomed_text
+            else:
+                count, texts = rxnorm_count, rxnorm_text
+            count[code] += 1
+            if text or code not in texts:
+                texts[code] = text if text else ''
+    return snomed_count, snomed_text, rxnorm_count, rxnorm_text
+
+
+def scan_directory(resource_bundle_dir, max_workers=None):
+    """Scans all bundles of a directory in parallel.
+
+    :return: (snomed counts, snomed descriptions, rxnorm counts, rxnorm descriptions), description is the last
+        non-empty text found for the code ('' if none)
+    """
+    paths = sorted(Path(resource_bundle_dir).glob('*.json'))
+    snomed_count, rxnorm_count = Counter(), Counter()
+    snomed_text, rxnorm_text = {}, {}
+
+    def merge(result):
+        sn_count, sn_text, rx_count, rx_text = result
+        snomed_count.update(sn_count)
+        rxnorm_count.update(rx_count)
+        for texts, new_texts in ((snomed_text, sn_text), (rxnorm_text, rx_text)):
+            for code, text in new_texts.items():
+                if text or code not in texts:
+                    texts[code] = text
+
+    if max_workers == 1 or len(paths) < 2:
+        for path in paths:
+            merge(scan_file(path))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for result in executor.map(scan_file, paths, chunksize=max(1, len(paths) // (8 * (os.cpu_count() or 1)))):
+                merge(result)
+    return snomed_count, snomed_text, rxnorm_count, rxnorm_text
+
+
+def main(resource_bundle_dir, save_dir='.', max_workers=None):
+    save_dir = Path(save_dir)
+    snomed_savefile = save_dir / 'snomed_found.json'
+    rxnorm_savefile = save_dir / 'rxcui_found.json'
+
+    print("Loading data from: " + str(resource_bundle_dir))
+    snomed_count, snomed_text, rxnorm_count, rxnorm_text = scan_directory(resource_bundle_dir,
+                                                                          max_workers=max_workers)
 
     rxnorm_count = sorted(rxnorm_count.items(), key=operator.itemgetter(1), reverse=True)
-
-    rxcui_description = {}
-    for key, _ in rxnorm_count:
-        rxcui_description[key]=rxnorm_text[key]
-
+    rxcui_description = {key: rxnorm_text.get(key, '') for key, _ in rxnorm_count}
 
     snomed_count = sorted(snomed_count.items(), key=operator.itemgetter(1), reverse=True)
-
-    snomed_description = {}
-    for key, _ in snomed_count:
-        snomed_description[key] = snomed_text[key]
-
+    snomed_description = {key: snomed_text.get(key, '') for key, _ in snomed_count}
 
     print("\nrx_norm_list:")
     print("rx Entries: ", len(rxnorm_count))
-    print(rxnorm_count)
-    print(rxcui_description)
+    logging.info(rxnorm_count)
     print("\nsnomed_list:")
     print("Snomed Entries: ", len(snomed_count))
-    print(snomed_count)
-    print(snomed_description)
+    logging.info(snomed_count)
 
     # save data
     save_to_json(snomed_description, snomed_savefile, indent=4)
     save_to_json(rxcui_description, rxnorm_savefile, indent=4)
 
+    file_ascii = save_dir / 'snomed_found.txt'
+    with open(file_ascii, 'w') as write_plain:
+        for key, value in snomed_description.items():
+            write_plain.write(str(key) + ': ' + str(value) + '\n')
 
-
-    file_ascii = 'snomed_found.txt'
-    write_plain = open(file_ascii, 'w')
-
-    for key, value in snomed_description.items():
-        str1 = str(key) + ': ' + str(value) + '\n'
-        write_plain.write(str1)
-    write_plain.close()
+    return snomed_description, rxcui_description
 
 
 if __name__ == '__main__':
+    import sys
     log_settings(filename ="FindCodes.log")
-    main(input("Enter Resource Bundle Dir: "))
\ No newline at end of file
+    if len(sys.argv) > 1:
+        main(sys.argv[1], *sys.argv[2:3])
+    else:
+        main(input("Enter Resource Bundle Dir: "))
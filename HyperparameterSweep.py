@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""HyperparameterSweep.py
+
+Hyperparameter search for the classifiers of RunClassification.set_up_classifier (dt, rf, lr, svm, gb, nb), run on
+every task of GOLD_multiclass.csv on a process pool.
+
+The sweep is described by a spec (JSON file or dict, missing keys take the values of DEFAULT_SPEC):
+    search        'grid' (every combination), 'random' (n_iter combinations per model) or 'halving' (successive
+                  halving of the random or grid candidates)
+    models        {model: {parameter: [values]}}, the values not listed are those of generate_default_ML_parameters
+    n_iter, seed  number of random candidates per model and random seed
+    cv            number of StratifiedKFold folds of the training reports
+    scoring       'f1_macro', 'f1_micro' or 'accuracy'
+    prune_margin  grid/random: after the first fold, candidates scoring more than prune_margin below the best
+                  candidate of the same task and model are not run on the other folds (None: no pruning)
+    eta, min_fraction  halving: the first rung trains on min_fraction of the training rows of each fold, each
+                  following rung keeps the best 1/eta candidates (per task and model) and trains on eta times more
+                  rows, the last rung uses all of them
+
+The feature matrix of the training reports (section_fm merged and normalized as in FeatureElimination: the cube root
+and min-max scale fitted on the training rows) and the folds of each task are built once and cached in
+work_dir/data/sweep/ (rebuilt when section_fm or the gold file change), the workers memory map them instead of
+receiving a copy with every job.
+
+Outputs (work_dir/data):
+    sweep_results.csv                          one row per task, model and candidate (score, folds, rung, status)
+    ML_model_settings/ML_sweep_settings.json   generate_default_ML_parameters() with the best candidate of each model
+                                               (see best_parameters), apply=True also writes ML_default_settings.json
+
+Example:
+    python HyperparameterSweep.py work/ --search halving --models dt rf --n-iter 20
+"""
+
+
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from MLDataProcessing import save_to_json, load_dict_json, log_settings, generate_default_ML_parameters
+
+SWEEP_DIR = Path('data') / 'sweep'
+RESULTS_FILE = Path('data') / 'sweep_results.csv'
+SWEEP_SETTINGS_FILE = Path('data') / 'ML_model_settings' / 'ML_sweep_settings.json'
+DEFAULT_SETTINGS_FILE = Path('data') / 'ML_model_settings' / 'ML_default_settings.json'
+
+DEFAULT_GRIDS = {
+    'dt': {'max_depth': [3, 6, 9, None], 'min_samples_leaf': [1, 2, 5],
+           'min_impurity_decrease': [0.0, 0.002, 0.006]},
+    'rf': {'n_estimators': [40, 80, 160], 'max_features': ['sqrt', 0.1],
+           'min_impurity_decrease': [0.0, 0.001, 0.005]},
+    'lr': {'C': [0.1, 1, 10, 100], 'solver': ['lbfgs']},
+    'svm': {'C': [1, 10, 100], 'kernel': ['linear', 'rbf']},
+    'gb': {'learning_rate': [0.025, 0.1], 'n_estimators': [50, 100], 'max_depth': [2, 3]},
+    'nb': {'alpha': [0.1, 0.5, 1.0]},
+}
+DEFAULT_SPEC = {'search': 'grid', 'models': None, 'n_iter': 10, 'seed': 0, 'cv': 3, 'scoring': 'f1_macro',
+                'prune_margin': 0.1, 'eta': 3, 'min_fraction': 0.25}
+SEARCHES = ('grid', 'random', 'halving')
+
+
+def load_spec(spec=None):
+    """spec: None, dict or path of a JSON file, returns the full spec"""
+    if spec is not None and not isinstance(spec, dict):
+        spec = load_dict_json(spec)
+    full = dict(DEFAULT_SPEC, **(spec or {}))
+    if full['search'] not in SEARCHES:
+        raise ValueError("Unknown search: %s, expected one of %s" % (full['search'], str(SEARCHES)))
+    if full['models'] is None:
+        full['models'] = DEFAULT_GRIDS
+    elif isinstance(full['models'], (list, tuple)):
+        full['models'] = {model: DEFAULT_GRIDS[model] for model in full['models']}
+    return full
+
+
+def candidates(spec):
+    """[(model, {parameter: value})] to evaluate, the parameters not in the grid are the default ones"""
+    defaults = generate_default_ML_parameters()
+    rng = random.Random(spec['seed'])
+    found = []
+    for model, grid in spec['models'].items():
+        names = sorted(grid)
+        combinations = [dict(zip(names, values)) for values in itertools.product(*(grid[n] for n in names))]
+        if spec['search'] == 'random' or (spec['search'] == 'halving' and spec['n_iter'] < len(combinations)):
+            combinations = rng.sample(combinations, min(spec['n_iter'], len(combinations)))
+        found += [(model, dict(defaults[model], **params)) for params in combinations]
+    return found
+
+
+def _cache_key(work_dir, spec):
+    from RunPipeline import fingerprint_path
+    return {'section_fm': fingerprint_path(work_dir / 'section_fm'),
+            'gold': fingerprint_path(work_dir / 'GOLD_multiclass.csv'), 'cv': spec['cv'], 'normalizer': 'train'}
+
+
+def prepare_data(work_dir, spec, set_of_classes=(0, 1, 2, 3)):
+    """Builds (or reuses) the cached feature matrix, classes and folds, returns the cache directory and the tasks"""
+    import numpy as np
+    import pandas as pd
+    from sklearn.model_selection import StratifiedKFold
+    from MLDataProcessing import combine_list_dfs, load_df, SplitIndex
+    from ModelRegistry import fit_normalizer, normalize
+
+    work_dir = Path(work_dir)
+    cache_dir = work_dir / SWEEP_DIR
+    key = _cache_key(work_dir, spec)
+    if (cache_dir / 'cache.json').exists():
+        cached = load_dict_json(cache_dir / 'cache.json')
+        if cached['key'] == key:
+            logging.info("Using cached sweep data: " + str(cache_dir))
+            return cache_dir, cached['tasks']
+
+    section_fms = [load_df(path) for path in sorted((work_dir / 'section_fm').glob('*.csv'))]
+    if not section_fms:
+        raise FileNotFoundError("No section feature matrices in " + str(work_dir / 'section_fm'))
+    merged = combine_list_dfs(section_fms)
+    features = [f for f in merged.columns if len(f) != 2]   # same features as FeatureElimination
+
+    gold = pd.read_csv(work_dir / 'GOLD_multiclass.csv', index_col=0).fillna(0)
+    split = SplitIndex(gold, merged.index, set_of_classes)
+    tasks = split.tasks
+
+    # training rows only, normalized with the scale fitted on them as in FeatureElimination
+    train = split.arrange(merged, features).iloc[:split.n_train]
+    scale = np.asarray(fit_normalizer(train))
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(cache_dir / 'fm.npy', normalize(train.to_numpy(dtype=np.float64), scale))
+    folds = {}
+    for n, task in enumerate(tasks):
+        rows = split.rows(task)[0]
+        y = split.classes[task].to_numpy()[rows].astype(int)
+        folds['rows_%d' % n] = rows
+        folds['y_%d' % n] = y
+        for fold, (train_index, valid_index) in enumerate(StratifiedKFold(n_splits=spec['cv']).split(rows, y)):
+            folds['train_%d_%d' % (n, fold)] = train_index
+            folds['valid_%d_%d' % (n, fold)] = valid_index
+    np.savez(cache_dir / 'folds.npz', **folds)
+    save_to_json({'key': key, 'tasks': tasks, 'features': features}, cache_dir / 'cache.json')
+    logging.info("Sweep data cached in %s: %d reports, %d features, %d tasks" % (cache_dir, train.shape[0],
+                                                                               train.shape[1], len(tasks)))
+    return cache_dir, tasks
+
+
+_worker_data = {}
+
+
+def _init_worker(cache_dir):
+    import numpy as np
+    _worker_data['X'] = np.load(Path(cache_dir) / 'fm.npy', mmap_mode='r')
+    _worker_data['folds'] = dict(np.load(Path(cache_dir) / 'folds.npz'))
+
+
+def _score(scoring, y_true, y_pred):
+    import numpy as np
+    if scoring == 'accuracy':
+        return float(np.mean(y_true == y_pred))
+    from CalculatePerformance import f1_score
+    return float(f1_score(y_true, y_pred, average=scoring.split('_')[1]))
+
+
+def evaluate(job):
+    """Worker: fits a candidate on a fold (a fraction of its training rows), returns the job with score and time"""
+    import numpy as np
+    from RunClassification import set_up_classifier
+
+    X, folds = _worker_data['X'], _worker_data['folds']
+    n, fold = job['task_index'], job['fold']
+    rows, y = folds['rows_%d' % n], folds['y_%d' % n]
+    train_index, valid_index = folds['train_%d_%d' % (n, fold)], folds['valid_%d_%d' % (n, fold)]
+    if job['fraction'] < 1:
+        order = np.random.RandomState(job['seed'] + fold).permutation(len(train_index))
+        train_index = np.sort(train_index[order[:max(2, int(job['fraction'] * len(train_index)))]])
+
+    start = time.perf_counter()
+    try:
+        clf = set_up_classifier(job['model'], 0, {job['model']: dict(job['params'])})
+        clf.fit(X[rows[train_index]], y[train_index])
+        score = _score(job['scoring'], y[valid_index], clf.predict(X[rows[valid_index]]))
+        error = None
+    except Exception as e:      # e.g. parameters not supported by the installed sklearn
+        score, error = float('nan'), '%s: %s' % (type(e).__name__, e)
+    return dict(job, score=score, seconds=time.perf_counter() - start, error=error)
+
+
+class Candidate():
+    def __init__(self, task, task_index, model, params):
+        self.task = task
+        self.task_index = task_index
+        self.model = model
+        self.params = params
+        self.scores = {}        # fold -> score at the current rung
+        self.seconds = 0.0
+        self.rung = 0
+        self.fraction = 1.0
+        self.status = 'running'
+
+    @property
+    def mean_score(self):
+        import numpy as np
+        scores = list(self.scores.values())
+        return float(np.mean(scores)) if scores else float('nan')
+
+    def row(self):
+        import numpy as np
+        return {'task': self.task, 'model': self.model, 'params': json.dumps(self.params, sort_keys=True),
+                'score': self.mean_score, 'score_std': float(np.std(list(self.scores.values()) or [np.nan])),
+                'folds': len(self.scores), 'rung': self.rung, 'fraction': self.fraction, 'status': self.status,
+                'fit_seconds': round(self.seconds, 4)}
+
+
+def _groups(found):
+    groups = {}
+    for candidate in found:
+        groups.setdefault((candidate.task, candidate.model), []).append(candidate)
+    return groups.values()
+
+
+def _run(executor, found, folds, fraction, spec):
+    jobs = [{'id': i, 'task_index': c.task_index, 'model': c.model, 'params': c.params, 'fold': fold,
+             'fraction': fraction, 'seed': spec['seed'], 'scoring': spec['scoring']}
+            for i, c in enumerate(found) for fold in folds]
+    for result in executor.map(evaluate, jobs, chunksize=max(1, len(jobs) // (4 * (os.cpu_count() or 1)))):
+        candidate = found[result['id']]
+        candidate.fraction = fraction
+        candidate.seconds += result['seconds']
+        if result['error'] is not None:
+            candidate.status = 'failed: ' + result['error']
+        elif not candidate.status.startswith('failed'):
+            candidate.scores[result['fold']] = result['score']
+    return [c for c in found if not c.status.startswith('failed')]
+
+
+def sweep(work_dir, spec=None, max_workers=None, apply=False):
+    """Runs the sweep described by spec, returns the results DataFrame (also saved to data/sweep_results.csv)"""
+    import pandas as pd
+
+    work_dir = Path(work_dir)
+    spec = load_spec(spec)
+    cache_dir, tasks = prepare_data(work_dir, spec)
+    found = [Candidate(task, n, model, params) for n, task in enumerate(tasks) for model, params in candidates(spec)]
+    all_folds = list(range(spec['cv']))
+    logging.info("sweep: %s search, %d candidates x %d tasks, %d folds" % (spec['search'], len(found) // len(tasks),
+                                                                         len(tasks), spec['cv']))
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(str(cache_dir),)) as executor:
+        if spec['search'] == 'halving':
+            n_rungs = max(1, math.ceil(math.log(max(len(g) for g in _groups(found)), spec['eta'])))
+            alive = found
+            for rung in range(n_rungs + 1):
+                fraction = min(1.0, spec['min_fraction'] * spec['eta'] ** rung) if rung < n_rungs else 1.0
+                for c in alive:
+                    c.rung, c.scores = rung, {}
+                alive = _run(executor, alive, all_folds, fraction, spec)
+                if rung == n_rungs:
+                    break
+                survivors = []
+                for group in _groups(alive):
+                    group.sort(key=lambda c: -c.mean_score)
+                    n_keep = max(1, math.ceil(len(group) / spec['eta']))
+                    survivors += group[:n_keep]
+                    for c in group[n_keep:]:
+                        c.status = 'pruned'
+                alive = survivors
+        else:
+            alive = _run(executor, found, all_folds[:1], 1.0, spec)
+            if spec['prune_margin'] is not None and spec['cv'] > 1:
+                for group in _groups(alive):
+                    best = max(c.mean_score for c in group)
+                    for c in group:
+                        if c.mean_score < best - spec['prune_margin']:
+                            c.status = 'pruned'
+                alive = [c for c in alive if c.status != 'pruned']
+            for c in alive:
+                c.rung = 1
+            alive = _run(executor, alive, all_folds[1:], 1.0, spec)
+    for c in alive:
+        c.status = 'complete'
+    logging.info("sweep done in %.1fs: %d complete, %d pruned, %d failed" % (
+        time.perf_counter() - start, len(alive), sum(c.status == 'pruned' for c in found),
+        sum(c.status.startswith('failed') for c in found)))
+
+    results = pd.DataFrame([c.row() for c in found]).sort_values(['task', 'model', 'score'],
+                                                                 ascending=[True, True, False])
+    results.to_csv(work_dir / RESULTS_FILE, index=False)
+    print("File saved: " + str(work_dir / RESULTS_FILE))
+    save_best_settings(work_dir, results, apply)
+    return results
+
+
+def best_parameters(results):
+    """{model: parameters} of the candidate complete on the most tasks (halving keeps different candidates per task),
+    then with the best mean score over these tasks"""
+    complete = results[results['status'] == 'complete']
+    best = {}
+    for model, rows in complete.groupby('model'):
+        by_params = rows.groupby('params')['score'].agg(['count', 'mean']).sort_values(['count', 'mean'])
+        best[model] = json.loads(by_params.index[-1])
+    return best
+
+
+def save_best_settings(work_dir, results, apply=False):
+    params = generate_default_ML_parameters()
+    best = best_parameters(results)
+    params.update(best)
+    for model, model_params in best.items():
+        logging.info("best %s: %s" % (model, str(model_params)))
+    save_to_json(params, Path(work_dir) / SWEEP_SETTINGS_FILE, indent=4)
+    if apply:
+        save_to_json(params, Path(work_dir) / DEFAULT_SETTINGS_FILE, indent=4)
+        logging.info("ML settings saved to: " + str(Path(work_dir) / DEFAULT_SETTINGS_FILE))
+    return params
+
+
+def main(work_dir=None, spec=None, max_workers=None, apply=False):
+    while work_dir is None or Path(work_dir).exists() is False:
+        print("Unable to locate directory.")
+        work_dir = input("Please enter working directory: ")
+    return sweep(work_dir, spec, max_workers, apply)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep over the classifiers and tasks")
+    parser.add_argument('work_dir')
+    parser.add_argument('--spec', help="JSON file with the sweep spec (see module docstring)")
+    parser.add_argument('--search', choices=SEARCHES)
+    parser.add_argument('--models', nargs='+', choices=sorted(DEFAULT_GRIDS), help="models to sweep (default grids)")
+    parser.add_argument('--n-iter', type=int)
+    parser.add_argument('--cv', type=int)
+    parser.add_argument('--scoring', choices=('f1_macro', 'f1_micro', 'accuracy'))
+    parser.add_argument('--max-workers', type=int)
+    parser.add_argument('--apply', action='store_true', help="also write the best settings to ML_default_settings.json")
+    args = parser.parse_args()
+
+    spec = load_dict_json(args.spec) if args.spec else {}
+    for name in ('search', 'models', 'n_iter', 'cv', 'scoring'):
+        if getattr(args, name) is not None:
+            spec[name] = getattr(args, name)
+
+    log_settings(filename="HyperparameterSweep.log")
+    main(args.work_dir, spec, args.max_workers, args.apply)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""ImportBudget.py
+
+Checks the start up cost of the pipeline modules.  Each module is imported in a fresh interpreter with
+'python -X importtime -c "import <module>"'; the cumulative import time of the module and the wall time of the whole
+process (interpreter start + import, the cost paid by every shard worker, ProcessPool worker or short CLI call) are
+compared to a budget.  The heavy packages (pandas, numpy, sklearn, requests, tkinter) pulled in at import are listed,
+they should only be imported by the functions using them.
+
+Exits with status 1 if a module is over budget, e.g. before merging:
+    python ImportBudget.py                         (worker modules, 200 ms)
+    python ImportBudget.py RunClassification --budget-ms 100 --verbose
+"""
+
+
+import os
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# modules started as separate processes or imported by them
+WORKER_MODULES = ('JsonBasedReader', 'AggregateReportsBySection', 'FindCodes', 'Sharding', 'CorpusPack', 'ReportTable',
+                  'JsonStream', 'SectionDetection', 'Instrumentation', 'MLDataProcessing', 'RxOntologyLookup',
+                  'SnomedOntologyLookup', 'OntologyStreaming', 'RunPipeline', 'RunClassification',
+                  'CalculatePerformance', 'FeatureElimination', 'ScoringService', 'RunAllGUI')
+HEAVY_PACKAGES = ('pandas', 'numpy', 'sklearn', 'scipy', 'requests', 'tkinter', 'joblib')
+BUDGET_MS = 200
+
+re_importtime = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)')
+
+
+def measure(module, repeat=3, python=sys.executable):
+    """Returns (wall ms, cumulative import ms of module, {heavy package: cumulative ms}, slowest direct imports) of
+    the fastest of repeat runs."""
+    here = str(Path(__file__).parent.resolve())
+    env = dict(os.environ, PYTHONPATH=here + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([python, '-X', 'importtime', '-c', 'import ' + module], cwd=here, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        wall = (time.perf_counter() - start) * 1000
+        if result.returncode != 0:
+            raise RuntimeError("import %s failed:\n%s" % (module, result.stderr[-2000:]))
+        if best is None or wall < best[0]:
+            best = (wall, result.stderr)
+
+    wall, log = best
+    module_ms = 0.0
+    heavy = {}
+    children = []       # imports one level down, listed before the module importing them
+    direct_imports = []
+    for self_us, cumulative_us, indent, name in re_importtime.findall(log):
+        cumulative = int(cumulative_us) / 1000
+        if name in HEAVY_PACKAGES:
+            heavy[name] = max(heavy.get(name, 0.0), cumulative)
+        if len(indent) == 3:
+            children.append((cumulative, name))
+        elif len(indent) == 1:
+            if name == module:
+                module_ms = cumulative
+                direct_imports = children
+            children = []
+    direct_imports.sort(reverse=True)
+    return wall, module_ms, heavy, direct_imports[:5]
+
+
+def check(modules=WORKER_MODULES, budget_ms=BUDGET_MS, repeat=3, verbose=False):
+    """Prints one line per module, returns the list of modules over budget."""
+    over = []
+    print('%-28s %9s %9s  %s' % ('module', 'wall ms', 'import ms', 'heavy packages loaded'))
+    for module in modules:
+        wall, module_ms, heavy, direct_imports = measure(module, repeat)
+        status = 'OVER' if wall > budget_ms else ''
+        heavy_text = ', '.join('%s %.0f ms' % item for item in sorted(heavy.items(), key=lambda x: -x[1]))
+        print('%-28s %9.1f %9.1f  %-40s %s' % (module, wall, module_ms, heavy_text or '-', status))
+        if verbose:
+            for cumulative, name in direct_imports:
+                print('%40s %9.1f ms' % (name, cumulative))
+        if wall > budget_ms:
+            over.append(module)
+    return over
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Check the import time of the pipeline modules")
+    parser.add_argument('modules', nargs='*', default=list(WORKER_MODULES))
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS, help="process start + import budget per module")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per module, the fastest is kept")
+    parser.add_argument('--verbose', action='store_true', help="also list the slowest imports of each module")
+    args = parser.parse_args()
+
+    over_budget = check(args.modules, args.budget_ms, args.repeat, args.verbose)
+    if over_budget:
+        print("Over the %.0f ms budget: %s" % (args.budget_ms, ', '.join(over_budget)))
+        sys.exit(1)
+    print("All modules within the %.0f ms budget" % args.budget_ms)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""IngredientClosure.py
+
+Ingredient closure of the RxCUIs: all the ingredients reachable from an rxcui through the ingredient lookups.
+
+A brand name drug resolves to a clinical drug, a multi ingredient drug to several ingredients, and an ingredient can
+resolve to its base ingredient (e.g. a salt); following the direct lookups of RxOntologyLookup until no new ingredient
+appears (fixed point) gives the complete set, in first found order.  The closure is stored as compact int arrays
+(CSR like: rxcui codes, row pointers and row indices of the ingredients), together with the direct lookups so that a
+rebuild only resolves the rxcuis that are new or whose lookups changed.
+
+Example:
+    closure = IngredientClosure.build(rxcui_to_ingredients, lookup=get_rxnorm_ingredients_batch,
+                                      previous=IngredientClosure.load(closure_file))
+    closure.save(closure_file)
+    closure['209387']      -> ('161', '1191')
+"""
+
+
+from pathlib import Path
+
+
+class IngredientClosure():
+    def __init__(self, codes, indptr, indices, direct_indptr, direct_indices):
+        import numpy as np
+        self.codes = np.asarray(codes, dtype=np.int64)                    # row -> rxcui
+        self.indptr = np.asarray(indptr, dtype=np.int64)                  # closure of row i: indices[indptr[i]:indptr[i+1]]
+        self.indices = np.asarray(indices, dtype=np.int32)                # rows of the ingredients
+        self.direct_indptr = np.asarray(direct_indptr, dtype=np.int64)    # direct lookups, same layout
+        self.direct_indices = np.asarray(direct_indices, dtype=np.int32)
+        self.rows = {code: row for row, code in enumerate(self.codes.tolist())}
+        self._names = {}
+        self.n_reused = 0
+        self.n_resolved = len(self.codes)
+
+    @staticmethod
+    def _as_code(rxcui):
+        try:
+            return int(rxcui)
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def build(cls, direct, lookup=None, previous=None):
+        """Resolves the closure of the rxcuis of direct ({rxcui: [ingredient rxcui]}) to a fixed point.
+
+        Ingredients without an entry in direct take their lookups from the previous closure, or from
+        lookup([rxcui]) -> {rxcui: [ingredient rxcui]} when given, called once per level of new ingredients (no further
+        lookups otherwise).  Closures of the previous build are reused when neither the rxcui nor any of its
+        ingredients changed its direct lookups.
+        """
+        graph = {}          # rxcui -> direct ingredient rxcuis
+        for rxcui, ingredients in direct.items():
+            code = cls._as_code(rxcui)
+            if code is None:
+                print("Ingredient closure: rxcui is not an integer, skipped:", rxcui)
+                continue
+            graph[code] = [c for c in map(cls._as_code, ingredients or ()) if c is not None]
+
+        previous_graph = previous.direct_lookups() if previous is not None else {}
+
+        # look up the ingredients not known yet, one batch per level until no new ingredient appears
+        new = [c for ingredients in graph.values() for c in ingredients]
+        while lookup is not None:
+            new = [c for c in dict.fromkeys(new) if c not in graph and c not in previous_graph]
+            if not new:
+                break
+            found = lookup([str(c) for c in new])
+            for code in new:
+                graph[code] = [c for c in map(cls._as_code, found.get(str(code)) or ()) if c is not None]
+            new = [c for code in new for c in graph[code]]
+
+        def edges(code):
+            if code not in graph:
+                graph[code] = previous_graph.get(code, [])
+            return graph[code]
+
+        # previous closures are valid if all the rxcuis they went through kept the same direct lookups
+        done = {}
+        if previous is not None:
+            changed = {code for code, ingredients in graph.items() if previous_graph.get(code) != ingredients}
+            for code in previous_graph:
+                if code in changed:
+                    continue
+                closure = previous.ingredient_codes(code)
+                if not changed.intersection(closure):
+                    done[code] = closure
+        n_reused = len(done)
+
+        pending = list(dict.fromkeys(list(graph) + list(previous_graph)))     # keeps the rxcuis of previous builds
+        while pending:
+            code = pending.pop()
+            if code in done:
+                continue
+            seen = {}
+            stack = list(reversed(edges(code)))
+            while stack:
+                ingredient = stack.pop()
+                if ingredient in seen:
+                    continue
+                seen[ingredient] = None
+                if ingredient in done:
+                    seen.update(dict.fromkeys(done[ingredient]))
+                else:
+                    stack.extend(reversed(edges(ingredient)))
+                    pending.append(ingredient)
+            done[code] = list(seen)
+
+        codes = list(done)
+        rows = {code: row for row, code in enumerate(codes)}
+        indptr, indices = [0], []
+        direct_indptr, direct_indices = [0], []
+        for code in codes:
+            indices.extend(rows[c] for c in done[code])
+            indptr.append(len(indices))
+            direct_indices.extend(rows[c] for c in edges(code) if c in rows)
+            direct_indptr.append(len(direct_indices))
+        closure = cls(codes, indptr, indices, direct_indptr, direct_indices)
+        closure.n_reused = n_reused
+        closure.n_resolved = len(codes) - n_reused
+        return closure
+
+    @classmethod
+    def load(cls, closure_file):
+        """Closure saved by save(), None if the file does not exist"""
+        closure_file = Path(closure_file)
+        if not closure_file.exists():
+            return None
+        import numpy as np
+        with np.load(closure_file) as arrays:
+            return cls(arrays['codes'], arrays['indptr'], arrays['indices'],
+                       arrays['direct_indptr'], arrays['direct_indices'])
+
+    def save(self, closure_file):
+        import numpy as np
+        closure_file = Path(closure_file)
+        closure_file.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(closure_file, codes=self.codes, indptr=self.indptr, indices=self.indices,
+                 direct_indptr=self.direct_indptr, direct_indices=self.direct_indices)
+
+    def direct_lookups(self):
+        """{rxcui code: [direct ingredient codes]} of the build"""
+        codes = self.codes.tolist()
+        indices = self.direct_indices.tolist()
+        indptr = self.direct_indptr.tolist()
+        return {code: [codes[i] for i in indices[indptr[row]:indptr[row + 1]]] for row, code in enumerate(codes)}
+
+    def ingredient_codes(self, rxcui):
+        """Ingredient rxcuis (int) of the closure of an rxcui, [] if not found"""
+        row = self.rows.get(self._as_code(rxcui))
+        if row is None:
+            return []
+        return self.codes[self.indices[self.indptr[row]:self.indptr[row + 1]]].tolist()
+
+    # dict like access used by the aggregation: rxcui (str) -> ingredient rxcuis (tuple of str)
+    def __contains__(self, rxcui):
+        return self._as_code(rxcui) in self.rows
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rxcui):
+        names = self._names.get(rxcui)
+        if names is None:
+            if rxcui not in self:
+                raise KeyError(rxcui)
+            names = self._names[rxcui] = tuple(str(code) for code in self.ingredient_codes(rxcui))
+        return names
+
+    def get(self, rxcui, default=None):
+        return self[rxcui] if rxcui in self else default
+
+    def keys(self):
+        return [str(code) for code in self.codes.tolist()]
+
+    def to_dict(self, rxcuis=None):
+        """{rxcui: [ingredients]} as saved in rxcui_ingredient.json, for the given rxcuis (all by default)"""
+        rxcuis = self.keys() if rxcuis is None else rxcuis
+        return {rxcui: list(self[rxcui]) for rxcui in rxcuis if rxcui in self}
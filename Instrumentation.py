@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Instrumentation.py
+
+Timers, counters and optional profiling shared by the pipeline stages.
+
+Each stage gets its metrics with get_metrics(stage), counts events with metrics.count('bundles') (or bytes_read,
+lookups, cache_hits/cache_misses...) and times blocks with `with metrics.timer('fit'):`.  At the end of a stage
+emit_metrics(stage, work_dir) writes one record with the counters, timers, rates (per second of stage time) and cache
+hit ratios, either as a JSON line appended to work_dir/data/metrics.jsonl or as Prometheus text in
+work_dir/data/metrics_<stage>.prom.
+
+Profiling is switched on per stage with the FHIR2ML_PROFILE environment variable (comma separated stage names or
+'all'), either around a block (`with profiled(stage):`) or a whole stage main (@profile_stage(stage)).
+FHIR2ML_PROFILE_MODE selects 'cprofile' (default, saves profile_<stage>.prof) or 'sampling' (samples the stack of the
+profiled thread every few ms, saves profile_<stage>.txt).  cProfile profiles one stage at a time: concurrent stages are
+sampled while it is in use.
+
+Environment variables:
+    FHIR2ML_METRICS_FORMAT   jsonl (default) or prometheus
+    FHIR2ML_PROFILE          stages to profile, e.g. json_reader,aggregate
+    FHIR2ML_PROFILE_MODE     cprofile or sampling
+    FHIR2ML_PROFILE_DIR      where profiles are saved (default: current directory)
+"""
+
+
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+METRICS_FILE = 'metrics.jsonl'
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+_cprofile_lock = threading.Lock()     # held while a cProfile profiler is enabled by profiled
+
+
+class StageMetrics():
+    def __init__(self, stage):
+        self.stage = stage
+        self.counters = defaultdict(float)
+        self.timers = defaultdict(float)
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.timers[name] += elapsed
+                self.counters[name + '_calls'] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timers = dict(self.timers)
+        elapsed = self.elapsed()
+
+        record = {'stage': self.stage, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'elapsed_s': elapsed,
+                  'counters': counters, 'timers_s': timers, 'rates_per_s': {}, 'ratios': {}}
+        for name, value in counters.items():
+            if not name.endswith('_calls') and elapsed > 0:
+                record['rates_per_s'][name] = value / elapsed
+        for name in counters:
+            if name.endswith('cache_hits'):
+                prefix = name[:-len('cache_hits')]
+                total = counters[name] + counters.get(prefix + 'cache_misses', 0)
+                if total > 0:
+                    record['ratios'][prefix + 'cache_hit_ratio'] = counters[name] / total
+        return record
+
+
+def get_metrics(stage):
+    with _metrics_lock:
+        if stage not in _metrics:
+            _metrics[stage] = StageMetrics(stage)
+        return _metrics[stage]
+
+
+def reset_metrics(stage):
+    with _metrics_lock:
+        _metrics[stage] = StageMetrics(stage)
+        return _metrics[stage]
+
+
+def emit_metrics(stage, work_dir=None, fmt=None):
+    """Writes the metrics of a stage (JSON line or Prometheus text) and logs a one line summary."""
+    record = get_metrics(stage).snapshot()
+    fmt = fmt or os.environ.get('FHIR2ML_METRICS_FORMAT', 'jsonl')
+    out_dir = Path(work_dir) / 'data' if work_dir is not None else Path('.')
+    os.makedirs(out_dir, exist_ok=True)
+
+    if fmt == 'prometheus':
+        with open(out_dir / ('metrics_' + stage + '.prom'), 'w') as fp:
+            fp.write(to_prometheus(record))
+    else:
+        with open(out_dir / METRICS_FILE, 'a') as fp:
+            fp.write(json.dumps(record) + '\n')
+
+    summary = ', '.join('%s=%.4g' % (k, v) for k, v in sorted(record['counters'].items()) if not k.endswith('_calls'))
+    logging.info("metrics %s: elapsed=%.2fs %s" % (stage, record['elapsed_s'], summary))
+    return record
+
+
+def to_prometheus(record):
+    stage = record['stage']
+    lines = []
+
+    def add(name, value, help_text, type_='gauge'):
+        metric = 'fhir2ml_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s %s' % (metric, type_))
+        lines.append('%s{stage="%s"} %s' % (metric, stage, repr(float(value))))
+
+    add('elapsed_seconds', record['elapsed_s'], 'Stage wall time')
+    for name, value in sorted(record['counters'].items()):
+        add(name + '_total', value, 'Counter ' + name, 'counter')
+    for name, value in sorted(record['timers_s'].items()):
+        add(name + '_seconds', value, 'Time spent in ' + name)
+    for name, value in sorted(record['rates_per_s'].items()):
+        add(name + '_per_second', value, 'Rate of ' + name)
+    for name, value in sorted(record['ratios'].items()):
+        add(name, value, 'Ratio ' + name)
+    return '\n'.join(lines) + '\n'
+
+
+def profiling_enabled(stage):
+    stages = os.environ.get('FHIR2ML_PROFILE', '')
+    stages = [s.strip() for s in stages.split(',') if s.strip()]
+    return 'all' in stages or stage in stages
+
+
+@contextmanager
+def profiled(stage, out_dir=None):
+    """Profiles the enclosed block if profiling is switched on for the stage (see FHIR2ML_PROFILE).
+
+    Only one cProfile profiler can be active in a process (Python 3.12+ raises ValueError on a second enable), so
+    stages run concurrently by RunPipeline take turns: a stage started while another one holds the cProfile profiler
+    is profiled with the SamplingProfiler instead.
+    """
+    if not profiling_enabled(stage):
+        yield
+        return
+
+    out_dir = Path(out_dir or os.environ.get('FHIR2ML_PROFILE_DIR', '.'))
+    os.makedirs(out_dir, exist_ok=True)
+    mode = os.environ.get('FHIR2ML_PROFILE_MODE', 'cprofile')
+
+    profile = None
+    if mode != 'sampling':
+        import cProfile
+        if _cprofile_lock.acquire(blocking=False):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:      # profiler enabled outside of profiled, e.g. python -m cProfile
+                profile = None
+                _cprofile_lock.release()
+        if profile is None:
+            logging.info("cProfile is already active, sampling stage " + stage + " instead")
+
+    if profile is None:
+        sampler = SamplingProfiler(threading.get_ident())
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            filename = out_dir / ('profile_' + stage + '.txt')
+            with open(filename, 'w') as fp:
+                fp.write(sampler.report())
+            logging.info("Sampling profile saved to: " + str(filename))
+    else:
+        import io
+        import pstats
+        try:
+            yield
+        finally:
+            profile.disable()
+            _cprofile_lock.release()
+            filename = out_dir / ('profile_' + stage + '.prof')
+            profile.dump_stats(str(filename))
+            stream = io.StringIO()
+            pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(20)
+            logging.info("Profile saved to: " + str(filename) + "\n" + stream.getvalue())
+
+
+def profile_stage(stage):
+    """Decorator profiling a whole stage function if profiling is switched on for the stage."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profiled(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler():
+    """Samples the stack of one thread at a fixed interval and counts the functions seen (self and cumulative)."""
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling_profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            self.self_counts[_frame_name(frame)] += 1
+            seen = set()
+            while frame is not None:
+                name = _frame_name(frame)
+                if name not in seen:
+                    self.total_counts[name] += 1
+                    seen.add(name)
+                frame = frame.f_back
+
+    def report(self, top=30):
+        lines = ['%d samples every %.1f ms' % (self.samples, self.interval * 1000), '', 'self:']
+        for name, n in self.self_counts.most_common(top):
+            lines.append('%6.2f%%  %s' % (100.0 * n / max(self.samples, 1), name))
+        lines += ['', 'cumulative:']
+        for name, n in self.total_counts.most_common(top):
+            lines.append('%6.2f%%  %s' % (100.0 * n / max(self.samples, 1), name))
+        return '\n'.join(lines) + '\n'
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s:%d(%s)' % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
@@ -16,6 +16,8 @@ Also saves the Snomed-CT and Rxcui codes found and shows a basic summary of resu
 
 This is set to only detect codes in defined types of resource content.  The addition or use of other types of content
 will require updating to determine the location of the main codes.
+
+The data directory can also be a corpus pack file made with CorpusPack.py (all bundles in one memory mapped file).
 """
 
 
@@ -30,7 +32,12 @@ from operator import itemgetter
 from pathlib import Path
 from statistics import mean
 
+from CorpusPack import CorpusPack, is_pack
+from Instrumentation import reset_metrics, emit_metrics, profile_stage
 from MLDataProcessing import save_to_json, load_dict_json, log_settings
+from ReportTable import ReportTableWriter, REPORT_TABLE_FILE, split_full_code
+from Sharding import parse_shard, shard_work_dir, in_shard, report_key, report_sort_key, READER_PARTIAL_FILE
+from SectionDetection import SectionSpanIndex, load_section_index
 
 LOINC_SECT_CODES = "\d{2,6}-\d"
 FHIR_RESOURCE_CODES = '[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
@@ -46,8 +53,23 @@ re_fhir_rsc = re.compile(FHIR_RESOURCE_CODES)
 
 INCL_ADDTL_CODES = True # Include additional associated codes (relating to main code) in a resource.
 
-
-def main(data_dir=None, work_dir=None):
+# extension urls containing one of these hold the position of a resource/section in the original note text
+OFFSET_EXTENSION_KEYWORDS = ('offset', 'position', 'span')
+
+
+@profile_stage('json_reader')
+def main(data_dir=None, work_dir=None, on_new_code=None, use_section_index=False, output_format='txt', shard=None,
+         pack_shard=None):
+    """on_new_code(code_system, code, text) is called the first time each Snomed-CT/RxNorm code is found
+    (used by OntologyStreaming to start the ontology lookups while the bundles are still being read).
+    use_section_index: sections without a valid Lion-C code are classified by their title using SectionDetection
+    instead of going to '00000-0'.
+    output_format: 'txt' writes output/REPORTn.txt per report, 'table' writes all reports to one ReportTable file
+    (output/report_codes.rtab)
+    shard: (i, N) or 'i/N', only read the bundles of hash partition i out of N and write the outputs to
+    work_dir/shards/i-of-N (merged with Sharding.reduce_reader)
+    pack_shard: (i, N) or 'i/N', data_dir being a corpus pack: only read the contiguous record range i out of N
+    (CorpusPack.shard, the other records are not visited), outputs as for shard"""
     while data_dir is None or Path(data_dir).exists() is False:
         print("Unable to locate directory.")
         data_dir = input("Please enter data directory (FHIR JSON Resource Bundle): ")
@@ -57,9 +79,20 @@ def main(data_dir=None, work_dir=None):
 
     data_dir = Path(data_dir)
     work_dir = Path(work_dir)
-    pathlist = Path(data_dir).glob('*.json')
+    shard = parse_shard(shard)
+    pack_shard = parse_shard(pack_shard)
+    if pack_shard is not None:
+        if shard is not None:
+            raise ValueError("shard and pack_shard can not be used together")
+        if not is_pack(data_dir):
+            raise ValueError("pack_shard needs a corpus pack, not a directory: " + str(data_dir))
+    partition = shard or pack_shard
+    if partition is not None:
+        work_dir = shard_work_dir(work_dir, partition)
+        os.makedirs(work_dir / 'data', exist_ok=True)
 
     log_settings(filename="json_based_reader.log", filemode='w')
+    metrics = reset_metrics('json_reader')
 
     os.makedirs(work_dir / "output", exist_ok=True)
     print("Trying to load data from: " + str(data_dir))
@@ -74,96 +107,69 @@ def main(data_dir=None, work_dir=None):
     sct_to_desc = {}
     rxcui_to_desc = {}
 
-    for path in pathlist:
-        path_in_str = str(path)
-        report = load_dict_json(path_in_str)
-
-        resource_to_section = {}
-        section_to_resource = defaultdict(list)
-        code_counts = defaultdict(int)
-        code_negation_counts = defaultdict(int)
-
-        lionc_words = defaultdict(int)
-        lionc_characters = defaultdict(int)
-        lionc_snomed_count = defaultdict(int)
-        lionc_rxnorm_count = defaultdict(int)
-
-        try:
-            sections_and_references = report['entry'][0]['resource']['section']
-        except KeyError:
-            resource_to_section = defaultdict(lambda: '00000:0')
-
-        # Read through first section defining Lion-C sections and references to uuid
-        for lionc in sections_and_references:
-            lionc_code = lionc['code']['coding'][0]['code']
-            if not re_loinc.match(lionc_code):
-                lionc_code = '00000-0'
-
-            lionc_text = lionc['text']['div']
-            word_char_count = text_word_counter(lionc_text)
-            lionc_words[lionc_code] += word_char_count[0]
-            lionc_characters[lionc_code] += word_char_count[1]
-
-            if 'entry' in lionc:
-                for item in lionc['entry']:  # references
-                    reference = re_fhir_rsc.findall(item['reference'])[0]
-                    resource_to_section[reference] = lionc_code
-                    section_to_resource[lionc_code].append(reference)
-
-        for i in range(1, len(report['entry'])):
-            try:
-                a_resource = report['entry'][i]['resource']
-                resource_type = a_resource['resourceType']
-                uuid = a_resource['id']
-            except Exception as e:
-                print(type(e))
-
-            # Add new resource types if necessary.  Code locations need to be manually defined.
-            try:
-                if resource_type == 'Condition':
-                    cct = ConditionEntry(a_resource)
-                elif resource_type == 'FamilyMemberHistory':
-                    cct = FamilyHistoryEntry(a_resource)
-                elif resource_type == 'Medication':
-                    cct = MedicationEntry(a_resource)
-                elif resource_type == 'MedicationStatement':
-                    cct = MedicationStatementEntry(a_resource)
-                elif resource_type == 'Procedure':
-                    cct = ProcedureEntry(a_resource)
-                else:
-                    print(resource_type, " was not included.")
-            except KeyError as err:
-                logging.info(err)
-                logging.info("code value (rxcui/sct) not found in file:" + path_in_str)
-                logging.info(str(a_resource))
-
-            # print(cct.return_codes())
-            section = find_section_for_uuid(cct.uuid, resource_to_section)
-            snomed_rxn_counts = cct.code_type_counts()
-            lionc_snomed_count[section] += snomed_rxn_counts[0]
-            lionc_rxnorm_count[section] += snomed_rxn_counts[1]
-
-            combined_section_with_code, negation_status = entry_to_codes(cct, resource_to_section, sct_to_desc=sct_to_desc,
-                                                        rxcui_to_desc=rxcui_to_desc, incl_addtl_codes=INCL_ADDTL_CODES)
-            for code in combined_section_with_code:
-                code_counts[code] += 1
-                if negation_status:
-                    code_negation_counts[code] += 1
-
+    section_index = None
+    if use_section_index:
+        section_index = load_section_index()
+    reattributed_count = 0  # resources placed in a section using their text offset
+
+    table_writer = None
+    if output_format == 'table':
+        table_writer = ReportTableWriter(work_dir / 'output' / REPORT_TABLE_FILE)
+
+    # sharded runs keep where sections and codes were first (and codes last) found, to merge the shards in order
+    lionc_first_report = {}
+    code_reports = {CodeSystem.SNOMED: {}, CodeSystem.RXNORM: {}} if partition is not None else None
+
+    select = None
+    if shard is not None:
+        select = (lambda name: in_shard(report_key(name), shard))
+
+    for file_name, n_bytes, report in iter_bundles(data_dir, select=select, pack_shard=pack_shard):
+        sort_key = report_sort_key(file_name)
+        path_in_str = str(data_dir / file_name)
+        metrics.count('bundles')
+        metrics.count('bytes_read', n_bytes)
+
+        bundle = read_bundle(report, path_in_str, sct_to_desc=sct_to_desc, rxcui_to_desc=rxcui_to_desc,
+                             on_new_code=on_new_code, section_index=section_index)
+        section_to_resource = bundle.section_to_resource
+        code_counts = bundle.code_counts
+        code_negation_counts = bundle.code_negation_counts
+        lionc_words = bundle.lionc_words
+        lionc_characters = bundle.lionc_characters
+        lionc_snomed_count = bundle.lionc_snomed_count
+        lionc_rxnorm_count = bundle.lionc_rxnorm_count
+        reattributed_count += bundle.reattributed
+        metrics.count('resources', bundle.resources)
+        metrics.count('codes', bundle.codes)
+        if code_reports is not None:
+            for cct in bundle.entries:
+                for full_code in cct.return_codes(incl_addtl_codes=INCL_ADDTL_CODES):
+                    if full_code.code != '0' and full_code.code_system in code_reports:
+                        code_reports[full_code.code_system].setdefault(full_code.code, [sort_key, sort_key])[1] = sort_key
 
         for lionc in section_to_resource:
             # save to results for all records
+            lionc_first_report.setdefault(lionc, sort_key)
             lionc_words_record[lionc].append(lionc_words[lionc])
             lionc_characters_record[lionc].append(lionc_characters[lionc])
             lionc_snomed_count_record[lionc].append(lionc_snomed_count[lionc])
             lionc_rxnorm_count_record[lionc].append(lionc_rxnorm_count[lionc])
 
-        code_counts = OrderedDict(sorted(code_counts.items(), key=itemgetter(1), reverse=True))
+        code_counts = bundle.sorted_code_counts()
 
-        # output file (csv format with original file name)
-        file_name = path.stem
+        # output (original file name, csv format or report table)
         if file_name.find('.')> 0:
             file_name = file_name[:(file_name.find('.'))]
+        if table_writer is not None:
+            report_id = re.findall(r"\d+$", file_name)
+            if not report_id:
+                logging.warning("No report number in file name, not saved to report table: " + path_in_str)
+                continue
+            table_writer.add_report(int(report_id[0]), ((*split_full_code(k), v, code_negation_counts[k])
+                                                        for k, v in code_counts.items()))
+            continue
+
         output_path = work_dir / 'output' / (file_name + '.txt')
         with open(output_path, 'w') as output:
             output.write("code,count,negation\n")
@@ -172,12 +178,46 @@ def main(data_dir=None, work_dir=None):
                 output.write(text)
 
     # after all records processed
-    with open(work_dir/'data'/'RB_Section_Summary.txt','w') as fp:
+    if table_writer is not None:
+        table_writer.close()
+        logging.info("Report table saved: %d rows, %d codes" % (table_writer.n_rows, len(table_writer.codes)))
+    section_records = {'words': lionc_words_record, 'chars': lionc_characters_record,
+                       'snomed': lionc_snomed_count_record, 'rxnorm': lionc_rxnorm_count_record}
+    save_section_summary(work_dir/'data'/'RB_Section_Summary.txt', section_records)
+
+
+    if reattributed_count:
+        logging.info("Resources assigned to a section by text offset: " + str(reattributed_count))
+    metrics.count('resources_reattributed', reattributed_count)
+
+    # save found terms
+    save_to_json(sct_to_desc, work_dir/'data'/'snomed_found.json', indent=4)
+    save_to_json(rxcui_to_desc, work_dir/'data'/'rxcui_found.json', indent=4)
+    metrics.count('snomed_codes_found', len(sct_to_desc))
+    metrics.count('rxcui_found', len(rxcui_to_desc))
+
+    if partition is not None:
+        partial = {'sections': {}, 'codes': {'snomed': code_reports[CodeSystem.SNOMED],
+                                             'rxnorm': code_reports[CodeSystem.RXNORM]}}
         for lionc in lionc_snomed_count_record:
-            words = lionc_words_record[lionc]
-            chars = lionc_characters_record[lionc]
-            scts = lionc_snomed_count_record[lionc]
-            rxnorms = lionc_rxnorm_count_record[lionc]
+            partial['sections'][lionc] = {'first': lionc_first_report[lionc]}
+            for name in SECTION_STATISTICS:
+                partial['sections'][lionc][name] = section_records[name][lionc]
+        save_to_json(partial, work_dir/'data'/READER_PARTIAL_FILE)
+    emit_metrics('json_reader', work_dir)
+
+
+# per section statistics of RB_Section_Summary.txt (a list of per report values for each section)
+SECTION_STATISTICS = ('words', 'chars', 'snomed', 'rxnorm')
+
+
+def save_section_summary(filename, section_records):
+    with open(filename, 'w') as fp:
+        for lionc in section_records['snomed']:
+            words = section_records['words'][lionc]
+            chars = section_records['chars'][lionc]
+            scts = section_records['snomed'][lionc]
+            rxnorms = section_records['rxnorm'][lionc]
             line1 = "%10s" * 5 % (str(lionc), 'words', 'chars', '#snomed', '#rxnorm')
             line2 = ("%10s" + "%10.3f" * 4) % ('', mean(words), mean(chars), mean(scts), mean(rxnorms))
             print(line1)
@@ -186,9 +226,143 @@ def main(data_dir=None, work_dir=None):
             fp.write(line2 +'\n')
 
 
-    # save found terms
-    save_to_json(sct_to_desc, work_dir/'data'/'snomed_found.json', indent=4)
-    save_to_json(rxcui_to_desc, work_dir/'data'/'rxcui_found.json', indent=4)
+class BundleCodes():
+    """Codes found in one bundle by read_bundle: counts and negation counts per full code ('<section>_[F-]<code>'),
+    the resources of each section and the per section statistics of RB_Section_Summary.txt."""
+    def __init__(self):
+        self.resource_to_section = {}
+        self.section_to_resource = defaultdict(list)
+        self.code_counts = defaultdict(int)
+        self.code_negation_counts = defaultdict(int)
+        self.lionc_words = defaultdict(int)
+        self.lionc_characters = defaultdict(int)
+        self.lionc_snomed_count = defaultdict(int)
+        self.lionc_rxnorm_count = defaultdict(int)
+        self.entries = []        # BasicEntry of each resource read
+        self.resources = 0
+        self.codes = 0
+        self.reattributed = 0    # resources assigned to a section using their text offset
+
+    def sorted_code_counts(self):
+        return OrderedDict(sorted(self.code_counts.items(), key=itemgetter(1), reverse=True))
+
+    def rows(self):
+        """(section, code, family flag, count, negation count) rows, as read back by AggregateReportsBySection"""
+        rows = []
+        for full_code, count in self.sorted_code_counts().items():
+            section, family, code = split_full_code(full_code)
+            rows.append((section, code, family, count, self.code_negation_counts[full_code]))
+        return rows
+
+
+def read_bundle(report, path_in_str='', sct_to_desc=None, rxcui_to_desc=None, on_new_code=None, section_index=None):
+    """Finds the codes of one FHIR bundle (a loaded json dict), returns a BundleCodes.  The Snomed-CT/RxNorm codes
+    found are added to sct_to_desc/rxcui_to_desc."""
+    bundle = BundleCodes()
+    resource_to_section = bundle.resource_to_section
+    section_to_resource = bundle.section_to_resource
+    code_counts = bundle.code_counts
+    code_negation_counts = bundle.code_negation_counts
+    lionc_snomed_count = bundle.lionc_snomed_count
+    lionc_rxnorm_count = bundle.lionc_rxnorm_count
+    if sct_to_desc is None:
+        sct_to_desc = {}
+    if rxcui_to_desc is None:
+        rxcui_to_desc = {}
+
+    try:
+        sections_and_references = report['entry'][0]['resource']['section']
+    except (KeyError, IndexError):
+        sections_and_references = []    # no composition sections, all resources will be '00000-0'
+
+    # text spans of the sections, used to place resources that are not referenced by a section
+    section_spans = section_spans_for_bundle(sections_and_references, section_index)
+
+    # Read through first section defining Lion-C sections and references to uuid
+    for lionc in sections_and_references:
+        lionc_code = find_section_code(lionc, section_index)
+
+        lionc_text = lionc.get('text', {}).get('div', '')
+        word_char_count = text_word_counter(lionc_text)
+        bundle.lionc_words[lionc_code] += word_char_count[0]
+        bundle.lionc_characters[lionc_code] += word_char_count[1]
+
+        if 'entry' in lionc:
+            for item in lionc['entry']:  # references
+                reference = re_fhir_rsc.findall(item['reference'])[0]
+                resource_to_section[reference] = lionc_code
+                section_to_resource[lionc_code].append(reference)
+
+    for i in range(1, len(report['entry'])):
+        try:
+            a_resource = report['entry'][i]['resource']
+            resource_type = a_resource['resourceType']
+            uuid = a_resource['id']
+        except Exception as e:
+            print(type(e))
+
+        # Add new resource types if necessary.  Code locations need to be manually defined.
+        try:
+            if resource_type == 'Condition':
+                cct = ConditionEntry(a_resource)
+            elif resource_type == 'FamilyMemberHistory':
+                cct = FamilyHistoryEntry(a_resource)
+            elif resource_type == 'Medication':
+                cct = MedicationEntry(a_resource)
+            elif resource_type == 'MedicationStatement':
+                cct = MedicationStatementEntry(a_resource)
+            elif resource_type == 'Procedure':
+                cct = ProcedureEntry(a_resource)
+            else:
+                print(resource_type, " was not included.")
+                continue
+        except KeyError as err:
+            logging.info(err)
+            logging.info("code value (rxcui/sct) not found in file:" + path_in_str)
+            logging.info(str(a_resource))
+            continue
+
+        if cct.uuid not in resource_to_section and section_spans:
+            offset = find_text_offset(a_resource)
+            if offset is not None:
+                span_section = section_spans.find(offset[0])
+                if span_section is not None:
+                    resource_to_section[cct.uuid] = span_section
+                    section_to_resource[span_section].append(cct.uuid)
+                    bundle.reattributed += 1
+
+        bundle.resources += 1
+        bundle.entries.append(cct)
+        # print(cct.return_codes())
+        section = find_section_for_uuid(cct.uuid, resource_to_section)
+        snomed_rxn_counts = cct.code_type_counts()
+        lionc_snomed_count[section] += snomed_rxn_counts[0]
+        lionc_rxnorm_count[section] += snomed_rxn_counts[1]
+
+        combined_section_with_code, negation_status = entry_to_codes(cct, resource_to_section, sct_to_desc=sct_to_desc,
+                                                                     rxcui_to_desc=rxcui_to_desc,
+                                                                     incl_addtl_codes=INCL_ADDTL_CODES,
+                                                                     on_new_code=on_new_code)
+        bundle.codes += len(combined_section_with_code)
+        for code in combined_section_with_code:
+            code_counts[code] += 1
+            if negation_status:
+                code_negation_counts[code] += 1
+    return bundle
+
+
+def iter_bundles(data_dir, select=None, pack_shard=None):
+    """Yields (file name stem, size in bytes, bundle) for each bundle of a data directory or of a corpus pack file
+    (see CorpusPack), in report number order.  pack_shard=(i, N) reads only the contiguous record range i of N of a
+    pack (CorpusPack.shard), select(file name stem) filters the bundles before they are loaded."""
+    if is_pack(data_dir):
+        with CorpusPack(data_dir) as pack:
+            start, stop = pack.shard(*pack_shard) if pack_shard is not None else (0, len(pack))
+            yield from pack.iter_records(start, stop, select)
+    else:
+        for path in sorted(Path(data_dir).glob('*.json'), key=lambda p: report_sort_key(p.stem)):
+            if select is None or select(path.stem):
+                yield path.stem, path.stat().st_size, load_dict_json(str(path))
 
 
 def find_full_codes(var, skip_key=None):
@@ -329,8 +503,9 @@ class ProcedureEntry(BasicEntry):
     #
     # Also add to a list of codes if given a dictionary to keep track of the codes.
     # the list of codes from the dictionary can be later used for searching through ontologies
+    # on_new_code(code_system, code, text) is called for codes not yet in the dictionary
 def entry_to_codes(entry: BasicEntry, uuid_to_section={}, incl_code_type=False, sct_to_desc=None,
-                   rxcui_to_desc=None, incl_addtl_codes = True) -> (list, bool):
+                   rxcui_to_desc=None, incl_addtl_codes = True, on_new_code=None) -> (list, bool):
     negation = entry.negation_status
     #uncertainty = entry.uncertainty_status
     code_list = []
@@ -346,10 +521,14 @@ def entry_to_codes(entry: BasicEntry, uuid_to_section={}, incl_code_type=False,
         if full_code.code_system == CodeSystem.SNOMED:
             type_ = 'F-' * is_family_history + 'sct_' * incl_code_type
             if sct_to_desc is not None:
+                if on_new_code is not None and code not in sct_to_desc:
+                    on_new_code(CodeSystem.SNOMED, code, full_code.code_text)
                 sct_to_desc[code] = full_code.code_text
         elif full_code.code_system == CodeSystem.RXNORM:
             type_ = 'F-' * is_family_history + 'rxn_' * incl_code_type
             if rxcui_to_desc is not None:
+                if on_new_code is not None and code not in rxcui_to_desc:
+                    on_new_code(CodeSystem.RXNORM, code, full_code.code_text)
                 rxcui_to_desc[code] = full_code.code_text
         else:
             # do not add other codes
@@ -361,6 +540,81 @@ def entry_to_codes(entry: BasicEntry, uuid_to_section={}, incl_code_type=False,
     return code_list, negation
 
 
+# Lion-C code of a Composition section.  If the section has no valid code and a SectionIndex is given, the section
+# title (or the start of its text) is looked up in the section index before defaulting to '00000-0'
+def find_section_code(section, section_index=None):
+    try:
+        code = section['code']['coding'][0]['code']
+    except (KeyError, IndexError):
+        code = ''
+    if re_loinc.match(code):
+        return code
+
+    if section_index is not None:
+        if 'title' in section:
+            title = section['title']
+        elif 'text' in section and 'div' in section['text']:
+            title, _ = clean_div(section['text']['div'])
+        else:
+            title = ''
+        code = section_index.classify(title)
+        if code is not None and re_loinc.match(code):
+            return code
+    return '00000-0'
+
+
+# Text position of a resource or section as (begin, end), None if not found.
+# Looks for an extension whose url contains one of OFFSET_EXTENSION_KEYWORDS, holding either valueInteger,
+# valueRange (low/high), valueString ('begin-end', 'begin,end' or 'begin') or begin/end sub-extensions.
+def find_text_offset(FHIR_element):
+    for extension in FHIR_element.get('extension', []):
+        url = str(extension.get('url', '')).lower()
+        if not any(keyword in url for keyword in OFFSET_EXTENSION_KEYWORDS):
+            continue
+        try:
+            if 'valueInteger' in extension:
+                return int(extension['valueInteger']), int(extension['valueInteger'])
+            if 'valueRange' in extension:
+                low = int(extension['valueRange']['low']['value'])
+                high = int(extension['valueRange'].get('high', {}).get('value', low))
+                return low, high
+            if 'valueString' in extension:
+                values = [int(x) for x in re.findall(r'\d+', extension['valueString'])]
+                if values:
+                    return values[0], values[-1]
+            if 'extension' in extension:
+                begin, end = None, None
+                for sub_extension in extension['extension']:
+                    sub_url = str(sub_extension.get('url', '')).lower()
+                    if 'valueInteger' not in sub_extension:
+                        continue
+                    if 'begin' in sub_url or 'start' in sub_url:
+                        begin = int(sub_extension['valueInteger'])
+                    elif 'end' in sub_url:
+                        end = int(sub_extension['valueInteger'])
+                if begin is not None:
+                    return begin, end if end is not None else begin
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+# Builds a SectionSpanIndex for the sections of a bundle from the text offsets of the sections (the offsets of the
+# resources, find_text_offset, are in the same note text).  Sections without offsets are not placed: headers found in
+# the narrative XHTML of the Composition would give positions in that markup, not in the note text.
+# Returns None if no spans can be found.
+def section_spans_for_bundle(sections_and_references, section_index=None):
+    spans = []
+    for lionc in sections_and_references:
+        offset = find_text_offset(lionc)
+        if offset is not None and offset[1] > offset[0]:
+            spans.append((offset[0], offset[1], find_section_code(lionc, section_index)))
+
+    if not spans:
+        return None
+    return SectionSpanIndex(spans)
+
+
 def find_section_for_uuid(uuid, uuid_to_section={}):
     if uuid in uuid_to_section:
         section = uuid_to_section[uuid]
@@ -416,4 +670,14 @@ class CodeSystem(Enum):
 
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description="Read FHIR JSON Resource Bundles into per report code counts")
+    parser.add_argument('data_dir', nargs='?', help="bundle directory or corpus pack file")
+    parser.add_argument('work_dir', nargs='?')
+    parser.add_argument('--shard', help="i/N: only read hash partition i of N (see Sharding.py)")
+    parser.add_argument('--pack-shard', help="i/N: only read the contiguous record range i of N of a corpus pack")
+    parser.add_argument('--report-table', action='store_true', help="write a single report table")
+    parser.add_argument('--section-index', action='store_true')
+    args = parser.parse_args()
+    main(args.data_dir, args.work_dir, use_section_index=args.section_index,
+         output_format='table' if args.report_table else 'txt', shard=args.shard, pack_shard=args.pack_shard)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""JsonStream.py
+
+Incremental JSON event tokenizer, used to scan large or minified FHIR bundles without loading whole documents.
+
+iter_json_events(fp) reads the file in fixed size chunks and yields (event, value) pairs:
+
+    ('start_map', None) ('end_map', None) ('start_array', None) ('end_array', None)
+    ('map_key', key) ('string', text) ('number', int/float) ('boolean', bool) ('null', None)
+
+Only the unread part of the current chunk and the stack of open containers are kept, so memory does not grow with
+the size of the document (it is bounded by the chunk size plus the largest single string).  The tokenizer does not
+fully validate the JSON, it only raises ValueError on input it cannot tokenize.
+"""
+
+
+import json
+import re
+
+CHUNK_SIZE = 1 << 16
+
+re_json_token = re.compile(r'[ \t\r\n]*(?:([{}\[\]:,])|"((?:[^"\\]|\\.)*)"|(-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?)'
+                           r'|(true|false|null))')
+re_whitespace = re.compile(r'[ \t\r\n]*')
+re_number_tail = re.compile(r'[0-9.eE+-]*')
+
+_LITERALS = {'true': True, 'false': False, 'null': None}
+
+
+def _decode_string(raw):
+    if '\\' in raw:
+        return json.loads('"' + raw + '"')
+    return raw
+
+
+def _decode_number(raw):
+    if '.' in raw or 'e' in raw or 'E' in raw:
+        return float(raw)
+    return int(raw)
+
+
+def iter_json_events(fp, chunk_size=CHUNK_SIZE):
+    """Yields (event, value) for a JSON document read from a text file object."""
+    buf = ''
+    pos = 0
+    eof = False
+    stack = []          # True for an object, False for an array
+    expect_key = False  # next string in the current object is a key
+
+    while True:
+        match = re_json_token.match(buf, pos)
+        # a token near the end of the buffer may be cut short (numbers, literals), or not matched at all (strings
+        # without their closing quote): read on before deciding
+        if not eof and (match is None or match.end() == len(buf) or
+                        (match.group(3) is not None and re_number_tail.fullmatch(buf, match.end()))):
+            chunk = fp.read(chunk_size)
+            if chunk:
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            eof = True
+            continue
+
+        if match is None:
+            if re_whitespace.match(buf, pos).end() == len(buf):
+                if stack:
+                    raise ValueError("Unexpected end of JSON document")
+                return
+            raise ValueError("Invalid JSON at: " + repr(buf[pos:pos + 40]))
+        pos = match.end()
+
+        structural, string, number, literal = match.groups()
+        if structural is not None:
+            if structural == '{':
+                stack.append(True)
+                expect_key = True
+                yield 'start_map', None
+            elif structural == '[':
+                stack.append(False)
+                expect_key = False
+                yield 'start_array', None
+            elif structural in '}]':
+                if not stack:
+                    raise ValueError("Unbalanced '" + structural + "' in JSON document")
+                stack.pop()
+                expect_key = False
+                yield ('end_map' if structural == '}' else 'end_array'), None
+            elif structural == ',':
+                expect_key = bool(stack) and stack[-1]
+            # ':' needs no event, the key was already emitted
+        elif string is not None:
+            if expect_key:
+                expect_key = False
+                yield 'map_key', _decode_string(string)
+            else:
+                yield 'string', _decode_string(string)
+        elif number is not None:
+            yield 'number', _decode_number(number)
+        else:
+            value = _LITERALS[literal]
+            yield ('null' if value is None else 'boolean'), value
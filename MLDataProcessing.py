@@ -14,8 +14,9 @@ import logging
 from pathlib import Path
 
 from collections import Counter
-from numpy import isnan
-import pandas as pd
+
+# pandas/numpy are imported by the functions using them: most scripts only need the json/logging helpers and
+# should not pay for importing pandas at start up (see ImportBudget.py)
 
 
 ML_settings_location = None
@@ -23,6 +24,7 @@ lionc_to_description = {'00000-0':'Unknown', '10155-0':'Allergies', '10157-6':'F
 
 
 def rearrange_for_testing(fm, gold, task = None, set_of_classes = None):
+    import pandas as pd
     features = fm.columns
     full = pd.concat([fm, gold], axis=1)
     train, test = full[full['train'] == 1], full[full['test'] == 1]
@@ -32,6 +34,89 @@ def rearrange_for_testing(fm, gold, task = None, set_of_classes = None):
     return train, test, features
 
 
+class SplitIndex():
+    """Train/test rows of the gold table and per task valid class masks, computed once.
+
+    Replaces calling rearrange_for_testing (concat of the feature matrix and gold, then boolean filters) for every
+    task: arrange() copies the feature matrix once (only the columns used), as a single block with its train rows
+    first and its test rows after.  split_rows() hands out the train and test row slices of that block (views, no
+    copy) with the positions of the valid rows of the task (None when all rows are valid), so only the rows and
+    columns actually used are taken (take()).  split() returns the frames directly: views for the tasks whose classes
+    are all in set_of_classes, a copy of the valid rows for the others.  Rows are in the same order as with
+    rearrange_for_testing.
+
+    Example:
+        split = SplitIndex(gold, fm.index, set_of_classes)
+        data = split.arrange(fm)
+        train_X, train_y, test_X, test_y = split.split(data, task)
+        train, train_rows, train_y, test, test_rows, test_y = split.split_rows(data, task)
+        train_X = SplitIndex.take(train, train_rows, features)
+    """
+    def __init__(self, gold, index, set_of_classes=None):
+        import numpy as np
+        gold = gold.reindex(index)
+        self.train_rows = np.flatnonzero((gold['train'] == 1).to_numpy())
+        self.test_rows = np.flatnonzero((gold['test'] == 1).to_numpy())
+        self.n_train = len(self.train_rows)
+        self.order = np.concatenate([self.train_rows, self.test_rows])
+        self.tasks = [x for x in gold if x not in ['test', 'train']]
+        self.classes = {task: gold[task].iloc[self.order] for task in self.tasks}
+        self.valid = {}     # task -> boolean mask over the arranged rows, None if all rows are valid
+        for task in self.tasks:
+            mask = self.classes[task].isin(set_of_classes).to_numpy() if set_of_classes is not None else None
+            self.valid[task] = None if mask is None or mask.all() else mask
+
+    def arrange(self, fm, columns=None):
+        """Feature matrix (only columns if given) with the train rows then the test rows, as a single block (the only
+        full copy made)"""
+        import numpy as np
+        import pandas as pd
+        if columns is None:
+            return pd.DataFrame(fm.to_numpy()[self.order], index=fm.index[self.order], columns=fm.columns, copy=False)
+        columns = pd.Index(columns)
+        values = fm.to_numpy()[np.ix_(self.order, fm.columns.get_indexer(columns))]
+        return pd.DataFrame(values, index=fm.index[self.order], columns=columns, copy=False)
+
+    def rows(self, task):
+        """(train, test) positions of the valid rows of a task in the arranged matrix"""
+        import numpy as np
+        mask = self.valid[task]
+        if mask is None:
+            return np.arange(self.n_train), np.arange(self.n_train, len(self.order))
+        return np.flatnonzero(mask[:self.n_train]), self.n_train + np.flatnonzero(mask[self.n_train:])
+
+    def split_rows(self, data, task):
+        """(train block, train rows, train classes, test block, test rows, test classes) of a task: the blocks are
+        row slices of data (views), the rows the positions of the valid rows in them (None if all are valid) and the
+        classes those of the valid rows"""
+        import numpy as np
+        y = self.classes[task]
+        train, test = data.iloc[:self.n_train], data.iloc[self.n_train:]
+        mask = self.valid[task]
+        if mask is None:
+            return train, None, y.iloc[:self.n_train], test, None, y.iloc[self.n_train:]
+        train_rows, test_rows = np.flatnonzero(mask[:self.n_train]), np.flatnonzero(mask[self.n_train:])
+        return (train, train_rows, y.iloc[:self.n_train].iloc[train_rows],
+                test, test_rows, y.iloc[self.n_train:].iloc[test_rows])
+
+    @staticmethod
+    def take(block, rows=None, columns=None):
+        """block itself if rows and columns are None, else the given rows of the given columns in a single copy"""
+        import numpy as np
+        import pandas as pd
+        if rows is None and columns is None:
+            return block
+        columns = block.columns if columns is None else pd.Index(columns)
+        rows = np.arange(len(block)) if rows is None else rows
+        values = block.to_numpy()[np.ix_(rows, block.columns.get_indexer(columns))]
+        return pd.DataFrame(values, index=block.index[rows], columns=columns, copy=False)
+
+    def split(self, data, task):
+        """(train features, train classes, test features, test classes) of a task, data as returned by arrange"""
+        train, train_rows, train_y, test, test_rows, test_y = self.split_rows(data, task)
+        return self.take(train, train_rows), train_y, self.take(test, test_rows), test_y
+
+
 def lionc_list_to_description(lionc):
     output = ''
     for section in lionc:
@@ -43,6 +128,8 @@ def lionc_list_to_description(lionc):
     return output[:-2]
 
 def myFactorize(data, min_count=2, max_categories=None):   # min_count is miniumum required entries for it to be classified as valid and included
+    import pandas as pd
+    from numpy import isnan
 
     accepted_categories = []
     counted = Counter(data)
@@ -164,11 +251,11 @@ def generate_default_ML_parameters()->dict:
 
 
 # tools to combine feature sets
-def combine_two_dfs(df1:pd.DataFrame, df2:pd.DataFrame) -> pd.DataFrame:
+def combine_two_dfs(df1:'pd.DataFrame', df2:'pd.DataFrame') -> 'pd.DataFrame':
+    import pandas as pd
     set1 = set(df1)
-    set2 = set(df2)
-    set_union = set1.intersection(set2)
-    set2_uniques = set2.difference(set1)
+    set_union = [x for x in df2.columns if x in set1]
+    set2_uniques = [x for x in df2.columns if x not in set1]
 
     df_out = df1.copy()
     df_out.loc[:, set_union] += df2.loc[:, set_union]   # add missing values
@@ -176,13 +263,13 @@ def combine_two_dfs(df1:pd.DataFrame, df2:pd.DataFrame) -> pd.DataFrame:
     return df_out
 
 
-def combine_list_dfs(list_of_df:list) ->pd.DataFrame:
+def combine_list_dfs(list_of_df:list) ->'pd.DataFrame':
     while len(list_of_df) > 1:
         list_of_df[0] = combine_two_dfs(list_of_df[0], list_of_df.pop())
     return list_of_df[0]
 
 
-def combine_from_indices(dict_of_sections, selected_indices) ->pd.DataFrame:
+def combine_from_indices(dict_of_sections, selected_indices) ->'pd.DataFrame':
     list_to_run = []
     for section in selected_indices:
         print(section)
@@ -192,17 +279,20 @@ def combine_from_indices(dict_of_sections, selected_indices) ->pd.DataFrame:
 
     # if no transformation is specified it will default to 'one hot encoding' style 'binary' approach where the value
     # is either 1 or 0
-def normalize_df_columns(df1, start_col:int = 0, tf= None)->pd.DataFrame:
+def normalize_df_columns(df1, start_col:int = 0, tf= None)->'pd.DataFrame':
+    import pandas as pd
     num_columns = len(list(df1))
     if start_col >= num_columns or start_col < 0:
         print("Attempting to normalize dataframe with start_col outside of index")
         return df1
 
+    # DataFrame.applymap was renamed to DataFrame.map in pandas 2.1
+    elementwise = df1.map if hasattr(df1, 'map') else df1.applymap
     if tf is None:
         tf = (lambda x: 1 if x > 0 else 0)
-        df1 = df1.applymap(tf)
+        df1 = elementwise(tf)
     else:
-        df1 = df1.applymap(tf)
+        df1 = elementwise(tf)
         df1.fillna(0)
 
         from sklearn import preprocessing
@@ -308,10 +398,11 @@ def save_default_ML_params(work_dir = None, overwrite = False):
     save_to_json(obj_to_save=generate_default_ML_parameters(), filename=file_path, indent=4)
 
 
-def save_df(df:pd.DataFrame, file):
+def save_df(df:'pd.DataFrame', file):
     df.mask(df.eq(0)).to_csv(file)
 
 def load_df(file):
+    import pandas as pd
     df = pd.read_csv(file,index_col=0)
     df.fillna(0, inplace=True)
     return df
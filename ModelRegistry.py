@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""ModelRegistry.py
+
+Saves the models trained by FeatureElimination so new patients can be scored without retraining, and runs batch
+inference on new JsonBasedReader outputs.
+
+For each task the registry (work_dir/models/registry) keeps:
+    <task>/estimator.joblib   the fitted estimator (numpy arrays inside are memory mapped when loaded)
+    <task>/features.json      the selected features, in the column order the estimator expects
+    <task>/scale.npy          2 x n_features array, min and max of the cube rooted values of the training rows (the
+                              normalizer FeatureElimination applies, memory mapped when loaded)
+plus manifest.json (tasks, model, settings used to aggregate the training reports) and vocabulary.json (all
+features of the training feature matrix).
+
+Inference builds only the selected columns: the codes of each report are expanded with the ontology tables exactly
+as AggregateReportsBySection does (expand_report_codes), summed over sections and kept if some task uses them.
+
+Example:
+    python ModelRegistry.py predict <registry dir> <work dir with new outputs> [--report-table] [--out preds.csv]
+"""
+
+
+import logging
+import re
+import time
+import warnings
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from MLDataProcessing import save_to_json, load_dict_json, log_settings
+from FeatureKey import default_codec, column_key
+
+REGISTRY_DIR = Path('models') / 'registry'
+MANIFEST_FILE = 'manifest.json'
+VOCABULARY_FILE = 'vocabulary.json'
+
+
+def cube_root(values):
+    return np.power(values, 1 / 3)
+
+
+def fit_normalizer(fm):
+    """Min and max per column of the cube rooted feature matrix (pass the training rows), the scale of normalize."""
+    values = cube_root(fm.to_numpy(dtype=float))
+    return values.min(axis=0), values.max(axis=0)
+
+
+def normalize(values, scale):
+    """Cube root then min-max scaling with scale = [min, max] (same arithmetic as sklearn's MinMaxScaler)."""
+    data_min, data_max = scale[0], scale[1]
+    data_range = data_max - data_min
+    factor = 1.0 / np.where(data_range == 0.0, 1.0, data_range)
+    return cube_root(values) * factor + (-data_min * factor)
+
+
+def _task_dir_name(task):
+    return re.sub(r'[^\w.-]', '_', str(task))
+
+
+class TaskModel():
+    def __init__(self, task, estimator, features, scale, info=None):
+        self.task = task
+        self.estimator = estimator
+        self.features = features
+        self.scale = scale
+        self.info = info or {}
+
+    def predict(self, values):
+        """values: n_reports x len(features) raw counts in the order of self.features"""
+        with warnings.catch_warnings():
+            # estimators fitted on DataFrames warn when given arrays, the column order is already the same
+            warnings.filterwarnings('ignore', message='X does not have valid feature names')
+            return self.estimator.predict(normalize(values, self.scale))
+
+
+class ModelRegistry():
+    def __init__(self, registry_dir):
+        self.registry_dir = Path(registry_dir)
+        manifest_file = self.registry_dir / MANIFEST_FILE
+        self.manifest = load_dict_json(manifest_file) if manifest_file.exists() else {'tasks': {}}
+
+    @property
+    def tasks(self):
+        return list(self.manifest['tasks'].keys())
+
+    @property
+    def aggregate_settings(self):
+        return self.manifest.get('aggregate_settings') or {}
+
+    @property
+    def hashing(self):
+        return self.manifest.get('hashing')
+
+    def save_manifest(self, model=None, vocabulary=None, aggregate_settings=None, hashing=None):
+        """hashing: FeatureHashing settings when the models were trained on hashed features"""
+        import sklearn
+        if model is not None:
+            self.manifest['model'] = model
+        if aggregate_settings is not None:
+            self.manifest['aggregate_settings'] = aggregate_settings
+        self.manifest['hashing'] = hashing
+        if vocabulary is not None:
+            save_to_json(list(vocabulary), self.registry_dir / VOCABULARY_FILE)
+            self.manifest['vocabulary_size'] = len(vocabulary)
+        self.manifest['sklearn_version'] = sklearn.__version__
+        self.manifest['saved'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        save_to_json(self.manifest, self.registry_dir / MANIFEST_FILE, indent=4)
+
+    def save_task(self, task, estimator, features, scale, info=None):
+        import joblib
+        task_dir = self.registry_dir / _task_dir_name(task)
+        task_dir.mkdir(parents=True, exist_ok=True)
+        joblib.dump(estimator, task_dir / 'estimator.joblib')
+        save_to_json(list(features), task_dir / 'features.json')
+        np.save(task_dir / 'scale.npy', np.asarray(scale, dtype=float))
+        self.manifest['tasks'][str(task)] = dict(info or {}, directory=task_dir.name, n_features=len(features))
+        save_to_json(self.manifest, self.registry_dir / MANIFEST_FILE, indent=4)
+
+    def load(self, task, mmap=True):
+        import joblib
+        task_dir = self.registry_dir / self.manifest['tasks'][str(task)]['directory']
+        mmap_mode = 'r' if mmap else None
+        estimator = joblib.load(task_dir / 'estimator.joblib', mmap_mode=mmap_mode)
+        features = load_dict_json(task_dir / 'features.json')
+        scale = np.load(task_dir / 'scale.npy', mmap_mode=mmap_mode)
+        return TaskModel(task, estimator, features, scale, self.manifest['tasks'][str(task)])
+
+    def load_all(self, mmap=True):
+        return {task: self.load(task, mmap=mmap) for task in self.tasks}
+
+
+class FeatureBuilder():
+    """Builds the selected feature columns of the registry models from the (section, code, family flag, count,
+    negation count) rows of JsonBasedReader, in AggregateReportsBySection's expansion and the sum over sections of
+    combine_list_dfs.  With hashing (FeatureHashing settings) the codes are hashed into the 'h<column>' features."""
+    def __init__(self, models, tables, aggregate_settings=None, hashing=None):
+        self.models = models
+        self.tables = tables
+        self.settings = aggregate_settings or {}
+        self.space = None
+        if hashing:
+            from FeatureHashing import HashedFeatureSpace
+            self.space = HashedFeatureSpace.from_settings(dict(hashing, reverse_map_size=0))
+        self.columns = sorted({feature for model in models.values() for feature in model.features})
+        self.column_index = {feature: k for k, feature in enumerate(self.columns)}
+        self.key_columns = {}       # FeatureKey column key -> column (None if no model uses the feature)
+        self.task_columns = {task: np.array([self.column_index[f] for f in model.features], dtype=np.intp)
+                             for task, model in models.items()}
+
+    def add_report(self, values, row, rows):
+        from AggregateReportsBySection import expand_report_codes
+        from FeatureHashing import column_name
+        column_index = self.column_index
+        saved_codes_list = expand_report_codes(rows, self.tables, **self.settings)[:2]
+        if self.space is not None:
+            for column, value in self.space.transform_codes(saved_codes_list).items():
+                k = column_index.get(column_name(column))
+                if k is not None:
+                    values[row, k] += value
+            return
+        # feature keys joined to the columns by their legacy name once, then by int
+        key_columns = self.key_columns
+        for saved_codes in saved_codes_list:
+            for codes in saved_codes.values():
+                for code, count in codes.items():
+                    key = column_key(code)
+                    k = key_columns.get(key, -1)
+                    if k == -1:
+                        k = key_columns[key] = column_index.get(default_codec.name(code))
+                    if k is not None:
+                        values[row, k] += count
+
+    def build(self, reports):
+        """reports: list of (report id, rows), returns (report ids, n_reports x n_columns array)"""
+        values = np.zeros((len(reports), len(self.columns)))
+        for row, (_, rows) in enumerate(reports):
+            self.add_report(values, row, rows)
+        return [report_id for report_id, _ in reports], values
+
+    def predict(self, values):
+        return {task: model.predict(values[:, self.task_columns[task]]) for task, model in self.models.items()}
+
+
+def predict_batch(registry_dir, work_dir, input_format='txt', out_file=None, batch_size=10000):
+    """Scores the per report outputs of work_dir (JsonBasedReader + lookups on the new bundles) with every model of
+    the registry, saves and returns a DataFrame of predictions (report id x task)."""
+    import pandas as pd
+    import ReportTable
+    from AggregateReportsBySection import OntologyTables, iter_report_files, find_max_report_id
+
+    work_dir = Path(work_dir)
+    registry = ModelRegistry(registry_dir)
+    models = registry.load_all()
+    builder = FeatureBuilder(models, OntologyTables.load(work_dir), registry.aggregate_settings, registry.hashing)
+    logging.info("Loaded %d models using %d features" % (len(models), len(builder.columns)))
+
+    reports_dir = work_dir / 'output'
+    if input_format == 'table':
+        reports = ReportTable.iter_reports(reports_dir / ReportTable.REPORT_TABLE_FILE)
+    else:
+        reports = iter_report_files(reports_dir, find_max_report_id(reports_dir))
+
+    start = time.perf_counter()
+    results = []
+    batch = []
+    for report in reports:
+        batch.append(report)
+        if len(batch) >= batch_size:
+            results.append(_predict_frame(builder, batch, pd))
+            batch = []
+    if batch or not results:
+        results.append(_predict_frame(builder, batch, pd))
+    predictions = pd.concat(results)
+    elapsed = time.perf_counter() - start
+    logging.info("Scored %d reports in %.3f s (%.0f reports/s)" % (len(predictions), elapsed,
+                                                                   len(predictions) / max(elapsed, 1e-9)))
+
+    out_file = out_file or work_dir / 'predictions.csv'
+    predictions.to_csv(out_file)
+    print("File saved: " + str(out_file))
+    return predictions
+
+
+def _predict_frame(builder, batch, pd):
+    report_ids, values = builder.build(batch)
+    predictions = builder.predict(values) if report_ids else {task: [] for task in builder.models}
+    return pd.DataFrame(predictions, index=pd.Index(report_ids, name='report_id'), columns=list(builder.models))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Batch inference with the models saved by FeatureElimination")
+    parser.add_argument('command', choices=['predict', 'list'])
+    parser.add_argument('registry_dir')
+    parser.add_argument('work_dir', nargs='?', help="working directory with the JsonBasedReader outputs to score")
+    parser.add_argument('--report-table', action='store_true')
+    parser.add_argument('--out', help="predictions csv (default: <work dir>/predictions.csv)")
+    args = parser.parse_args()
+
+    log_settings(filename="ModelRegistry.log")
+    if args.command == 'list':
+        registry = ModelRegistry(args.registry_dir)
+        for task, info in registry.manifest['tasks'].items():
+            print(task, info)
+    else:
+        predict_batch(args.registry_dir, args.work_dir, 'table' if args.report_table else 'txt', args.out)
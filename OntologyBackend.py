@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""OntologyBackend.py
+
+Backends answering the Snomed-CT and RxNorm lookups of SnomedOntologyLookup and RxOntologyLookup, in batches.
+
+Every method of a backend takes a list of unique codes (the cache misses of a batch lookup) and returns a mapping
+{code: result} with an entry for each code.  RemoteBackend sends them to the RxNav/RxClass and Snomed-CT APIs (no batch
+endpoints: one rate limited request per code, see the query_* functions), LocalBackend answers them from dictionaries
+or the json files of a data directory (e.g. the outputs of a previous run, or the ontology of SyntheticBundles).
+
+The batch helpers (get_rxnorm_ingredients_batch, get_snomed_parents_batch, ...) check their cache for all the codes in
+one pass and pass the deduplicated misses to the backend installed with set_backend, in groups of GROUP_SIZE.
+
+Example:
+    set_backend(LocalBackend.from_dir(work_dir / 'data'))
+    RxOntologyLookup.get_rxnorm_ingredients_batch(['209387', '197361'])  -> {'209387': ['161'], '197361': ['17767']}
+"""
+
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from MLDataProcessing import load_dict_json
+
+GROUP_SIZE = 100    # codes per backend call
+
+
+class OntologyBackend(ABC):
+    """Interface of the lookup backends, the results are keyed by the codes requested.  A backend must implement all
+    the methods (it cannot be instantiated otherwise)."""
+
+    @abstractmethod
+    def rxnorm_ingredients(self, rxcuis):
+        """{rxcui: [(ingredient rxcui, ingredient name)]}"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def rxnorm_atc(self, rxcuis):
+        """{rxcui: [ATC class]} (ATC levels 1-4)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def rxnorm_search(self, terms):
+        """{term: [rxcui of the approximate matches]}"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def snomed_parents(self, sctids):
+        """{sctid: [(parent sctid, parent description)]} (inferred parents)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def snomed_names(self, sctids):
+        """{sctid: description}"""
+        raise NotImplementedError
+
+
+class RemoteBackend(OntologyBackend):
+    """RxNav/RxClass and Snomed-CT APIs (the query_* functions of RxOntologyLookup and SnomedOntologyLookup)."""
+
+    def rxnorm_ingredients(self, rxcuis):
+        import RxOntologyLookup
+        return {rxcui: [(x[0], x[1]) for x in RxOntologyLookup.query_rxnorm_ingredients(rxcui)] for rxcui in rxcuis}
+
+    def rxnorm_atc(self, rxcuis):
+        import RxOntologyLookup
+        return {rxcui: [x[0] for x in RxOntologyLookup.query_rxnorm_ATC(rxcui)] for rxcui in rxcuis}
+
+    def rxnorm_search(self, terms):
+        import RxOntologyLookup
+        return {term: [x[0] for x in RxOntologyLookup.query_rxnorm_ingredients_using_search(term)] for term in terms}
+
+    def snomed_parents(self, sctids):
+        import SnomedOntologyLookup
+        return {sctid: list(SnomedOntologyLookup.query_snomed_parents(sctid)) for sctid in sctids}
+
+    def snomed_names(self, sctids):
+        import SnomedOntologyLookup
+        return {sctid: SnomedOntologyLookup.query_snomed_name(sctid) for sctid in sctids}
+
+
+class LocalBackend(OntologyBackend):
+    """Lookups answered from dictionaries in the format of the lookup outputs, codes not found have no results."""
+
+    def __init__(self, ingredients=None, atc=None, snomed_parents=None, descriptions=None, ingredient_names=None):
+        self.ingredients = ingredients or {}                # rxcui -> [ingredient rxcui]
+        self.atc = atc or {}                                # rxcui -> [ATC class]
+        self.parents = snomed_parents or {}                 # sctid -> [parent sctid]
+        self.descriptions = descriptions or {}              # sctid -> description
+        self.ingredient_names = ingredient_names or {}      # ingredient rxcui -> name
+
+    @classmethod
+    def from_dir(cls, data_dir):
+        """Loads the json files of a data directory (rxcui_ingredient.json, rxcui_atc.json, ...)"""
+        data_dir = Path(data_dir)
+        return cls(ingredients=load_dict_json(data_dir / 'rxcui_ingredient.json', create_local_if_not_found=True),
+                   atc=load_dict_json(data_dir / 'rxcui_atc.json', create_local_if_not_found=True),
+                   snomed_parents=load_dict_json(data_dir / 'snomed_parents_inferred.json',
+                                                 create_local_if_not_found=True),
+                   descriptions=load_dict_json(data_dir / 'snomed_description_from_query.json',
+                                               create_local_if_not_found=True),
+                   ingredient_names=load_dict_json(data_dir / 'rxcui_ingredient_names.json',
+                                                   create_local_if_not_found=True))
+
+    def rxnorm_ingredients(self, rxcuis):
+        return {rxcui: [(x, self.ingredient_names.get(x, '')) for x in self.ingredients.get(str(rxcui), [])]
+                for rxcui in rxcuis}
+
+    def rxnorm_atc(self, rxcuis):
+        return {rxcui: list(self.atc.get(str(rxcui), [])) for rxcui in rxcuis}
+
+    def rxnorm_search(self, terms):
+        return {term: [] for term in terms}
+
+    def snomed_parents(self, sctids):
+        return {sctid: [(x, self.descriptions.get(x, '')) for x in self.parents.get(str(sctid), [])]
+                for sctid in sctids}
+
+    def snomed_names(self, sctids):
+        return {sctid: self.descriptions.get(str(sctid), '') for sctid in sctids}
+
+
+_backend = RemoteBackend()
+
+
+def get_backend():
+    return _backend
+
+
+def set_backend(backend):
+    """Installs the backend used by the lookups of SnomedOntologyLookup and RxOntologyLookup, returns the previous one"""
+    global _backend
+    if not isinstance(backend, OntologyBackend):
+        raise TypeError("Ontology backend must be an OntologyBackend, got " + type(backend).__name__)
+    previous, _backend = _backend, backend
+    return previous
+
+
+def split_cached(codes, *caches):
+    """One pass over codes: ({code: cached result}, [misses, deduplicated in first seen order]).
+
+    The caches are checked in order, the first one with the code wins.
+    """
+    found = {}
+    misses = {}
+    for code in codes:
+        if code in found or code in misses:
+            continue
+        for cache in caches:
+            if code in cache:
+                found[code] = cache[code]
+                break
+        else:
+            misses[code] = None
+    return found, list(misses)
+
+
+def groups(codes, group_size=None):
+    group_size = group_size or GROUP_SIZE
+    for start in range(0, len(codes), group_size):
+        yield codes[start:start + group_size]
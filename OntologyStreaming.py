@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""OntologyStreaming.py
+
+Runs JsonBasedReader with the Snomed-CT and RxNorm lookups overlapped with the reading of the bundles.
+
+JsonBasedReader publishes each newly found Snomed-CT code and Rxcui onto a queue.  One worker thread per ontology
+resolves them (Snomed names/ancestors, RxNorm ingredients/ATC) while the bundles are still being read, taking all the
+codes queued so far as one batch lookup, and fills the same cache files used by SnomedOntologyLookup and
+RxOntologyLookup.  Once reading ends the queues are drained and the
+normal lookup mains are run, which then mostly hit the warm caches.
+"""
+
+
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import JsonBasedReader
+import RxOntologyLookup
+import SnomedOntologyLookup
+from JsonBasedReader import CodeSystem
+from Instrumentation import emit_metrics, reset_metrics
+from MLDataProcessing import save_to_json, load_dict_json, log_settings
+from OntologyBackend import GROUP_SIZE
+
+SAVE_PROGRESS_EVERY_N = 100  # save the caches after N resolved codes in case anything occurs during run
+
+
+def main(data_dir, work_dir, snomed_depth=2, add_snomed_ontology=True, find_ingreds=True, find_ATC=True,
+         use_section_index=False, output_format='txt'):
+    work_dir = Path(work_dir)
+    log_settings(filename="ontology_streaming.log", filemode='w')
+
+    run_snomed = add_snomed_ontology and snomed_depth > 0
+    if run_snomed and len(SnomedOntologyLookup.base_uri) == 0:
+        logging.warning("Snomed CT server url not set in SnomedOntologyLookup, skipping Snomed lookups")
+        run_snomed = False
+
+    snomed_queue = queue.Queue()
+    rx_queue = queue.Queue()
+
+    def publish(code_system, code, text):
+        if code_system == CodeSystem.SNOMED:
+            if run_snomed:
+                snomed_queue.put(code)
+        elif code_system == CodeSystem.RXNORM:
+            rx_queue.put(code)
+
+    reset_metrics('snomed_lookup')
+    reset_metrics('rx_lookup')
+    workers = []
+    if run_snomed:
+        workers.append(threading.Thread(target=snomed_worker, args=(snomed_queue, work_dir, snomed_depth),
+                                        name='snomed_worker', daemon=True))
+    workers.append(threading.Thread(target=rx_worker, args=(rx_queue, work_dir, find_ingreds, find_ATC),
+                                    name='rx_worker', daemon=True))
+    for worker in workers:
+        worker.start()
+
+    try:
+        JsonBasedReader.main(data_dir=data_dir, work_dir=work_dir, on_new_code=publish,
+                             use_section_index=use_section_index, output_format=output_format)
+    finally:
+        snomed_queue.put(None)
+        rx_queue.put(None)
+
+    logging.info("Reading finished, %d Snomed and %d RxNorm codes still queued"
+                 % (snomed_queue.qsize() - 1, rx_queue.qsize() - 1))
+    for worker in workers:
+        worker.join()
+    # lookups done by the workers, the mains below start their own metrics
+    if run_snomed:
+        emit_metrics('snomed_lookup', work_dir)
+    emit_metrics('rx_lookup', work_dir)
+
+    # finish with the regular lookups (mostly cache hits now), these do not depend on each other
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(RxOntologyLookup.main, work_dir, find_ingreds=find_ingreds, find_ATC=find_ATC)]
+        if run_snomed:
+            futures.append(executor.submit(SnomedOntologyLookup.main, work_dir, depth=snomed_depth))
+        for future in futures:
+            future.result()
+
+
+def consume_batches(code_queue, max_size=GROUP_SIZE):
+    """Yields lists of the codes queued so far (waits for the first one, at most max_size) until None is queued"""
+    while True:
+        code = code_queue.get()
+        if code is None:
+            return
+        batch = [code]
+        while len(batch) < max_size:
+            try:
+                code = code_queue.get_nowait()
+            except queue.Empty:
+                break
+            if code is None:
+                yield batch
+                return
+            batch.append(code)
+        yield batch
+
+
+def progress_saved(count, batch_size):
+    """True when count crossed a multiple of SAVE_PROGRESS_EVERY_N with the last batch"""
+    return count // SAVE_PROGRESS_EVERY_N != (count - batch_size) // SAVE_PROGRESS_EVERY_N
+
+
+def snomed_worker(code_queue, work_dir, depth):
+    parents_file = work_dir / 'data' / 'snomed_parents_inferred.json'
+    descriptions_file = work_dir / 'data' / 'snomed_description_from_query.json'
+    sctid_to_parents = load_dict_json(parents_file, create_local_if_not_found=True)
+    sctid_to_desc = load_dict_json(descriptions_file, create_local_if_not_found=True)
+
+    count = 0
+    for batch in consume_batches(code_queue):
+        try:
+            SnomedOntologyLookup.get_snomed_names_batch(batch, sctid_to_desc)
+            SnomedOntologyLookup.get_snomed_ancestors_batch(batch, sctid_to_parents, sctid_to_desc, depth=depth,
+                                                            query_depth=depth)
+        except Exception as e:  # left for SnomedOntologyLookup.main to retry
+            logging.info("Snomed lookup failed for " + str(batch) + ": " + repr(e))
+        count += len(batch)
+        if progress_saved(count, len(batch)):
+            save_to_json(sctid_to_parents, parents_file, indent=4)
+            save_to_json(sctid_to_desc, descriptions_file, indent=4)
+            logging.info("Snomed codes resolved while reading: " + str(count))
+
+    save_to_json(sctid_to_parents, parents_file, indent=4)
+    save_to_json(sctid_to_desc, descriptions_file, indent=4)
+    logging.info("Snomed codes resolved while reading: " + str(count))
+
+
+def rx_worker(code_queue, work_dir, find_ingreds=True, find_ATC=True):
+    ingredient_dict_file = work_dir / 'data' / 'rxcui_ingredient.json'
+    save_atc_file = work_dir / 'data' / 'rxcui_atc.json'
+    manual_ingredient_entries_file = work_dir / 'data' / 'rxcui_ingred_manual_entries.json'
+    ingredients_name_file = work_dir / 'data' / "rxcui_ingredient_names.json"
+
+    # the lookup helpers keep their caches in module globals, the same ones RxOntologyLookup.main loads
+    RxOntologyLookup.cache_cui_to_ingredients = load_dict_json(ingredient_dict_file, create_local_if_not_found=True)
+    RxOntologyLookup.cache_cui_to_atc = load_dict_json(save_atc_file, create_local_if_not_found=True)
+    RxOntologyLookup.manual_ingredient_entries = load_dict_json(manual_ingredient_entries_file,
+                                                                create_local_if_not_found=True)
+    RxOntologyLookup.ingredients_name = load_dict_json(ingredients_name_file, create_local_if_not_found=True)
+
+    def save_caches():
+        if find_ingreds:
+            save_to_json(RxOntologyLookup.cache_cui_to_ingredients, ingredient_dict_file, indent=4)
+            save_to_json(RxOntologyLookup.ingredients_name, ingredients_name_file, indent=4)
+        if find_ATC:
+            save_to_json(RxOntologyLookup.cache_cui_to_atc, save_atc_file, indent=4)
+
+    count = 0
+    for batch in consume_batches(code_queue):
+        try:
+            ingredients = {}
+            if find_ingreds:
+                ingredients = RxOntologyLookup.get_rxnorm_ingredients_batch(batch)
+                RxOntologyLookup.get_rxnorm_ingredients_batch(ingredient for rxcui in batch
+                                                              for ingredient in ingredients[rxcui])
+            if find_ATC:
+                atc = RxOntologyLookup.get_rxnorm_ATC_batch(batch)
+                RxOntologyLookup.get_rxnorm_ATC_batch(ingredient for rxcui in batch if not atc[rxcui]
+                                                      for ingredient in ingredients.get(rxcui, []))
+        except Exception as e:  # left for RxOntologyLookup.main to retry
+            logging.info("RxNorm lookup failed for " + str(batch) + ": " + repr(e))
+        count += len(batch)
+        if progress_saved(count, len(batch)):
+            save_caches()
+            logging.info("RxNorm codes resolved while reading: " + str(count))
+
+    save_caches()
+    logging.info("RxNorm codes resolved while reading: " + str(count))
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 2:
+        main(sys.argv[1], sys.argv[2])
+    else:
+        main(input("Please enter data directory (FHIR JSON Resource Bundle): "),
+             input("Please enter working directory: "))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""ReportTable.py
+
+Single file, long format, columnar store for the per report code counts of JsonBasedReader, used in place of one
+output/REPORTn.txt csv per report.
+
+Each row is (report_id, section, family flag, code, count, negation count).  Sections and codes are dictionary
+encoded: the writer gives each new string the next integer id and the new strings are stored with the block that
+first uses them, so the file is append only and can be read front to back in one pass.  Rows are buffered and
+appended in blocks of BATCH_ROWS rows.  Every report added is recorded with its number of rows, reports without
+codes included (they have no rows but count for the number of reports, as the empty REPORTn.txt files do).
+
+Layout (little endian):
+    header   8s magic 'FHIRTAB2'
+    blocks   uint32 rows, uint32 min report id, uint32 max report id, uint32 reports, uint32 new sections,
+             uint32 new codes, uint32 dictionary bytes, new sections and codes (utf-8, newline separated),
+             the reports: report id uint32, rows uint32 (one entry per report of the block, in the order added),
+             then the columns: report_id uint32, section uint32, family uint8, code uint32, count uint32,
+             negation uint32
+
+The rows of a report are always written together, in the order the reports were added.
+"""
+
+
+import struct
+import sys
+from array import array
+from pathlib import Path
+
+from FeatureKey import default_codec
+
+REPORT_TABLE_FILE = 'report_codes.rtab'
+MAGIC = b'FHIRTAB2'
+BATCH_ROWS = 1 << 16
+
+_block_header = struct.Struct('<IIIIIII')
+_COLUMNS = (('report_id', 'I'), ('section', 'I'), ('family', 'B'), ('code', 'I'), ('count', 'I'),
+            ('negation', 'I'))
+
+
+def split_full_code(full_code):
+    """Splits a JsonBasedReader code ('<section>_[F-]<code>') into (section, family flag, code)."""
+    return default_codec.split(full_code)
+
+
+def _to_little_endian(column):
+    if sys.byteorder != 'little' and column.itemsize > 1:
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+
+class ReportTableWriter():
+    """Appends report rows to a report table, use as a context manager or call close()."""
+    def __init__(self, filename, batch_rows=BATCH_ROWS):
+        self.filename = Path(filename)
+        self.batch_rows = batch_rows
+        self.sections = {}
+        self.codes = {}
+        self._new_sections = []
+        self._new_codes = []
+        self._columns = {name: array(typecode) for name, typecode in _COLUMNS}
+        self._reports = array('I')          # reports of the block and their number of rows
+        self._report_rows = array('I')
+        self._fp = open(self.filename, 'wb')
+        self._fp.write(MAGIC)
+        self.n_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _encode(self, value, dictionary, new_values):
+        key = dictionary.get(value)
+        if key is None:
+            key = dictionary[value] = len(dictionary)
+            new_values.append(value)
+        return key
+
+    def add_report(self, report_id, rows):
+        """rows: iterable of (section, family flag, code, count, negation count)"""
+        columns = self._columns
+        n_rows = len(columns['report_id'])
+        for section, family, code, count, negation in rows:
+            columns['report_id'].append(report_id)
+            columns['section'].append(self._encode(section, self.sections, self._new_sections))
+            columns['family'].append(1 if family else 0)
+            columns['code'].append(self._encode(code, self.codes, self._new_codes))
+            columns['count'].append(count)
+            columns['negation'].append(negation)
+        self._reports.append(report_id)
+        self._report_rows.append(len(columns['report_id']) - n_rows)
+        if len(columns['report_id']) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        report_ids = self._columns['report_id']
+        if not self._reports:
+            return
+        dictionary = '\n'.join(self._new_sections + self._new_codes).encode('utf-8')
+        self._fp.write(_block_header.pack(len(report_ids), min(self._reports), max(self._reports), len(self._reports),
+                                          len(self._new_sections), len(self._new_codes), len(dictionary)))
+        self._fp.write(dictionary)
+        _to_little_endian(self._reports).tofile(self._fp)
+        _to_little_endian(self._report_rows).tofile(self._fp)
+        for name, _ in _COLUMNS:
+            _to_little_endian(self._columns[name]).tofile(self._fp)
+        self.n_rows += len(report_ids)
+        self._new_sections = []
+        self._new_codes = []
+        self._columns = {name: array(typecode) for name, typecode in _COLUMNS}
+        self._reports = array('I')
+        self._report_rows = array('I')
+
+    def close(self):
+        if self._fp.closed:
+            return
+        self.flush()
+        self._fp.close()
+
+
+def _read_header(fp, filename):
+    magic = fp.read(len(MAGIC))
+    if magic != MAGIC:
+        if magic[:7] == MAGIC[:7]:
+            raise ValueError(str(filename) + " is a report table of an older version, rerun JsonBasedReader")
+        raise ValueError(str(filename) + " is not a report table")
+
+
+def iter_blocks(filename):
+    """Yields (columns, sections, codes) per block: the columns as arrays plus the section and code dictionaries
+    (lists indexed by id) as known up to that block.  columns also has the reports of the block ('reports' and their
+    number of rows 'report_rows', empty reports included)."""
+    sections = []
+    codes = []
+    with open(filename, 'rb') as fp:
+        _read_header(fp, filename)
+        while True:
+            header = fp.read(_block_header.size)
+            if len(header) < _block_header.size:
+                return
+            n_rows, _, _, n_reports, n_sections, n_codes, dictionary_bytes = _block_header.unpack(header)
+            if n_sections + n_codes:
+                new_values = fp.read(dictionary_bytes).decode('utf-8').split('\n')
+                sections += new_values[:n_sections]
+                codes += new_values[n_sections:]
+            columns = {}
+            for name, typecode, n in (('reports', 'I', n_reports), ('report_rows', 'I', n_reports)):
+                column = array(typecode)
+                column.fromfile(fp, n)
+                columns[name] = _to_little_endian(column)
+            for name, typecode in _COLUMNS:
+                column = array(typecode)
+                column.fromfile(fp, n_rows)
+                columns[name] = _to_little_endian(column)
+            yield columns, sections, codes
+
+
+def iter_reports(filename):
+    """Yields (report_id, rows) with rows as a list of (section, code, family flag, count, negation count), for every
+    report in the order added (rows is empty for the reports without codes)."""
+    for columns, sections, codes in iter_blocks(filename):
+        columns_of_rows = (columns['section'], columns['family'], columns['code'], columns['count'],
+                           columns['negation'])
+        start = 0
+        for report_id, n_rows in zip(columns['reports'], columns['report_rows']):
+            rows = [(sections[section], codes[code], bool(family), count, negation)
+                    for section, family, code, count, negation in zip(*(c[start:start + n_rows]
+                                                                         for c in columns_of_rows))]
+            start += n_rows
+            yield report_id, rows
+
+
+def max_report_id(filename):
+    """Largest report id in the table (-1 if empty), read from the block headers only (reports without codes
+    included)."""
+    max_id = -1
+    with open(filename, 'rb') as fp:
+        _read_header(fp, filename)
+        row_size = sum(array(typecode).itemsize for _, typecode in _COLUMNS)
+        while True:
+            header = fp.read(_block_header.size)
+            if len(header) < _block_header.size:
+                return max_id
+            n_rows, _, block_max, n_reports, _, _, dictionary_bytes = _block_header.unpack(header)
+            if n_reports:
+                max_id = max(max_id, block_max)
+            fp.seek(dictionary_bytes + n_reports * 8 + n_rows * row_size, 1)
@@ -12,39 +12,26 @@ changing hardcoded settings.
 
 
 
-import numpy as np
-import pandas as pd
-import sklearn
-import CalculatePerformance
 import logging
-
-from pathlib import Path
-from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
-from sklearn.naive_bayes import GaussianNB, MultinomialNB, BernoulliNB
-from sklearn import tree
-from sklearn.linear_model import LogisticRegression
-from sklearn.svm import SVC
-from sklearn.multiclass import OneVsRestClassifier
-
-from sklearn.metrics import f1_score, precision_score, recall_score, roc_curve, auc
-from random import random
-from datetime import datetime
-from sklearn.model_selection import cross_val_predict, cross_validate, StratifiedKFold
-from sklearn.feature_selection import RFECV, RFE
-from sklearn.model_selection import StratifiedKFold, StratifiedShuffleSplit
-from collections import Counter
-from math import isnan
+import time
 from warnings import warn
-from MLDataProcessing import myFactorize, get_ML_parameters, generate_param_strings, log_settings, rearrange_for_testing, normalize_df_columns
 
-import time
+from MLDataProcessing import myFactorize, get_ML_parameters, generate_param_strings, log_settings, rearrange_for_testing, normalize_df_columns, SplitIndex
+
+# sklearn (and pandas) are imported where they are used, importing this module to reach set_up_classifier or the
+# classifiers below does not load the whole sklearn surface (see ImportBudget.py).  LM_params=None uses
+# get_ML_parameters() at call time.
 
 have_written_params_to_file = False
 
 
 
-def run_rfe_classifier(method, train_data, train_class, test_data, CV_ = 0, fraction_feat_to_keep = 0.1, LM_params = get_ML_parameters()):
+def run_rfe_classifier(method, train_data, train_class, test_data, CV_ = 0, fraction_feat_to_keep = 0.1, LM_params = None):
+    from sklearn.feature_selection import RFE
+    from sklearn.multiclass import OneVsRestClassifier
     global have_written_params_to_file
+    if LM_params is None:
+        LM_params = get_ML_parameters()
     if have_written_params_to_file is False:
         logging.info("Run settings for models:")
         logging.info(str(LM_params))
@@ -71,6 +58,7 @@ def run_rfe_classifier(method, train_data, train_class, test_data, CV_ = 0, frac
 # have to find index from test for which we add predictions.  Some index are not added since the gold file did not have
 # a valid class (i.e. blank instead of 'Y'/'N')
 def append_results_to_df(base_df, test, preds, task):
+    import pandas as pd
     task_results = str(task) + ' results'
     results_row_df = pd.DataFrame(preds, index=test.index, columns=[task_results])
     base_df = pd.concat([base_df, results_row_df], axis=1)
@@ -78,8 +66,13 @@ def append_results_to_df(base_df, test, preds, task):
     return base_df
 
 
-def eval_classifier(method, train_data, train_class, test_data, test_class, LM_params = get_ML_parameters(), positive_roc_index = 1):
+def eval_classifier(method, train_data, train_class, test_data, test_class, LM_params = None, positive_roc_index = 1):
+    from sklearn.metrics import roc_curve, auc
+    from sklearn.multiclass import OneVsRestClassifier
+    from sklearn.svm import SVC
     global have_written_params_to_file
+    if LM_params is None:
+        LM_params = get_ML_parameters()
     if have_written_params_to_file is False:
         logging.info("Run settings for models:")
         logging.info(str(LM_params))
@@ -103,9 +96,88 @@ def eval_classifier(method, train_data, train_class, test_data, test_class, LM_p
 
     return preds, roc_auc
 
+
+def _roc_scores(clf, test_data, positive_roc_index):
+    """Scores of class positive_roc_index for the ROC curve: decision_function when the estimator has one (no
+    probability calibration needed, e.g. SVC), predict_proba otherwise"""
+    classes = list(clf.classes_)
+    if positive_roc_index not in classes:
+        return None
+    if hasattr(clf, 'decision_function'):
+        scores = clf.decision_function(test_data)
+        if scores.ndim == 1:  # binary: score of classes[1]
+            return scores if classes.index(positive_roc_index) == 1 else -scores
+    else:
+        scores = clf.predict_proba(test_data)
+    return scores[:, classes.index(positive_roc_index)]
+
+
+def _fit_and_score(method, data, LM_params, set_of_classes, positive_roc_index):
+    from sklearn.metrics import roc_curve, auc
+    from sklearn.multiclass import OneVsRestClassifier
+    import CalculatePerformance
+
+    train_data, train_class, test_data, test_class = data
+    start = time.perf_counter()
+    clf = OneVsRestClassifier(set_up_classifier(method, 0, LM_params))
+    clf.fit(train_data, train_class)
+    fit_seconds = time.perf_counter() - start
+    preds = clf.predict(test_data)
+
+    row = dict(zip(('p_micro', 'p_macro', 'r_micro', 'r_macro', 'f1_micro', 'f1_macro'),
+                   CalculatePerformance.calculate_metrics(test_class, preds, set_of_classes, output_type='values')))
+    scores = _roc_scores(clf, test_data, positive_roc_index)
+    row['auc'] = float('nan')
+    if scores is not None and positive_roc_index in set(test_class) and len(set(test_class)) > 1:
+        fpr, tpr, thresholds = roc_curve(test_class, scores, pos_label=positive_roc_index)
+        roc_auc = auc(fpr, tpr)
+        row['auc'] = max(roc_auc, 1 - roc_auc)
+    row['fit_seconds'] = fit_seconds
+    return row, preds
+
+
+def eval_classifiers(fm, gold, methods=('dt', 'rf', 'lr', 'svm', 'gb', 'nb'), tasks=None, set_of_classes=(0, 1, 2, 3),
+                     LM_params=None, positive_roc_index=1, max_workers=None):
+    """Evaluates several model types on every task in one pass, returns (metrics DataFrame with one row per task
+    and method, {(task, method): test predictions}).
+
+    The train/test rows of a task (SplitIndex) are taken once and shared by all the methods, which are fitted concurrently
+    (threads, the arrays are not copied).  Same models as eval_classifier (OneVsRestClassifier of
+    set_up_classifier), except SVC is not fitted with probability=True: the ROC of every method uses
+    decision_function when available (the AUC only depends on the ranking of the scores)."""
+    import pandas as pd
+    from concurrent.futures import ThreadPoolExecutor
+
+    if LM_params is None:
+        LM_params = get_ML_parameters()
+    split = SplitIndex(gold, fm.index, set_of_classes)
+    tasks = tasks if tasks is not None else split.tasks
+    X = split.arrange(fm).to_numpy(dtype=float)
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for task in tasks:
+            train_rows, test_rows = split.rows(task)
+            y = split.classes[task].to_numpy().astype(int)
+            data = (X[train_rows], y[train_rows], X[test_rows], y[test_rows])
+            for method in methods:
+                futures[(task, method)] = (executor.submit(_fit_and_score, method, data, LM_params, set_of_classes,
+                                                           positive_roc_index), len(train_rows), len(test_rows))
+
+    rows, predictions = [], {}
+    for (task, method), (future, n_train, n_test) in futures.items():
+        row, predictions[(task, method)] = future.result()
+        rows.append(dict({'task': task, 'method': method, 'n_train': n_train, 'n_test': n_test}, **row))
+        logging.info("task: %s method: %s f1: %.4f f1_macro: %.4f auc: %.4f"
+                     % (task, method, row['f1_micro'], row['f1_macro'], row['auc']))
+    return pd.DataFrame(rows), predictions
+
 # run recursive feature elimination
-def rfe_classifier(method, train_data, train_class, test_data, CV_ = 3, fraction_feat_to_keep = 0.1, LM_params = get_ML_parameters()):
+def rfe_classifier(method, train_data, train_class, test_data, CV_ = 3, fraction_feat_to_keep = 0.1, LM_params = None):
+    from sklearn.feature_selection import RFE
     global have_written_params_to_file
+    if LM_params is None:
+        LM_params = get_ML_parameters()
     if have_written_params_to_file is False:
         logging.info("Run settings for models:")
         logging.info(str(LM_params))
@@ -137,31 +209,42 @@ def rfe_classifier(method, train_data, train_class, test_data, CV_ = 3, fraction
 
 def set_up_classifier(method, CV_, LM_params):
     if method == 'dt':
+        from sklearn import tree
         clf = tree.DecisionTreeClassifier(random_state=0, **LM_params['dt'])
     elif method =='rf':
+        from sklearn.ensemble import RandomForestClassifier
         clf = RandomForestClassifier(random_state=0,**LM_params['rf'])
     elif method == 'lr':
+        from sklearn.linear_model import LogisticRegression
         clf = LogisticRegression(random_state = 0,**LM_params['lr'])
     elif method =='svm':
+        from sklearn.svm import SVC
         if CV_ > 1:
             if LM_params['svm']['kernel'] != 'linear':
                 logging.warn("SVM kernel method set to linear to do cross validation")
                 LM_params['svm']['kernel'] = 'linear'
         clf = SVC(random_state=0, **LM_params['svm'])
     elif method =='gb':
+        from sklearn.ensemble import GradientBoostingClassifier
         clf = GradientBoostingClassifier(random_state=0, **LM_params['gb'])
     elif method =='nb':
+        from sklearn.naive_bayes import MultinomialNB
         clf = MultinomialNB(**LM_params['nb'])
     else:
+        from sklearn import tree
         warn("Invalid method selected running DT as default method")
         clf = tree.DecisionTreeClassifier(random_state=0, **LM_params['dt'])
     return clf
 
 #run recursive feature elimination with cross validation
-def rfecv_classifier(method, train_data, train_class, test_data, CV_ = 3, fraction_feat_to_keep = 0.1, LM_params = get_ML_parameters(), save_model=False):
+def rfecv_classifier(method, train_data, train_class, test_data, CV_ = 3, fraction_feat_to_keep = 0.1, LM_params = None, save_model=False):
+    from sklearn.feature_selection import RFECV, RFE
+    from sklearn.model_selection import StratifiedKFold
     n_orig_features = len(list(train_data))
     max_ratio_diff = 1.2
     global have_written_params_to_file
+    if LM_params is None:
+        LM_params = get_ML_parameters()
     if have_written_params_to_file is False:
         logging.info("Run settings for models:")
         logging.info(str(LM_params))
@@ -177,7 +260,7 @@ def rfecv_classifier(method, train_data, train_class, test_data, CV_ = 3, fracti
         # Recursive feature elimination with Cross Validation
         # CV might have issues if data set classification is poorly balanced and can not split it properly
         try:
-            rfecv = RFECV(estimator=clf, step=step_elim, cv=StratifiedKFold(n_splits=CV_, random_state=0),
+            rfecv = RFECV(estimator=clf, step=step_elim, cv=StratifiedKFold(n_splits=CV_),
                           scoring='accuracy')
             rfecv.fit(train_data, train_class)
             preds = rfecv.predict(test_data)
@@ -202,19 +285,29 @@ def rfecv_classifier(method, train_data, train_class, test_data, CV_ = 3, fracti
             rfecv.fit(train_data[features_selected], train_class)
             preds = rfecv.predict(test_data[features_selected])
             mask = list(rfecv.support_)
-            features = train_data.columns
+            features = features_selected  # support_ of the second elimination refers to the features kept by the first
             features_selected = [features[i] for i in range(0, len(mask)) if mask[i]]
 
     else:
         clf.fit(train_data, train_class)
         preds = clf.predict(test_data)
+        features_selected = list(train_data.columns)
+        mask = [True] * len(features_selected)
 
+    # save_model: also return the fitted estimator, which takes the selected features (in order) as input
+    if save_model:
+        model = rfecv.estimator_ if CV_ > 1 else clf
+        return preds, features_selected, sum(mask), model
     return preds, features_selected, sum(mask)
 
 
 
 if __name__ == "__main__":
 
+    import numpy as np
+    import pandas as pd
+    import sklearn
+
     log_settings(filename="RunClassification.log", level=logging.INFO)
 
     logging.info("pandas version " + str(pd.__version__))
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""RunPipeline.py
+
+Headless runner for the pre-processing and classification pipeline (same steps as RunAllGUI).
+
+Each stage is a node in a DAG with declared inputs and outputs.  A stage depends on every stage that produces one of
+its inputs.  The fingerprint of the inputs (and of the stage settings) is saved after each successful run in
+work_dir/data/pipeline_state.json, and a stage is skipped on the next run if its fingerprint has not changed and its
+outputs still exist.  Stages that do not depend on each other (e.g. the Snomed and RxNorm lookups) are run
+concurrently.  Per-stage timings are saved to work_dir/data/pipeline_timings.json.
+
+Example:
+    python RunPipeline.py --data-dir bundles/ --work-dir work/ --gold-csv GOLD.csv
+"""
+
+
+import argparse
+import ast
+import hashlib
+import json
+import logging
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+from Instrumentation import reset_metrics, emit_metrics
+from MLDataProcessing import save_to_json, load_dict_json, log_settings
+
+add_snomed_ontology = True
+snomed_ontology_ancestor_lookup_depth = 2
+add_rxnorm_ATC = True
+atc_levels = None  # ATC levels (1-4) added with add_rxnorm_ATC, None: all
+convert_rxcui_to_ingred = True
+keep_rxnorm_after_conversion = True
+disregard_negation_when_adding_original_codes = True
+gold_factorization = {'Y': 1, 'N': 0, 'Q': 2, 'U': 3}
+model = 'rf'
+stream_ontology_lookups = False  # overlap the ontology lookups with reading the bundles (OntologyStreaming)
+use_section_index = False  # classify sections without a Lion-C code using SECTIONS_Index_V9.csv
+report_format = 'txt'  # per report outputs: 'txt' (output/REPORTn.txt) or 'table' (single ReportTable file)
+hash_features = 0  # > 0: hash the codes into this many columns instead of one column per code (FeatureHashing)
+explain_models = False  # add the SHAP explanations stage (ShapExplanations, needs the shap package)
+
+STATE_FILE = 'pipeline_state.json'
+TIMINGS_FILE = 'pipeline_timings.json'
+
+
+class PipelineStage():
+    def __init__(self, name, func, inputs=(), outputs=(), params=None):
+        self.name = name
+        self.func = func
+        self.inputs = [Path(x) for x in inputs]
+        self.outputs = [Path(x) for x in outputs]
+        self.params = params if params is not None else {}
+        self.depends_on = set()
+
+    def fingerprint(self):
+        sha = hashlib.sha1()
+        sha.update(json.dumps(self.params, sort_keys=True, default=str).encode('utf-8'))
+        for path in self.inputs:
+            sha.update(str(path).encode('utf-8'))
+            sha.update(fingerprint_path(path).encode('utf-8'))
+        return sha.hexdigest()
+
+    def outputs_exist(self):
+        return all(path.exists() for path in self.outputs)
+
+    def __repr__(self):
+        return 'PipelineStage(' + self.name + ')'
+
+
+def fingerprint_path(path):
+    """Content hash for a file; name, size and modification time of every file for a directory."""
+    path = Path(path)
+    if not path.exists():
+        return 'missing'
+    sha = hashlib.sha1()
+    if path.is_dir():
+        for sub_path in sorted(path.rglob('*')):
+            if sub_path.is_file():
+                stat = sub_path.stat()
+                sha.update(('%s:%d:%d;' % (sub_path.relative_to(path), stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+    else:
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def link_stages(stages):
+    """Adds a dependency from each stage to every stage producing one of its inputs."""
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            producers[output] = stage.name
+    for stage in stages:
+        for input_ in stage.inputs:
+            if input_ in producers and producers[input_] != stage.name:
+                stage.depends_on.add(producers[input_])
+    return stages
+
+
+def build_stages(data_dir, work_dir, gold_csv):
+    """Defines the pipeline stages (same order and settings as RunAllGUI)."""
+    data_dir, work_dir, gold_csv = Path(data_dir), Path(work_dir), Path(gold_csv)
+    data = work_dir / 'data'
+    gold_multiclass = work_dir / (gold_csv.stem + '_multiclass.csv')
+
+    def run_json_reader():
+        import JsonBasedReader
+        JsonBasedReader.main(data_dir=data_dir, work_dir=work_dir, use_section_index=use_section_index,
+                             output_format=report_format)
+
+    def run_snomed_lookup():
+        import SnomedOntologyLookup
+        SnomedOntologyLookup.main(work_dir, depth=snomed_ontology_ancestor_lookup_depth)
+
+    def run_rx_lookup():
+        import RxOntologyLookup
+        RxOntologyLookup.main(work_dir, find_ATC=add_rxnorm_ATC, find_ingreds=add_rxnorm_ATC)
+
+    def run_streaming_reader():
+        import OntologyStreaming
+        OntologyStreaming.main(data_dir, work_dir, snomed_depth=snomed_ontology_ancestor_lookup_depth,
+                               add_snomed_ontology=add_snomed_ontology, find_ingreds=add_rxnorm_ATC,
+                               find_ATC=add_rxnorm_ATC, use_section_index=use_section_index,
+                               output_format=report_format)
+
+    # also saved with the trained models, new reports are expanded the same way when scored (ModelRegistry)
+    aggregate_settings = {'add_rxnorm_ATC': add_rxnorm_ATC, 'atc_levels': atc_levels,
+                          'add_snomed_ontology': add_snomed_ontology,
+                          'convert_rxcui_to_ingred': convert_rxcui_to_ingred,
+                          'keep_rxnorm_after_conversion': keep_rxnorm_after_conversion,
+                          'disregard_negation_when_adding_original_codes': disregard_negation_when_adding_original_codes}
+
+    def run_aggregate():
+        import AggregateReportsBySection
+        AggregateReportsBySection.main(work_dir, input_format=report_format, hash_features=hash_features,
+                                       **aggregate_settings)
+
+    def run_class_factorization():
+        import ClassFactorization
+        ClassFactorization.main(gold_csv=gold_csv, conversion_dict=gold_factorization, work_dir=work_dir)
+
+    def run_feature_elimination():
+        import FeatureElimination
+        FeatureElimination.main(work_dir=work_dir, model=model, set_of_classes=set(gold_factorization.values()),
+                                aggregate_settings=aggregate_settings,
+                                input_format='hashed' if hash_features else 'columns', gold_file=gold_multiclass)
+
+    def run_explanations():
+        import ShapExplanations
+        ShapExplanations.main(work_dir=work_dir, gold_file=gold_multiclass)
+
+    if hash_features:
+        from FeatureHashing import HASHED_FM_FILE, HASHED_INFO_FILE
+        feature_matrix_outputs = [work_dir / HASHED_FM_FILE, work_dir / HASHED_INFO_FILE]
+    else:
+        feature_matrix_outputs = [work_dir / 'section_fm', work_dir / '_feature_matrix_all_sections_.csv']
+
+    stages = [
+        PipelineStage('json_reader', run_json_reader,
+                      inputs=[data_dir],
+                      outputs=[work_dir / 'output', data / 'snomed_found.json', data / 'rxcui_found.json',
+                               data / 'RB_Section_Summary.txt'],
+                      params={'use_section_index': use_section_index, 'report_format': report_format}),
+        PipelineStage('rx_lookup', run_rx_lookup,
+                      inputs=[data / 'rxcui_found.json', data / 'rxcui_ingred_manual_entries.json'],
+                      outputs=[data / 'rxcui_ingredient.json', data / 'rxcui_ingredient_closure.npz',
+                               data / 'rxcui_atc.json'],
+                      params={'add_rxnorm_ATC': add_rxnorm_ATC}),
+        PipelineStage('aggregate', run_aggregate,
+                      inputs=[work_dir / 'output', data / 'rxcui_found.json', data / 'snomed_found.json',
+                              data / 'rxcui_ingredient.json', data / 'rxcui_ingredient_closure.npz',
+                              data / 'rxcui_atc.json', data / 'snomed_ancestor_inferred.json'],
+                      outputs=feature_matrix_outputs,
+                      params={'add_rxnorm_ATC': add_rxnorm_ATC, 'atc_levels': atc_levels,
+                              'add_snomed_ontology': add_snomed_ontology,
+                              'convert_rxcui_to_ingred': convert_rxcui_to_ingred,
+                              'keep_rxnorm_after_conversion': keep_rxnorm_after_conversion,
+                              'disregard_negation': disregard_negation_when_adding_original_codes,
+                              'report_format': report_format, 'hash_features': hash_features}),
+        PipelineStage('class_factorization', run_class_factorization,
+                      inputs=[gold_csv],
+                      outputs=[gold_multiclass],
+                      params={'gold_factorization': gold_factorization}),
+        PipelineStage('feature_elimination', run_feature_elimination,
+                      inputs=feature_matrix_outputs[:1] + [gold_multiclass,
+                              data / 'ML_model_settings' / 'ML_default_settings.json'],
+                      outputs=[work_dir / 'models' / 'top_features.json', work_dir / 'models' / 'registry'],
+                      params={'model': model, 'gold_factorization': gold_factorization}),
+    ]
+    if explain_models:
+        stages.append(PipelineStage('explanations', run_explanations,
+                                    inputs=feature_matrix_outputs[:1] + [gold_multiclass,
+                                                                         work_dir / 'models' / 'registry'],
+                                    outputs=[work_dir / 'models' / 'shap']))
+    if add_snomed_ontology:
+        stages.insert(1, PipelineStage('snomed_lookup', run_snomed_lookup,
+                                       inputs=[data / 'snomed_found.json'],
+                                       outputs=[data / 'snomed_parents_inferred.json',
+                                                data / 'snomed_ancestor_inferred.json'],
+                                       params={'depth': snomed_ontology_ancestor_lookup_depth}))
+    if stream_ontology_lookups:
+        # reader and lookups become a single stage with the inputs and outputs of all three
+        merged = [stage for stage in stages if stage.name in ('json_reader', 'snomed_lookup', 'rx_lookup')]
+        produced = {output for stage in merged for output in stage.outputs}
+        inputs = [x for stage in merged for x in stage.inputs if x not in produced]
+        outputs = [x for stage in merged for x in stage.outputs]
+        params = {'add_snomed_ontology': add_snomed_ontology, 'depth': snomed_ontology_ancestor_lookup_depth,
+                  'add_rxnorm_ATC': add_rxnorm_ATC, 'use_section_index': use_section_index,
+                  'report_format': report_format}
+        stages = [PipelineStage('ingest_and_lookup', run_streaming_reader, inputs, outputs, params)] + \
+                 [stage for stage in stages if stage not in merged]
+    return link_stages(stages)
+
+
+def run_stages(stages, state_file, force=(), max_workers=2):
+    """Runs the stages in dependency order, concurrently where possible.
+
+    :return: dictionary of stage name to {'status', 'seconds'} for this run
+    """
+    state = load_dict_json(state_file, create_local_if_not_found=True)
+    by_name = {stage.name: stage for stage in stages}
+    results = {}
+    done = set()    # completed or skipped
+    failed = set()
+    running = {}
+
+    def start(stage):
+        fingerprint = stage.fingerprint()
+        previous = state.get(stage.name, {})
+        if stage.name not in force and previous.get('fingerprint') == fingerprint and stage.outputs_exist():
+            logging.info("Skipping stage (inputs unchanged): " + stage.name)
+            results[stage.name] = {'status': 'skipped', 'seconds': 0.0}
+            return None
+        logging.info("Starting stage: " + stage.name)
+        return executor.submit(timed_call, stage.func)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(done) + len(failed) < len(stages):
+            progress = False
+            for stage in stages:
+                if stage.name in done or stage.name in failed or stage.name in running.values():
+                    continue
+                if stage.depends_on & failed:
+                    logging.error("Stage not run because a dependency failed: " + stage.name)
+                    results[stage.name] = {'status': 'not run', 'seconds': 0.0}
+                    failed.add(stage.name)
+                    progress = True
+                elif stage.depends_on <= done:
+                    future = start(stage)
+                    if future is None:
+                        done.add(stage.name)
+                    else:
+                        running[future] = stage.name
+                    progress = True
+            if progress:
+                continue
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                seconds, error = future.result()
+                if error is None:
+                    # fingerprint is taken after the run so outputs of earlier stages are included
+                    state[name] = {'fingerprint': by_name[name].fingerprint(), 'seconds': seconds,
+                                   'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+                    save_to_json(state, state_file, indent=4)
+                    results[name] = {'status': 'completed', 'seconds': seconds}
+                    done.add(name)
+                    logging.info("Finished stage: %s (%.2f s)" % (name, seconds))
+                else:
+                    results[name] = {'status': 'failed', 'seconds': seconds, 'error': repr(error)}
+                    failed.add(name)
+                    logging.error("Stage failed: %s (%s)" % (name, repr(error)))
+    return results
+
+
+def timed_call(func):
+    start = time.perf_counter()
+    try:
+        func()
+    except BaseException as e:  # SystemExit from the stage scripts should not stop the other stages
+        logging.exception(e)
+        return time.perf_counter() - start, e
+    return time.perf_counter() - start, None
+
+
+def run_pipeline(data_dir, work_dir, gold_csv, only=None, force=(), max_workers=2):
+    work_dir = Path(work_dir)
+    (work_dir / 'data').mkdir(parents=True, exist_ok=True)
+
+    try:
+        shutil.copytree('./data', work_dir / 'data', dirs_exist_ok=True)
+    except Exception:
+        pass
+
+    import MLDataProcessing
+    MLDataProcessing.save_default_ML_params(work_dir=work_dir)
+
+    stages = build_stages(data_dir, work_dir, gold_csv)
+    if only:
+        stages = [stage for stage in stages if stage.name in only]
+        names = {stage.name for stage in stages}
+        for stage in stages:
+            stage.depends_on &= names
+
+    metrics = reset_metrics('pipeline')
+    start = time.perf_counter()
+    results = run_stages(stages, work_dir / 'data' / STATE_FILE, force=set(force), max_workers=max_workers)
+    total = time.perf_counter() - start
+
+    save_to_json({'stages': results, 'total_seconds': total}, work_dir / 'data' / TIMINGS_FILE, indent=4)
+    logging.info("%-22s %10s %10s" % ('stage', 'status', 'seconds'))
+    for stage in stages:
+        result = results.get(stage.name, {'status': 'not run', 'seconds': 0.0})
+        logging.info("%-22s %10s %10.2f" % (stage.name, result['status'], result['seconds']))
+    logging.info("Total: %.2f s" % total)
+
+    for name, result in results.items():
+        metrics.count('stages_' + result['status'].replace(' ', '_'))
+        metrics.count(name + '_seconds', result['seconds'])
+    emit_metrics('pipeline', work_dir)
+    return results
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Run the FHIR2ML pipeline without the GUI.")
+    parser.add_argument('--data-dir', required=True, help="FHIR JSON Resource Bundle directory")
+    parser.add_argument('--work-dir', required=True, help="Output or working directory")
+    parser.add_argument('--gold-csv', required=True, help="Gold standard csv")
+    parser.add_argument('--stages', nargs='*', help="Only run these stages")
+    parser.add_argument('--force', nargs='*', default=[], help="Run these stages even if their inputs are unchanged")
+    parser.add_argument('--jobs', type=int, default=2, help="Maximum number of stages run at the same time")
+    parser.add_argument('--gold-factorization', default=str(gold_factorization))
+    parser.add_argument('--snomed-depth', type=int, default=snomed_ontology_ancestor_lookup_depth)
+    parser.add_argument('--no-snomed-ontology', action='store_true')
+    parser.add_argument('--no-atc', action='store_true')
+    parser.add_argument('--atc-levels', type=int, nargs='+', choices=[1, 2, 3, 4],
+                        help="Only add the ATC classes of these levels (default: all)")
+    parser.add_argument('--no-ingredients', action='store_true')
+    parser.add_argument('--drop-rxnorm-after-conversion', action='store_true')
+    parser.add_argument('--model', default=model)
+    parser.add_argument('--stream-lookups', action='store_true',
+                        help="Run the ontology lookups while the bundles are being read")
+    parser.add_argument('--section-index', action='store_true',
+                        help="Classify sections without a Lion-C code using the section index file")
+    parser.add_argument('--report-table', action='store_true',
+                        help="Write the per report codes to a single report table instead of one file per report")
+    parser.add_argument('--hash-features', type=int, default=hash_features,
+                        help="Hash the codes into this many feature columns instead of one column per code")
+    parser.add_argument('--explain', action='store_true',
+                        help="Compute SHAP explanations of the trained models (requires shap)")
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    add_snomed_ontology = not args.no_snomed_ontology
+    snomed_ontology_ancestor_lookup_depth = args.snomed_depth
+    add_rxnorm_ATC = not args.no_atc
+    atc_levels = args.atc_levels
+    convert_rxcui_to_ingred = not args.no_ingredients
+    keep_rxnorm_after_conversion = not args.drop_rxnorm_after_conversion
+    gold_factorization = ast.literal_eval(args.gold_factorization)
+    model = args.model
+    stream_ontology_lookups = args.stream_lookups
+    use_section_index = args.section_index
+    report_format = 'table' if args.report_table else 'txt'
+    hash_features = args.hash_features
+    explain_models = args.explain
+
+    log_settings(filename="RunPipeline.log")
+    run_pipeline(args.data_dir, args.work_dir, args.gold_csv, only=args.stages, force=args.force,
+                 max_workers=args.jobs)
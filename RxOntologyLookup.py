@@ -17,11 +17,12 @@ Disclaimer:  This product uses publicly available data from the U.S. National Li
 
 
 from re import split
-import requests
 import xml.etree.ElementTree
 import time
+from Instrumentation import get_metrics, reset_metrics, emit_metrics, profile_stage
 from MLDataProcessing import save_to_json, load_dict_json, load_dict_pickle, pickle_something
-from collections import defaultdict
+from IngredientClosure import IngredientClosure
+from OntologyBackend import get_backend, split_cached, groups
 import operator
 from pathlib import Path
 
@@ -31,15 +32,18 @@ cache_cui_to_atc = {}
 manual_ingredient_entries = {}
 rxnorm_blank_search_results = []
 
+@profile_stage('rx_lookup')
 def main(working_dir, find_ingreds = True, find_ATC = True, output_ATC_count=False):
     print("Starting RxNorm code lookup")
+    metrics = reset_metrics('rx_lookup')
     working_dir = Path(working_dir)
     print("Loading Data from: " + str(working_dir))
 
-    global cache_cui_to_ingredients, cache_cui_to_atc, manual_ingredient_entries
+    global cache_cui_to_ingredients, cache_cui_to_atc, manual_ingredient_entries, ingredients_name
     rxnorm_savefile = working_dir / 'data' / 'rxcui_found.json'
     save_atc_file = working_dir / 'data' / 'rxcui_atc.json'
     ingredient_dict_file = working_dir / 'data' / 'rxcui_ingredient.json'
+    closure_file = working_dir / 'data' / 'rxcui_ingredient_closure.npz'
     manual_ingredient_entries_file = working_dir / 'data' / 'rxcui_ingred_manual_entries.json'
     ingredients_name_file = working_dir / 'data' / "rxcui_ingredient_names.json"
     rxcui_name_file = working_dir / 'data' / "rxcui_names.json"
@@ -71,13 +75,12 @@ def main(working_dir, find_ingreds = True, find_ATC = True, output_ATC_count=Fal
 
     if find_ingreds:
         count = 0
-        for rxcui in rxcui_to_lookup.keys():
-            rxcui_to_ingredients[rxcui] = get_rxnorm_ingredients(rxcui)
-            count += 1
-            if count % 100 == 0 or count ==len(rxcui_to_lookup):
-                save_to_json(rxcui_to_ingredients, ingredient_dict_file, indent=4)
-                save_to_json(ingredients_name, ingredients_name_file, indent=4)
-                print("Stage 1/4: Ingredients Lookup: ", count, "/", len(rxcui_to_lookup), " entries processed.")
+        for group in groups(list(rxcui_to_lookup.keys())):
+            rxcui_to_ingredients.update(get_rxnorm_ingredients_batch(group))
+            count += len(group)
+            save_to_json(rxcui_to_ingredients, ingredient_dict_file, indent=4)
+            save_to_json(ingredients_name, ingredients_name_file, indent=4)
+            print("Stage 1/4: Ingredients Lookup: ", count, "/", len(rxcui_to_lookup), " entries processed.")
 
 
         # try to look up missing entries because sometimes rxcui get retired
@@ -103,53 +106,55 @@ def main(working_dir, find_ingreds = True, find_ATC = True, output_ATC_count=Fal
 
 
 
-    # try to find ingredients from original ingredients
-    for rxcui, ingredients in rxcui_to_ingredients.items():
-        new_ingredients = []
-        for ingredient in ingredients:
-            new_ingredients = new_ingredients + get_rxnorm_ingredients(ingredient)
-        rxcui_to_ingredients[rxcui] = list(set(ingredients + new_ingredients))
+    # resolve the ingredients of the ingredients to a fixed point (brand -> clinical drug -> ingredients), only the
+    # rxcuis new since the last run or with changed lookups are resolved again
+    if find_ingreds:
+        closure = IngredientClosure.build(rxcui_to_ingredients, lookup=get_rxnorm_ingredients_batch,
+                                          previous=IngredientClosure.load(closure_file))
+        metrics.count('closure_resolved', closure.n_resolved)
+        metrics.count('closure_reused', closure.n_reused)
+        rxcui_to_ingredients = {rxcui: list(closure.get(rxcui, ingredients))
+                                for rxcui, ingredients in rxcui_to_ingredients.items()}
 
 
     #find ATC codes
     if find_ATC:
         count = 0
-        for code, ingredients in rxcui_to_ingredients.items():
-            ATC = get_rxnorm_ATC(code)
-
-            if not ATC:
-                for ingredient in ingredients:
-                    ATC = ATC + get_rxnorm_ATC(ingredient)
-
-            if ATC:
-                rxcui_to_atc[code] = list(set(ATC))
-            else:
-                print("ATC could not be found for ", code, '(%d/%d)' % (count, len(rxcui_to_ingredients)))
-            count += 1
-            if count % 100 == 0 or count ==len(rxcui_to_ingredients):
-                save_to_json(rxcui_to_atc, save_atc_file, indent=4)
-                print("Stage 4/4: ATC: ", count, "/", len(rxcui_to_ingredients), " entries processed.")
+        for group in groups(list(rxcui_to_ingredients.keys())):
+            group_atc = get_rxnorm_ATC_batch(group)
+            # rxcuis without ATC classes take the classes of their ingredients
+            ingredient_atc = get_rxnorm_ATC_batch(ingredient for code in group if not group_atc[code]
+                                                  for ingredient in rxcui_to_ingredients[code])
+            for code in group:
+                ATC = group_atc[code] or [atc for ingredient in rxcui_to_ingredients[code]
+                                          for atc in ingredient_atc[ingredient]]
+                if ATC:
+                    rxcui_to_atc[code] = list(dict.fromkeys(ATC))
+                else:
+                    print("ATC could not be found for ", code, '(%d/%d)' % (count, len(rxcui_to_ingredients)))
+                count += 1
+            save_to_json(rxcui_to_atc, save_atc_file, indent=4)
+            print("Stage 4/4: ATC: ", count, "/", len(rxcui_to_ingredients), " entries processed.")
 
 
     #save data
     if find_ingreds:
         save_to_json(rxcui_to_ingredients, ingredient_dict_file,indent=4, print_save_loc=True)
+        closure.save(closure_file)      # after the json: aggregation uses the closure unless the json is more recent
         save_to_json(ingredients_name, ingredients_name_file, indent=4, print_save_loc=True)
     if find_ATC:
         save_to_json(rxcui_to_atc, save_atc_file, indent=4, print_save_loc=True)
+    metrics.count('rxcui', len(rxcui_to_lookup))
+    emit_metrics('rx_lookup', working_dir)
 
     count = 0
     new_count = 0
     keys_to_del = []
 
     if output_ATC_count:
-        ATC_struct = defaultdict(int)
-        for key, ATCs in rxcui_to_atc.items():
-            if not ATCs:
-                continue
-            for ATC in ATCs:
-                for subcode in [ATC[0:1], ATC[0:3], ATC[0:4], ATC[0:5]]:
-                    ATC_struct[subcode] += 1
+        # number of rxcui in each ATC class (levels 1-4), each rxcui counted once per class
+        from AtcHierarchy import AtcHierarchy
+        ATC_struct = AtcHierarchy(rxcui_to_atc).class_counts()
 
         ATC_struct = sorted(ATC_struct.items(), key=operator.itemgetter(1), reverse=True)
         print("ATC count:")
@@ -204,18 +209,12 @@ def get_rxnorm_ingredients_using_multisearch(term_to_search:str):
 def get_rxnorm_ingredients_using_search(term_to_search:str):
     global rxnorm_blank_search_results
     if term_to_search in rxnorm_blank_search_results:
+        get_metrics('rx_lookup').count('search_cache_hits')
         return []
-    results = []
-    search_results = list(query_rxnorm_ingredients_using_search(term_to_search))
-    set_of_done = set()
-
-    if search_results:
-        for one_result in search_results:
-            code = one_result[0]
-            if code in set_of_done:
-                continue
-            set_of_done.add(code)
-            results = results + get_rxnorm_ingredients(str(code))
+    get_metrics('rx_lookup').count('search_cache_misses')
+    search_results = [str(code) for code in get_backend().rxnorm_search([term_to_search])[term_to_search]]
+    found = get_rxnorm_ingredients_batch(search_results)
+    results = [ingredient for code in found for ingredient in found[code]]
 
     if not results:
         rxnorm_blank_search_results.append(term_to_search)
@@ -223,9 +222,11 @@ def get_rxnorm_ingredients_using_search(term_to_search:str):
 
 
 def query_rxnorm_ingredients_using_search(term):
+    get_metrics('rx_lookup').count('lookups')
     time.sleep(0.05)
     base_uri = 'http://rxnav.nlm.nih.gov/REST'
     url = '{base_uri}/approximateTerm?term={term}&maxEntries=4'.format(base_uri=base_uri, term=term)
+    import requests    # only needed for the web queries, not to use the cached results
     response = requests.get(url)
     tree = xml.etree.ElementTree.fromstring(response.text)
     xml_ingredients = tree.findall("./approximateGroup/candidate")
@@ -234,10 +235,12 @@ def query_rxnorm_ingredients_using_search(term):
 
 
 def query_rxnorm_name(rxcui):
+    get_metrics('rx_lookup').count('lookups')
     time.sleep(0.05) #Limit API requests to max of 20/s
 
     base_uri = 'http://rxnav.nlm.nih.gov/REST'
     url = '{base_uri}/rxcui/{rxcui}/'.format(base_uri = base_uri, rxcui = rxcui)
+    import requests    # only needed for the web queries, not to use the cached results
     response = requests.get(url)
     tree = xml.etree.ElementTree.fromstring(response.text)
     for name_ in tree.findall("./idGroup/name"):
@@ -246,27 +249,35 @@ def query_rxnorm_name(rxcui):
 
 
 def get_rxnorm_ingredients(rxcui):
-    global cache_cui_to_ingredients, ingredients_name, manual_ingredient_entries
-    if rxcui in cache_cui_to_ingredients:
-        return cache_cui_to_ingredients[rxcui]
-    if rxcui in manual_ingredient_entries:
-        return manual_ingredient_entries[rxcui]
+    return get_rxnorm_ingredients_batch([rxcui])[rxcui]
+
 
-    ingredients = list(query_rxnorm_ingredients(rxcui))
-    ingredients_list = []
-    if ingredients:
-        for x in ingredients:
-            ingredients_list.append(x[0])
-            ingredients_name[x[0]] = x[1]
-    cache_cui_to_ingredients[rxcui] = ingredients_list
-    return ingredients_list
+# {rxcui: [ingredient rxcui]} for an iterable of rxcuis, only the (deduplicated) cache misses go to the backend
+def get_rxnorm_ingredients_batch(rxcuis):
+    global cache_cui_to_ingredients, ingredients_name, manual_ingredient_entries
+    metrics = get_metrics('rx_lookup')
+    rxcuis = list(rxcuis)
+    found, misses = split_cached(rxcuis, cache_cui_to_ingredients, manual_ingredient_entries)
+    metrics.count('ingredient_cache_hits', len(found))
+    metrics.count('ingredient_cache_misses', len(misses))
+
+    for group in groups(misses):
+        for rxcui, ingredients in get_backend().rxnorm_ingredients(group).items():
+            ingredients_list = []
+            for ingredient, name in ingredients:
+                ingredients_list.append(ingredient)
+                ingredients_name[ingredient] = name
+            cache_cui_to_ingredients[rxcui] = found[rxcui] = ingredients_list
+    return {rxcui: found[rxcui] for rxcui in rxcuis}
 
 
 def query_rxnorm_ingredients(rxcui):
+    get_metrics('rx_lookup').count('lookups')
     time.sleep(0.05) #Limit API requests to max of 20/s
 
     base_uri = 'http://rxnav.nlm.nih.gov/REST'
     url = '{base_uri}/rxcui/{rxcui}/related?tty=IN'.format(base_uri = base_uri, rxcui = rxcui)
+    import requests    # only needed for the web queries, not to use the cached results
     response = requests.get(url)
     tree = xml.etree.ElementTree.fromstring(response.text)
     xml_ingredients = tree.findall("./allRelatedGroup/conceptGroup[tty='IN']/conceptProperties")
@@ -280,24 +291,31 @@ def query_rxnorm_ingredients(rxcui):
 
 
 def get_rxnorm_ATC(rxcui):
+    return get_rxnorm_ATC_batch([rxcui])[rxcui]
+
+
+# {rxcui: [ATC class]} for an iterable of rxcuis, only the (deduplicated) cache misses go to the backend
+def get_rxnorm_ATC_batch(rxcuis):
     global cache_cui_to_atc
-    if rxcui in cache_cui_to_atc:
-        return cache_cui_to_atc[rxcui]
+    metrics = get_metrics('rx_lookup')
+    rxcuis = list(rxcuis)
+    found, misses = split_cached(rxcuis, cache_cui_to_atc)
+    metrics.count('atc_cache_hits', len(found))
+    metrics.count('atc_cache_misses', len(misses))
 
-    ATCs = list(query_rxnorm_ATC(rxcui))
-    atc_list = []
-    if ATCs:
-        for atc in ATCs:
-            atc_list.append(atc[0])
-    cache_cui_to_atc[rxcui] = atc_list
-    return atc_list
+    for group in groups(misses):
+        for rxcui, atc_list in get_backend().rxnorm_atc(group).items():
+            cache_cui_to_atc[rxcui] = found[rxcui] = list(atc_list)
+    return {rxcui: found[rxcui] for rxcui in rxcuis}
 
 
 def query_rxnorm_ATC(rxcui):
+    get_metrics('rx_lookup').count('lookups')
     time.sleep(0.05)    #limit requests under 20 requests/s
 
     base_uri = 'https://rxnav.nlm.nih.gov/REST'
     url = '{base_uri}/rxclass/class/byRxcui?rxcui={rxcui}&relaSource=ATC'.format(base_uri = base_uri, rxcui = rxcui)
+    import requests    # only needed for the web queries, not to use the cached results
     response = requests.get(url)
     tree = xml.etree.ElementTree.fromstring(response.text)
     xml_ATC = tree.findall("./rxclassDrugInfoList/rxclassDrugInfo/rxclassMinConceptItem[classType='ATC1-4']")
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""ScoringService.py
+
+Long running local HTTP service scoring one FHIR bundle at a time with the models of a ModelRegistry.
+
+Everything needed to score is loaded once and kept in memory: the registry models (memory mapped), the ontology
+tables of the training working directory (used to expand the codes as AggregateReportsBySection does) and the
+section index.  A request only runs JsonBasedReader.read_bundle, expand_report_codes on the codes found and the
+models' predict on the selected columns.
+
+    POST /score    body: one FHIR JSON Resource Bundle
+                   reply: {"predictions": {task: class}, "codes": number of codes found, "elapsed_ms": ...}
+    GET  /health   reply: {"status": "ok", "tasks": [...]}
+
+bench starts the service in process and sends the bundles of a directory (or corpus pack) from several concurrent
+clients, reporting the p50/p90/p99 latencies and the throughput.
+
+Example:
+    python ScoringService.py serve <registry dir> <training work dir> [--port 8500]
+    python ScoringService.py bench <registry dir> <training work dir> <bundle dir> [--clients 8] [--requests 2000]
+"""
+
+
+import http.client
+import json
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from MLDataProcessing import log_settings
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8500
+
+
+class WarmScorer():
+    """In memory state of the service, score(bundle) is thread safe."""
+    def __init__(self, registry_dir, work_dir, use_section_index=False):
+        from AggregateReportsBySection import OntologyTables
+        from ModelRegistry import ModelRegistry, FeatureBuilder
+        from SectionDetection import load_section_index
+
+        registry = ModelRegistry(registry_dir)
+        self.models = registry.load_all()
+        self.builder = FeatureBuilder(self.models, OntologyTables.load(work_dir), registry.aggregate_settings,
+                                      registry.hashing)
+        self.section_index = load_section_index() if use_section_index else None
+        logging.info("Scorer ready: %d models, %d features" % (len(self.models), len(self.builder.columns)))
+
+    @property
+    def tasks(self):
+        return list(self.models)
+
+    def score(self, bundle):
+        """bundle: FHIR bundle as a json dict, returns ({task: predicted class}, number of codes found)"""
+        from JsonBasedReader import read_bundle
+
+        codes = read_bundle(bundle, section_index=self.section_index)
+        _, values = self.builder.build([(0, codes.rows())])
+        predictions = self.builder.predict(values)
+        return {task: predicted[0].item() for task, predicted in predictions.items()}, codes.codes
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    scorer = None
+    protocol_version = 'HTTP/1.1'   # keep alive, clients reuse their connection
+    disable_nagle_algorithm = True  # headers and body are separate writes, do not wait for the delayed ack
+
+    def _reply(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {'status': 'ok', 'tasks': self.scorer.tasks})
+        else:
+            self._reply(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._reply(404, {'error': 'unknown path ' + self.path})
+            return
+        start = time.perf_counter()
+        try:
+            bundle = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            predictions, n_codes = self.scorer.score(bundle)
+        except (ValueError, KeyError, TypeError, IndexError) as err:
+            self._reply(400, {'error': 'could not score bundle: ' + repr(err)})
+            return
+        self._reply(200, {'predictions': predictions, 'codes': n_codes,
+                          'elapsed_ms': (time.perf_counter() - start) * 1000})
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def make_server(scorer, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    handler = type('Handler', (ScoringHandler,), {'scorer': scorer})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(registry_dir, work_dir, host=DEFAULT_HOST, port=DEFAULT_PORT, use_section_index=False):
+    server = make_server(WarmScorer(registry_dir, work_dir, use_section_index), host, port)
+    print("Scoring service listening on http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def percentile(sorted_values, p):
+    """Nearest rank percentile of an ascending list."""
+    if not sorted_values:
+        return float('nan')
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def load_test(host, port, payloads, clients=8, requests=1000):
+    """Sends requests POST /score from clients concurrent connections (payloads used round robin), returns the
+    latency statistics in ms and the throughput."""
+    counter = iter(range(requests))
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def client():
+        connection = http.client.HTTPConnection(host, port)
+        own = []
+        while True:
+            with lock:
+                k = next(counter, None)
+            if k is None:
+                break
+            payload = payloads[k % len(payloads)]
+            start = time.perf_counter()
+            connection.request('POST', '/score', body=payload, headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            own.append((time.perf_counter() - start) * 1000)
+            if response.status != 200:
+                errors.append(response.status)
+        connection.close()
+        with lock:
+            latencies.extend(own)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        for future in [executor.submit(client) for _ in range(clients)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {'requests': len(latencies), 'clients': clients, 'errors': len(errors),
+            'p50_ms': percentile(latencies, 50), 'p90_ms': percentile(latencies, 90),
+            'p99_ms': percentile(latencies, 99), 'max_ms': latencies[-1] if latencies else float('nan'),
+            'requests_per_s': len(latencies) / elapsed}
+
+
+def bench(registry_dir, work_dir, data_dir, clients=(1, 8), requests=1000, use_section_index=False):
+    """Starts the service on a free port and load tests it with the bundles of data_dir for each client count."""
+    from JsonBasedReader import iter_bundles
+
+    payloads = [json.dumps(bundle).encode('utf-8') for _, _, bundle in iter_bundles(data_dir)]
+    if not payloads:
+        raise ValueError("No bundles found in: " + str(data_dir))
+    server = make_server(WarmScorer(registry_dir, work_dir, use_section_index), port=0)
+    host, port = server.server_address[:2]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    results = []
+    try:
+        load_test(host, port, payloads, clients=1, requests=min(len(payloads), 50))    # warm up
+        for n_clients in clients:
+            result = load_test(host, port, payloads, clients=n_clients, requests=requests)
+            results.append(result)
+            print("clients %3d: p50 %7.2f ms  p90 %7.2f ms  p99 %7.2f ms  max %7.2f ms  %8.1f req/s  errors %d" % (
+                n_clients, result['p50_ms'], result['p90_ms'], result['p99_ms'], result['max_ms'],
+                result['requests_per_s'], result['errors']))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Score single FHIR bundles with the models of a ModelRegistry")
+    parser.add_argument('command', choices=['serve', 'bench'])
+    parser.add_argument('registry_dir')
+    parser.add_argument('work_dir', help="working directory of the training run (ontology lookup outputs)")
+    parser.add_argument('data_dir', nargs='?', help="bundles sent by bench (directory or corpus pack)")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--section-index', action='store_true')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    log_settings(filename="ScoringService.log")
+    if args.command == 'serve':
+        serve(args.registry_dir, args.work_dir, args.host, args.port, args.section_index)
+    else:
+        if args.data_dir is None or not Path(args.data_dir).exists():
+            parser.error("bench needs the directory (or corpus pack) of bundles to send")
+        bench(args.registry_dir, args.work_dir, args.data_dir, args.clients, args.requests, args.section_index)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""SectionDetection.py
+
+Detects Lion-C section headers using the section index file (SECTIONS_Index_V9.csv).
+
+The index (header synonym <tab> Lion-C code, 'x' for headers to ignore) is compiled into a trie over normalized
+tokens (lower case, split on anything that is not a letter or digit), so 'PAST MEDICAL HISTORY:' and
+'past_medical history' are the same header.  find_headers labels the headers of a raw note in one linear pass: the
+tokens at each line start are matched against the trie (longest match, at most the length of the longest synonym),
+and a match is accepted as a header when it is followed by ':' or the end of the line.
+
+classify(title) gives the code for a single section title, and is used by JsonBasedReader when a section has no valid
+Lion-C code.  SectionSpanIndex finds the section containing a text position, which JsonBasedReader uses to place
+resources that are not referenced by any section.
+
+Run with --benchmark to measure throughput on large synthetic notes.
+"""
+
+
+import logging
+import random
+import re
+import time
+from bisect import bisect_right
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+
+SECTION_INDEX_FILE = Path(__file__).parent / 'SECTIONS_Index_V9.csv'
+IGNORE_CODE = 'x'
+
+re_token = re.compile(r'[a-z0-9]+')
+re_token_and_separator = re.compile(r'([a-z0-9]+)[^a-z0-9\r\n]*')
+re_line_start = re.compile(r'^[ \t]*(?=[a-z0-9])', re.MULTILINE)
+
+SectionHeader = namedtuple('SectionHeader', ['start', 'end', 'title', 'code'])
+
+_CODE = ''  # key used to store the code in a trie node (tokens are never empty)
+
+
+def normalize_tokens(text):
+    return re_token.findall(text.lower())
+
+
+class SectionIndex():
+    def __init__(self, synonyms=()):
+        self.trie = {}
+        self.max_tokens = 0
+        self.conflicts = 0
+        for header, code in synonyms:
+            self.add(header, code)
+
+    @classmethod
+    def from_csv(cls, filename=SECTION_INDEX_FILE):
+        synonyms = []
+        with open(filename, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                line = line.strip('\r\n')
+                if not line:
+                    continue
+                header, _, code = line.partition('\t')
+                synonyms.append((header, code.strip()))
+        index = cls(synonyms)
+        if index.conflicts:
+            logging.info("%d section synonyms with more than one code in %s, first code kept"
+                         % (index.conflicts, str(filename)))
+        return index
+
+    def add(self, header, code):
+        tokens = normalize_tokens(header)
+        if not tokens:
+            return
+        node = self.trie
+        for token in tokens:
+            node = node.setdefault(token, {})
+        if _CODE in node:
+            if node[_CODE] != code:
+                self.conflicts += 1
+            return
+        node[_CODE] = code
+        self.max_tokens = max(self.max_tokens, len(tokens))
+
+    def classify(self, title):
+        """Returns the code for a section title ('x' for ignored headers), None if the title is not in the index."""
+        node = self.trie
+        for token in normalize_tokens(title):
+            if token not in node:
+                return None
+            node = node[token]
+        return node.get(_CODE)
+
+    def find_headers(self, text, include_ignored=False):
+        """Finds the section headers in a raw note in one pass.
+
+        :return: list of SectionHeader(start, end, title, code) in order of appearance
+        """
+        lowered = text.lower()
+        if len(lowered) != len(text):  # keep offsets aligned when lower() changes the length of a character
+            lowered = ''.join(c.lower()[0] for c in text)
+        headers = []
+        for line_start in re_line_start.finditer(lowered):
+            start = line_start.end()
+            node = self.trie
+            match = None
+            pos = start
+            for _ in range(self.max_tokens):
+                token = re_token_and_separator.match(lowered, pos)
+                if token is None:
+                    break
+                node = node.get(token.group(1))
+                if node is None:
+                    break
+                if _CODE in node and _ends_header(lowered, token.end(1)):
+                    match = (token.end(1), node[_CODE])
+                pos = token.end()
+
+            if match is not None and (match[1] != IGNORE_CODE or include_ignored):
+                headers.append(SectionHeader(start, match[0], text[start:match[0]], match[1]))
+        return headers
+
+    def section_spans(self, text, include_ignored=False):
+        """Splits a note into sections, each running from its header to the next header.
+
+        :return: list of (start, end, code)
+        """
+        headers = self.find_headers(text, include_ignored=True)
+        spans = []
+        for k, header in enumerate(headers):
+            end = headers[k + 1].start if k + 1 < len(headers) else len(text)
+            if header.code != IGNORE_CODE or include_ignored:
+                spans.append((header.start, end, header.code))
+        return spans
+
+
+class SectionSpanIndex():
+    """Finds the section containing a text position in O(log n) using bisect over the sorted span starts.
+
+    Spans are (start, end, code) with end exclusive and are expected not to overlap.
+    """
+    def __init__(self, spans):
+        spans = sorted(spans)
+        self.starts = [span[0] for span in spans]
+        self.ends = [span[1] for span in spans]
+        self.codes = [span[2] for span in spans]
+
+    def find(self, position):
+        i = bisect_right(self.starts, position) - 1
+        if i >= 0 and position < self.ends[i]:
+            return self.codes[i]
+        return None
+
+    def __len__(self):
+        return len(self.starts)
+
+
+def _ends_header(text, pos):
+    k = pos
+    while k < len(text) and text[k] in ' \t':
+        k += 1
+    return k >= len(text) or text[k] in ':\r\n'
+
+
+@lru_cache(maxsize=None)
+def load_section_index(filename=SECTION_INDEX_FILE):
+    return SectionIndex.from_csv(filename)
+
+
+def synthetic_note(index_file=SECTION_INDEX_FILE, n_chars=100000, seed=0):
+    rng = random.Random(seed)
+    with open(index_file, 'r', encoding='utf-8') as fp:
+        headers = [line.split('\t')[0] for line in fp if line.strip()]
+    words = ['patient', 'reports', 'denies', 'history', 'of', 'pain', 'mg', 'daily', 'obesity', 'with', 'no',
+             'diabetes', 'hypertension', 'noted', 'today', 'stable', 'follow', 'up', 'in', 'weeks']
+    parts = []
+    size = 0
+    while size < n_chars:
+        header = rng.choice(headers)
+        if rng.random() < 0.5:
+            header = header.upper()
+        body = ' '.join(rng.choice(words) for _ in range(rng.randint(20, 120)))
+        parts.append(header + ':\n' + body + '\n')
+        size += len(parts[-1])
+    return ''.join(parts)
+
+
+def benchmark(n_notes=20, note_chars=500000):
+    index = SectionIndex.from_csv()
+    notes = [synthetic_note(n_chars=note_chars, seed=i) for i in range(n_notes)]
+    n_bytes = sum(len(note) for note in notes)
+
+    start = time.perf_counter()
+    n_headers = sum(len(index.find_headers(note)) for note in notes)
+    elapsed = time.perf_counter() - start
+
+    print("%d notes, %.1f MB, %d headers found" % (n_notes, n_bytes / 1e6, n_headers))
+    print("%.3f s, %.2f MB/s, %.0f headers/s" % (elapsed, n_bytes / 1e6 / elapsed, n_headers / elapsed))
+    return elapsed
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == '--benchmark':
+        benchmark()
+    else:
+        note = open(sys.argv[1], 'r', encoding='utf-8').read() if len(sys.argv) > 1 else input("Enter note text: ")
+        for section in load_section_index().find_headers(note):
+            print(section)
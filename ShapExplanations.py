@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""ShapExplanations.py
+
+SHAP explanations of the models saved by FeatureElimination (ModelRegistry), the graphs linked from the README.
+
+For each task the selected features of the test reports (or all reports) are read, normalized as for training and
+explained with shap's exact TreeExplainer (tree path dependent) for dt/rf/gb, or LinearExplainer for lr with the mean
+of the normalized training reports as background (one baseline per task, shared by all the chunks).  The
+feature matrices stay sparse until only the selected columns of a task are left, these are densified in chunks of
+chunk_size reports (shap's tree explainer only takes dense input).  Chunks of all the tasks are explained in
+parallel on a process pool, each worker loads the task models from the registry (memory mapped).
+
+Multi-class GradientBoostingClassifier, not supported by TreeExplainer, is explained tree by tree: the SHAP values
+of class k are learning_rate times the sum of those of its regression trees (log odds, as for binary GB).  Tree
+models other than GB explain the predicted probabilities.
+
+Outputs (work_dir/models/shap):
+    <task>.npz          shap_values (reports x features x classes, float32), base_values, classes, features,
+                        report_ids, predicted, global_importance (mean |SHAP| per feature), top_features /
+                        top_values (per report, the top_k features of the predicted class by |SHAP|)
+    summary.json        global importance of the features of every task
+    shap_summary.html   global importances and per report top contributors of every task
+
+Requires the shap package (pip install shap).
+
+Example:
+    python ShapExplanations.py <work dir> [--all-reports] [--top-k 10]
+"""
+
+
+import html
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from MLDataProcessing import save_to_json, log_settings
+from ModelRegistry import ModelRegistry, REGISTRY_DIR, normalize, _task_dir_name
+
+SHAP_DIR = Path('models') / 'shap'
+TREE_MODELS = ('DecisionTreeClassifier', 'RandomForestClassifier', 'ExtraTreesClassifier',
+               'GradientBoostingClassifier')
+
+
+def _import_shap():
+    try:
+        import shap
+    except ImportError:
+        raise ImportError("ShapExplanations requires the shap package: pip install shap")
+    return shap
+
+
+def _as_3d(values, n_classes):
+    """shap output (list per class, 2d for a single output, or 3d) -> reports x features x classes"""
+    import numpy as np
+    if isinstance(values, list):
+        values = np.stack(values, axis=-1)
+    values = np.asarray(values)
+    if values.ndim == 2:
+        # single output (binary GB log odds, binary linear model): score of the second class
+        values = np.stack([-values, values], axis=-1) if n_classes == 2 else values[:, :, None]
+    return values
+
+
+def _as_1d(base_values, n_classes):
+    import numpy as np
+    base_values = np.atleast_1d(np.asarray(base_values, dtype=float))
+    if len(base_values) == 1 and n_classes == 2:
+        base_values = np.array([-base_values[0], base_values[0]])
+    return base_values
+
+
+def make_explainer(estimator, background=None):
+    """shap explainer of estimator, None for multi-class GB (explained tree by tree).  background: dense array of the
+    reports the linear explainer averages over (e.g. the mean training report), the same for every chunk of a task."""
+    shap = _import_shap()
+    name = type(estimator).__name__
+    if name == 'GradientBoostingClassifier' and estimator.estimators_.shape[1] > 1:
+        return None
+    if name in TREE_MODELS:
+        return shap.TreeExplainer(estimator, feature_perturbation='tree_path_dependent')
+    if hasattr(estimator, 'coef_'):
+        if background is None:
+            raise ValueError("LinearExplainer needs a background for " + name)
+        return shap.LinearExplainer(estimator, background)
+    raise ValueError("No exact SHAP explainer for " + name)
+
+
+def shap_values(estimator, X, explainer=None, background=None):
+    """Exact SHAP values of estimator for the dense array X, returns (reports x features x classes, base values).
+    explainer: made by make_explainer(estimator, background) if not given (background defaults to X)"""
+    import numpy as np
+    shap = _import_shap()
+    name = type(estimator).__name__
+    n_classes = len(estimator.classes_)
+
+    if name == 'GradientBoostingClassifier' and estimator.estimators_.shape[1] > 1:
+        values = np.zeros(X.shape + (n_classes,))
+        base_values = np.asarray(estimator._raw_predict_init(X[:1])[0], dtype=float)
+        for k in range(n_classes):
+            for tree in estimator.estimators_[:, k]:
+                tree_explainer = shap.TreeExplainer(tree)
+                values[:, :, k] += estimator.learning_rate * tree_explainer.shap_values(X, check_additivity=False)
+                base_values[k] += estimator.learning_rate * float(np.ravel(tree_explainer.expected_value)[0])
+        return values, base_values
+
+    if explainer is None:
+        explainer = make_explainer(estimator, X if background is None else background)
+    if name in TREE_MODELS:
+        values = explainer.shap_values(X, check_additivity=False)
+    else:
+        values = explainer.shap_values(X)
+    return _as_3d(values, n_classes), _as_1d(explainer.expected_value, n_classes)
+
+
+_worker_models = {}
+
+
+def _explain_chunk(job):
+    """Worker: SHAP values of one chunk of reports of a task (model and explainer made once per task)"""
+    registry_dir, task, X, background = job
+    if (registry_dir, task) not in _worker_models:
+        model = ModelRegistry(registry_dir).load(task)
+        _worker_models[(registry_dir, task)] = (model, make_explainer(model.estimator, background))
+    model, explainer = _worker_models[(registry_dir, task)]
+    values, base_values = shap_values(model.estimator, X, explainer)
+    return values.astype('float32'), base_values
+
+
+def load_feature_values(work_dir, features, hashing=None):
+    """Raw values (sum over sections) of the given features for every report, returns (report ids, CSR matrix)"""
+    import pandas as pd
+    from scipy import sparse
+    work_dir = Path(work_dir)
+
+    if hashing:
+        from FeatureHashing import load_hashed_matrix, COLUMN_PREFIX
+        matrix, info = load_hashed_matrix(work_dir)
+        columns = [int(feature[len(COLUMN_PREFIX):]) for feature in features]
+        return pd.RangeIndex(1, matrix.shape[0] + 1), matrix[:, columns].tocsr()
+
+    from MLDataProcessing import combine_list_dfs
+    wanted = set(features)
+    section_fms = []
+    for path in sorted((work_dir / 'section_fm').glob('*.csv')):
+        # only the selected columns are read (and the index, the first column)
+        with open(path) as fp:
+            index_name = pd.read_csv(fp, nrows=0).columns[0]
+        section_fms.append(pd.read_csv(path, index_col=0, usecols=lambda c: c in wanted or c == index_name).fillna(0))
+    merged = combine_list_dfs(section_fms).reindex(columns=list(features)).fillna(0)
+    return merged.index, sparse.csr_matrix(merged.to_numpy(dtype=float))
+
+
+def _top_contributors(values, classes, predicted, top_k):
+    """Indices and SHAP values of the top_k features of the predicted class of each report (by |SHAP|)"""
+    import numpy as np
+    class_index = np.searchsorted(classes, predicted)
+    contributions = values[np.arange(len(values)), :, class_index]
+    top = np.argsort(-np.abs(contributions), axis=1, kind='stable')[:, :top_k]
+    return top.astype('int32'), np.take_along_axis(contributions, top, axis=1).astype('float32')
+
+
+def explain(work_dir, registry_dir=None, all_reports=False, max_workers=None, chunk_size=256, top_k=10,
+            gold_file=None):
+    """Explains every task of the registry (test reports of gold_file unless all_reports), returns {task: summary}"""
+    import numpy as np
+    import pandas as pd
+
+    work_dir = Path(work_dir)
+    registry_dir = str(registry_dir or work_dir / REGISTRY_DIR)
+    registry = ModelRegistry(registry_dir)
+    models = registry.load_all()
+    columns = sorted({feature for model in models.values() for feature in model.features})
+    report_ids, values = load_feature_values(work_dir, columns, registry.hashing)
+
+    gold = pd.read_csv(gold_file or work_dir / 'GOLD_multiclass.csv', index_col=0).reindex(report_ids)
+    train_values = values[np.flatnonzero((gold['train'] == 1).to_numpy())]
+    rows = np.arange(len(report_ids))
+    if not all_reports:
+        rows = np.flatnonzero((gold['test'] == 1).to_numpy())
+    report_ids = np.asarray(report_ids)[rows]
+    values = values[rows]
+    column_index = {feature: k for k, feature in enumerate(columns)}
+    logging.info("Explaining %d tasks on %d reports (%d features)" % (len(models), len(rows), len(columns)))
+
+    start = time.perf_counter()
+    jobs, inputs = [], {}
+    for task, model in models.items():
+        task_columns = [column_index[f] for f in model.features]
+        task_values = values[:, task_columns]
+        inputs[task] = task_values
+        # background of the linear explainer: the mean normalized training report (one baseline for all the chunks)
+        background = normalize(train_values[:, task_columns].toarray(), np.asarray(model.scale)).mean(axis=0,
+                                                                                                     keepdims=True)
+        for chunk_start in range(0, len(rows), chunk_size):
+            chunk = task_values[chunk_start:chunk_start + chunk_size].toarray()
+            jobs.append((registry_dir, task, normalize(chunk, np.asarray(model.scale)), background))
+
+    results = {}
+    workers = max_workers or min(len(jobs), os.cpu_count() or 1)
+    if workers <= 1:
+        outputs = list(map(_explain_chunk, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            outputs = list(executor.map(_explain_chunk, jobs))
+    for (_, task, _, _), (chunk_values, base_values) in zip(jobs, outputs):
+        results.setdefault(task, ([], base_values))[0].append(chunk_values)
+
+    out_dir = work_dir / SHAP_DIR
+    os.makedirs(out_dir, exist_ok=True)
+    summaries = {}
+    for task, model in models.items():
+        chunks, base_values = results[task]
+        task_values = np.concatenate(chunks)
+        classes = np.asarray(model.estimator.classes_)
+        predicted = model.predict(inputs[task].toarray())
+        top_features, top_values = _top_contributors(task_values, classes, predicted, top_k)
+        importance = np.abs(task_values).mean(axis=(0, 2))
+        np.savez_compressed(out_dir / (_task_dir_name(task) + '.npz'), shap_values=task_values, base_values=base_values,
+                            classes=classes, features=np.array(model.features), report_ids=report_ids,
+                            predicted=predicted, global_importance=importance,
+                            global_importance_by_class=np.abs(task_values).mean(axis=0),
+                            top_features=top_features, top_values=top_values)
+        order = np.argsort(-importance, kind='stable')
+        summaries[str(task)] = {'model': type(model.estimator).__name__, 'reports': len(report_ids),
+                                'importance': [[model.features[i], float(importance[i])] for i in order],
+                                'contributors': [(str(report_ids[i]), predicted[i].item(),
+                                                  [(model.features[f], float(v))
+                                                   for f, v in zip(top_features[i], top_values[i])])
+                                                 for i in range(len(report_ids))]}
+    logging.info("SHAP values of %d tasks computed in %.1f s" % (len(models), time.perf_counter() - start))
+
+    save_to_json({task: dict(model=s['model'], reports=s['reports'], importance=s['importance'])
+                  for task, s in summaries.items()}, out_dir / 'summary.json', indent=1)
+    write_html(summaries, out_dir / 'shap_summary.html')
+    return summaries
+
+
+def write_html(summaries, out_file, top_n=20):
+    parts = ['<!DOCTYPE html><html><head><meta charset="utf-8"><title>SHAP summary</title><style>',
+             'body{font-family:sans-serif;font-size:13px} table{border-collapse:collapse;margin-bottom:2em}',
+             'td,th{padding:2px 8px;text-align:left} .bar{background:#4a7bd0;height:10px}',
+             '.pos{color:#c0392b} .neg{color:#2471a3}</style></head><body>']
+    for task, summary in summaries.items():
+        parts.append('<h2>%s</h2><p>%s, %d reports</p>' % (html.escape(task), html.escape(summary['model']),
+                                                           summary['reports']))
+        parts.append('<table><tr><th>feature</th><th>mean |SHAP|</th><th></th></tr>')
+        top = summary['importance'][:top_n]
+        largest = max([value for _, value in top] + [1e-12])
+        for feature, value in top:
+            parts.append('<tr><td>%s</td><td>%.4f</td><td><div class="bar" style="width:%dpx"></div></td></tr>'
+                         % (html.escape(feature), value, int(200 * value / largest)))
+        parts.append('</table><details><summary>Top contributors per report</summary><table>'
+                     '<tr><th>report</th><th>predicted</th><th>features (SHAP of the predicted class)</th></tr>')
+        for report_id, predicted, contributors in summary['contributors']:
+            cells = ' '.join('<span class="%s">%s %+.3f</span>' % ('pos' if v > 0 else 'neg', html.escape(f), v)
+                             for f, v in contributors if v != 0)
+            parts.append('<tr><td>%s</td><td>%s</td><td>%s</td></tr>' % (html.escape(report_id), predicted, cells))
+        parts.append('</table></details>')
+    parts.append('</body></html>')
+    with open(out_file, 'w') as fp:
+        fp.write('\n'.join(parts))
+    print("File saved: " + str(out_file))
+
+
+def main(work_dir=None, all_reports=False, max_workers=None, top_k=10, gold_file=None):
+    while work_dir is None or Path(work_dir).exists() is False:
+        print("Unable to locate directory.")
+        work_dir = input("Please enter working directory: ")
+    return explain(work_dir, all_reports=all_reports, max_workers=max_workers, top_k=top_k, gold_file=gold_file)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="SHAP explanations of the models saved by FeatureElimination")
+    parser.add_argument('work_dir')
+    parser.add_argument('--all-reports', action='store_true', help="explain every report, not only the test set")
+    parser.add_argument('--max-workers', type=int)
+    parser.add_argument('--top-k', type=int, default=10, help="contributors kept per report")
+    parser.add_argument('--gold', help="factorized gold csv (default: <work_dir>/GOLD_multiclass.csv)")
+    args = parser.parse_args()
+
+    log_settings(filename="ShapExplanations.log")
+    main(args.work_dir, args.all_reports, args.max_workers, args.top_k, gold_file=args.gold)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Sharding.py
+
+Runs JsonBasedReader and AggregateReportsBySection over a deterministic hash partition of the reports, so the work can
+be spread over several machines, and merges the partial outputs back into the outputs of a single node run.
+
+A report belongs to shard crc32(report number) % N.  With shard=(i, N) (or --shard i/N on the command line) each
+stage only processes the reports of shard i and writes its partial outputs to work_dir/shards/i-of-N.  JsonBasedReader
+reading a corpus pack can instead take pack_shard=(i, N) (--pack-shard i/N): the contiguous record range i of the pack,
+without visiting the other records; the partial outputs are the same:
+
+    JsonBasedReader            output/ (REPORTn.txt or report table), data/snomed_found.json, data/rxcui_found.json
+                               and data/reader_partial.json (per section statistics and where each code was found)
+    AggregateReportsBySection  aggregate_partial.csv (section, report_id, code, value rows in the order they were
+                               added) and aggregate_partial.json
+
+reduce_reader and reduce_aggregate merge all N partials into work_dir exactly as a single node run would have written
+them (same rows, column order, found codes and section summary).  The ontology lookups run once between the two
+reduce steps, on the merged found code files.
+
+Example (N nodes simulated as local processes):
+    python Sharding.py simulate <data dir> <work dir> 4 [--report-table]
+"""
+
+
+import heapq
+import os
+import re
+import shutil
+import subprocess
+import sys
+import zlib
+from pathlib import Path
+
+import FeatureHashing
+from MLDataProcessing import save_to_json, load_dict_json, log_settings
+
+SHARDS_DIR = 'shards'
+READER_PARTIAL_FILE = 'reader_partial.json'
+AGGREGATE_PARTIAL_FILE = 'aggregate_partial.csv'
+AGGREGATE_PARTIAL_INFO_FILE = 'aggregate_partial.json'
+
+re_report_number = re.compile(r'\d+$')
+
+
+def parse_shard(shard):
+    """'i/N' or (i, N) -> (i, N)"""
+    if shard is None:
+        return None
+    if isinstance(shard, str):
+        index, _, count = shard.partition('/')
+        shard = (int(index), int(count))
+    index, count = int(shard[0]), int(shard[1])
+    if not 0 <= index < count:
+        raise ValueError("Invalid shard %d/%d, expected 0 <= i < N" % (index, count))
+    return index, count
+
+
+def report_key(name):
+    """Report number of a bundle/report file name ('REPORT12' -> '12'), the name itself if it has no number."""
+    number = re_report_number.findall(name.split('.')[0])
+    return (number[0].lstrip('0') or '0') if number else name
+
+
+def report_sort_key(name):
+    """Orders report names by report number (then name), the order in which bundles are read."""
+    number = re_report_number.findall(name.split('.')[0])
+    return (int(number[0]) if number else -1, name)
+
+
+def shard_of(key, count):
+    return zlib.crc32(str(key).encode('utf-8')) % count
+
+
+def in_shard(key, shard):
+    return shard is None or shard_of(key, shard[1]) == shard[0]
+
+
+def shard_work_dir(work_dir, shard):
+    return Path(work_dir) / SHARDS_DIR / ('%d-of-%d' % shard)
+
+
+def shard_dirs(work_dir, count):
+    return [shard_work_dir(work_dir, (i, count)) for i in range(count)]
+
+
+def _merge_first_seen(partials):
+    """partials: per shard list of (item, first key) in shard order.  Returns the items ordered by first key, items
+    first seen in the same report keeping their shard order."""
+    ordered = []
+    for partial in partials:
+        for position, (item, first) in enumerate(partial):
+            ordered.append(((tuple(first), position), item))
+    ordered.sort(key=lambda x: x[0])
+    seen = set()
+    items = []
+    for _, item in ordered:
+        if item not in seen:
+            seen.add(item)
+            items.append(item)
+    return items
+
+
+def reduce_reader(work_dir, count, report_format='txt'):
+    """Merges the partial JsonBasedReader outputs of count shards into work_dir."""
+    import JsonBasedReader
+    import ReportTable
+
+    work_dir = Path(work_dir)
+    shards = shard_dirs(work_dir, count)
+    partials = [load_dict_json(shard / 'data' / READER_PARTIAL_FILE) for shard in shards]
+    os.makedirs(work_dir / 'output', exist_ok=True)
+    os.makedirs(work_dir / 'data', exist_ok=True)
+
+    # found codes: order of first appearance, description from the last report the code was found in
+    for system, found_file in (('snomed', 'snomed_found.json'), ('rxnorm', 'rxcui_found.json')):
+        found = [load_dict_json(shard / 'data' / found_file) for shard in shards]
+        order = _merge_first_seen([[(code, partial['codes'][system][code][0]) for code in shard_found]
+                                   for partial, shard_found in zip(partials, found)])
+        last_seen = {}
+        for partial, shard_found in zip(partials, found):
+            for code, description in shard_found.items():
+                last = tuple(partial['codes'][system][code][1])
+                if code not in last_seen or last > last_seen[code][0]:
+                    last_seen[code] = (last, description)
+        save_to_json({code: last_seen[code][1] for code in order}, work_dir / 'data' / found_file, indent=4)
+
+    # section summary: per report values of all shards, sections in order of first appearance
+    order = _merge_first_seen([[(lionc, stats['first']) for lionc, stats in partial['sections'].items()]
+                               for partial in partials])
+    records = {name: {lionc: [] for lionc in order} for name in JsonBasedReader.SECTION_STATISTICS}
+    for partial in partials:
+        for lionc, stats in partial['sections'].items():
+            for name in JsonBasedReader.SECTION_STATISTICS:
+                records[name][lionc] += stats[name]
+    JsonBasedReader.save_section_summary(work_dir / 'data' / 'RB_Section_Summary.txt', records)
+
+    # per report outputs
+    if report_format == 'table':
+        readers = [ReportTable.iter_reports(shard / 'output' / ReportTable.REPORT_TABLE_FILE) for shard in shards
+                   if (shard / 'output' / ReportTable.REPORT_TABLE_FILE).exists()]
+        with ReportTable.ReportTableWriter(work_dir / 'output' / ReportTable.REPORT_TABLE_FILE) as writer:
+            for report_id, rows in heapq.merge(*readers, key=lambda report: report[0]):
+                writer.add_report(report_id, ((section, family, code, n, negation)
+                                              for section, code, family, n, negation in rows))
+    else:
+        for shard in shards:
+            for path in (shard / 'output').glob('*.txt'):
+                shutil.copyfile(path, work_dir / 'output' / path.name)
+    print("Merged reader outputs of %d shards into: %s" % (count, str(work_dir)))
+
+
+def reduce_aggregate(work_dir, count):
+    """Merges the partial AggregateReportsBySection outputs of count shards into work_dir."""
+    import numpy as np
+    import pandas as pd
+    from AggregateReportsBySection import save_section_matrices
+
+    work_dir = Path(work_dir)
+    shards = shard_dirs(work_dir, count)
+    if all((shard / FeatureHashing.HASHED_FM_FILE).exists() for shard in shards):
+        reduce_hashed(work_dir, shards)
+        return
+    num_reports = max(load_dict_json(shard / AGGREGATE_PARTIAL_INFO_FILE)['num_reports'] for shard in shards)
+    partials = [pd.read_csv(shard / AGGREGATE_PARTIAL_FILE, dtype={'section': str, 'code': str},
+                            keep_default_na=False) for shard in shards]
+
+    # sections and their columns in the order a single node run adds them: by first report, then by the order
+    # they were added within that report
+    section_order = _merge_first_seen([list(zip(p['section'], zip(p['report_id']))) for p in partials])
+    column_order = _merge_first_seen([list(zip(zip(p['section'], p['code']), zip(p['report_id'])))
+                                      for p in partials])
+    columns = {section: [] for section in section_order}
+    for section, code in column_order:
+        columns[section].append(code)
+
+    df_sections = {}
+    rows = pd.concat(partials, ignore_index=True)
+    for section in section_order:
+        df = pd.DataFrame(np.nan, index=range(1, num_reports + 1), columns=columns[section], dtype=float)
+        part = rows[rows['section'] == section]
+        positions = {code: k for k, code in enumerate(columns[section])}
+        values = df.to_numpy(copy=True)
+        values[part['report_id'].to_numpy() - 1, [positions[code] for code in part['code']]] = part['value']
+        df_sections[section] = pd.DataFrame(values, index=df.index, columns=df.columns)
+
+    save_section_matrices(df_sections, work_dir)
+    print("Merged aggregate outputs of %d shards into: %s" % (count, str(work_dir)))
+
+
+def reduce_hashed(work_dir, shards):
+    """Merges hashed feature matrices (AggregateReportsBySection with hash_features): the shards have disjoint report
+    rows, so the matrix is their sum.  The sampled reverse maps are merged in shard order."""
+    matrices = []
+    infos = []
+    for shard in shards:
+        matrix, info = FeatureHashing.load_hashed_matrix(shard)
+        matrices.append(matrix)
+        infos.append(info)
+    num_reports = max(info['num_reports'] for info in infos)
+    space = FeatureHashing.HashedFeatureSpace.from_settings(infos[0]['hashing'])
+    for info in infos:
+        for column, names in info['reverse_map'].items():
+            merged = space.reverse_map[int(column)]
+            merged += [name for name in names if name not in merged][:space.reverse_map_size - len(merged)]
+    for matrix in matrices:
+        matrix.resize((num_reports, space.n_features))
+    matrix = matrices[0]
+    for other in matrices[1:]:
+        matrix = matrix + other
+    FeatureHashing.save_hashed_matrix(work_dir, matrix.tocsr(), space, num_reports, infos[0]['aggregate_settings'])
+    print("Merged hashed aggregate outputs of %d shards into: %s" % (len(shards), str(work_dir)))
+
+
+def simulate(data_dir, work_dir, count, report_format='txt', lookups=True):
+    """Runs the reader and aggregation as count local processes per stage, with the reduce steps in between."""
+    work_dir = Path(work_dir)
+    here = Path(__file__).parent
+    table_flag = ['--report-table'] if report_format == 'table' else []
+
+    def run_shards(script, args, shard_flag='--shard'):
+        processes = [subprocess.Popen([sys.executable, str(here / script)] + args + [shard_flag, '%d/%d' % (i, count)]
+                                      + table_flag, stdout=subprocess.DEVNULL)
+                     for i in range(count)]
+        for process in processes:
+            if process.wait() != 0:
+                raise RuntimeError(script + " shard failed with exit code " + str(process.returncode))
+
+    from CorpusPack import is_pack
+    run_shards('JsonBasedReader.py', [str(data_dir), str(work_dir)],
+               '--pack-shard' if is_pack(data_dir) else '--shard')
+    reduce_reader(work_dir, count, report_format)
+    if lookups:
+        import RxOntologyLookup
+        import SnomedOntologyLookup
+        RxOntologyLookup.main(work_dir)
+        if SnomedOntologyLookup.base_uri:
+            SnomedOntologyLookup.main(work_dir)
+    run_shards('AggregateReportsBySection.py', [str(work_dir)])
+    reduce_aggregate(work_dir, count)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Merge sharded JsonBasedReader/AggregateReportsBySection outputs")
+    parser.add_argument('command', choices=['reduce-reader', 'reduce-aggregate', 'simulate'])
+    parser.add_argument('paths', nargs='+', help="work dir (reduce) or data dir and work dir (simulate)")
+    parser.add_argument('shards', type=int, help="number of shards N")
+    parser.add_argument('--report-table', action='store_true')
+    args = parser.parse_args()
+
+    log_settings(filename="Sharding.log")
+    report_format = 'table' if args.report_table else 'txt'
+    if args.command == 'reduce-reader':
+        reduce_reader(args.paths[0], args.shards, report_format)
+    elif args.command == 'reduce-aggregate':
+        reduce_aggregate(args.paths[0], args.shards)
+    else:
+        simulate(args.paths[0], args.paths[1], args.shards, report_format)
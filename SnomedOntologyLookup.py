@@ -10,9 +10,10 @@ Please refer to http://snomed.info for more information on terms of use
 """
 
 import json
-import requests
 import time
+from Instrumentation import get_metrics, reset_metrics, emit_metrics, profile_stage
 from MLDataProcessing import save_to_json, load_dict_json, log_settings
+from OntologyBackend import get_backend, split_cached, groups
 import logging
 from pathlib import Path
 
@@ -21,9 +22,11 @@ base_uri = ''
 
 
 
+@profile_stage('snomed_lookup')
 def main(working_dir, depth=10):
     if depth > 0 and len(base_uri) == 0:
         exit("Please set base url for Snomed CT server in:" + __file__)
+    metrics = reset_metrics('snomed_lookup')
 
     log_settings(filename="SNOMED_LOOKUP.log", level=logging.INFO, filemode='w', stdout=True)
     working_dir = Path(str(working_dir))
@@ -50,24 +53,22 @@ def main(working_dir, depth=10):
 
 
     count = 0
-    for sctid in list_of_snomed_to_lookup:
-        if sctid not in sctid_to_desc:
-            name = query_snomed_name(sctid)
-            print(sctid, name)
-            sctid_to_desc[sctid] = name
-        count +=1
-        if SAVE_PROGRESS_EVERY_N > 0 and count % int(SAVE_PROGRESS_EVERY_N) == 0 or count == len(list_of_snomed_to_lookup):  # save results once in a while
-            save_to_json(sctid_to_desc, snomed_code_descriptions_from_query, indent=4)
-            print("Saving results: ", count, "/", len(list_of_snomed_to_lookup), " entries processed.")
+    for group in groups(list_of_snomed_to_lookup, max(SAVE_PROGRESS_EVERY_N, 0) or len(list_of_snomed_to_lookup)):
+        get_snomed_names_batch(group, sctid_to_desc)
+        count += len(group)
+        # save results once in a while
+        save_to_json(sctid_to_desc, snomed_code_descriptions_from_query, indent=4)
+        print("Saving results: ", count, "/", len(list_of_snomed_to_lookup), " entries processed.")
 
 
 
     count = 0
-    for sctid in list_of_snomed_to_lookup:
-        list_of_ancestors = list(set(get_snomed_ancestors(sctid, sctid_to_parents, sctid_to_desc, depth=depth, query_depth=depth)))
-        if list_of_ancestors:
-            snomed_to_ancestors[sctid] = list_of_ancestors
-        count += 1
+    for group in groups(list_of_snomed_to_lookup, max(SAVE_PROGRESS_EVERY_N, 0) or len(list_of_snomed_to_lookup)):
+        ancestors = get_snomed_ancestors_batch(group, sctid_to_parents, sctid_to_desc, depth=depth, query_depth=depth)
+        for sctid, list_of_ancestors in ancestors.items():
+            if list_of_ancestors:
+                snomed_to_ancestors[sctid] = list_of_ancestors
+        count += len(group)
         if SAVE_PROGRESS_EVERY_N > 0 and count % int(SAVE_PROGRESS_EVERY_N) == 0:  # save results once in a while
             save_to_json(sctid_to_parents, save_snomed_to_parents_file, indent=4)
             save_to_json(snomed_to_ancestors, snomed_ancestor_file, indent=4)
@@ -79,6 +80,8 @@ def main(working_dir, depth=10):
     save_to_json(sctid_to_parents, save_snomed_to_parents_file,indent=4,print_save_loc=True)
     save_to_json(snomed_to_ancestors, snomed_ancestor_file,indent=4,print_save_loc=True)
     save_to_json(sctid_to_desc, snomed_code_descriptions_from_query,indent=4,print_save_loc=True)
+    metrics.count('sctid', len(list_of_snomed_to_lookup))
+    emit_metrics('snomed_lookup', working_dir)
 
 
 
@@ -87,40 +90,64 @@ def main(working_dir, depth=10):
 
 
 def get_snomed_ancestors(sctid, cached_parents, found_descriptions, depth=2, query_depth = 2):
-    results = []
-    if depth <= 0:
-        return results
-
-    if query_depth > 0:
-        results = get_snomed_parents(sctid, cached_parents, found_descriptions, query=True)
-    if query_depth <= 0:
-        results = get_snomed_parents(sctid, cached_parents, found_descriptions, query=False)
-
-    # if there are results try calling function again recursively to check for more parents/ancestors
-    if results:
-        for id in results:
-            results = results + get_snomed_ancestors(id, cached_parents, found_descriptions, depth - 1, query_depth - 1)
-
-    return results
+    return get_snomed_ancestors_batch([sctid], cached_parents, found_descriptions, depth, query_depth)[sctid]
+
+
+# {sctid: [ancestors]} up to depth levels above each sctid (first found order), the parents of each level are looked up
+# in one batch for all the sctids, and only queried for the first query_depth levels (cached parents only after that)
+def get_snomed_ancestors_batch(sctids, cached_parents, found_descriptions, depth=2, query_depth = 2):
+    sctids = list(dict.fromkeys(sctids))
+    ancestors = {sctid: {} for sctid in sctids}
+    frontiers = {sctid: [sctid] for sctid in sctids}
+    for level in range(depth):
+        parents = get_snomed_parents_batch((code for frontier in frontiers.values() for code in frontier),
+                                           cached_parents, found_descriptions, query=level < query_depth)
+        for sctid, frontier in frontiers.items():
+            # ancestors found at a lower level already had their parents added
+            new = [parent for code in frontier for parent in parents[code] if parent not in ancestors[sctid]]
+            ancestors[sctid].update(dict.fromkeys(new))
+            frontiers[sctid] = list(dict.fromkeys(new))
+    return {sctid: list(found) for sctid, found in ancestors.items()}
 
 
 def get_snomed_parents(sctid, cached_parents, found_descriptions, query = True):
+    return get_snomed_parents_batch([sctid], cached_parents, found_descriptions, query)[sctid]
 
-    if sctid in cached_parents:
-        return cached_parents[sctid]
 
-    parents_list = []
+# {sctid: [parent sctid]} for an iterable of sctids, only the (deduplicated) cache misses go to the backend
+def get_snomed_parents_batch(sctids, cached_parents, found_descriptions, query = True):
+    metrics = get_metrics('snomed_lookup')
+    sctids = list(sctids)
+    found, misses = split_cached(sctids, cached_parents)
+    metrics.count('parents_cache_hits', len(found))
+    metrics.count('parents_cache_misses', len(misses))
 
     if query:
-        parents = list(query_snomed_parents(sctid))
-        if parents:
-            for x in parents:
-                parents_list.append(x[0])
-                found_descriptions[x[0]] = x[1]
-        cached_parents[sctid] = parents_list
-        summary_text = "Snomed Query Results for: " + str(sctid) + str(parents_list)
-        logging.info(summary_text)
-    return parents_list
+        for group in groups(misses):
+            for sctid, parents in get_backend().snomed_parents(group).items():
+                parents_list = []
+                for parent, term in parents:
+                    parents_list.append(parent)
+                    found_descriptions[parent] = term
+                cached_parents[sctid] = found[sctid] = parents_list
+                summary_text = "Snomed Query Results for: " + str(sctid) + str(parents_list)
+                logging.info(summary_text)
+    return {sctid: found.get(sctid, []) for sctid in sctids}
+
+
+# {sctid: description} for an iterable of sctids, the descriptions not found yet are queried
+def get_snomed_names_batch(sctids, found_descriptions):
+    metrics = get_metrics('snomed_lookup')
+    sctids = list(sctids)
+    found, misses = split_cached(sctids, found_descriptions)
+    metrics.count('description_cache_hits', len(found))
+    metrics.count('description_cache_misses', len(misses))
+
+    for group in groups(misses):
+        for sctid, name in get_backend().snomed_names(group).items():
+            print(sctid, name)
+            found_descriptions[sctid] = found[sctid] = name
+    return {sctid: found[sctid] for sctid in sctids}
 
 
 def query_snomed_parents(sctid):
@@ -130,11 +157,13 @@ def query_snomed_parents(sctid):
     :param sctid: Snomed-CT ID
     :return: inferred Parents of Snomed-CT ID
     '''
+    get_metrics('snomed_lookup').count('lookups')
     time.sleep(0.2)    #limit rate of requests
     version = 'v20180131'
     form = 'inferred'   # stated or inferred
     global base_uri
     url = '{base_uri}/{release}/concepts/{sctid}/parents?form={form}'.format(base_uri = base_uri, release = version, sctid = str(sctid), form=form)
+    import requests    # only needed for the web queries, not to use the cached results
     response = requests.get(url)
     response.raise_for_status()
     parsed_json = json.loads(response.text)
@@ -154,11 +183,13 @@ def query_snomed_name(sctid):
     :param sctid: Snomed-CT ID
     :return: inferred Parents of Snomed-CT ID
     '''
+    get_metrics('snomed_lookup').count('lookups')
     time.sleep(1)    #limit rate of requests
     version = 'v20180131'
     form = 'inferred'   # stated or inferred
     global base_uri
     url = '{base_uri}/{release}/concepts/{sctid}'.format(base_uri = base_uri, release = version, sctid = str(sctid), form=form)
+    import requests    # only needed for the web queries, not to use the cached results
     response = requests.get(url)
     response.raise_for_status()
     try:
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""SyntheticBundles.py
+
+Generates synthetic FHIR Composition Resource Bundles (no PHI) in the layout read by JsonBasedReader, for testing and
+benchmarking the pipeline.
+
+The number of sections, resources per section, mix of resource types (Condition, MedicationStatement,
+FamilyMemberHistory, Procedure), negation rate and the size of the Snomed-CT/RxNorm code vocabularies can be tuned.
+Also generates a matching gold standard and a local ontology (ingredients, ATC classes, Snomed parents) which
+install_local_lookups plugs into SnomedOntologyLookup/RxOntologyLookup in place of the remote APIs, so the whole
+pipeline can be run offline.
+
+Example:
+    python SyntheticBundles.py bundles/ 1000
+"""
+
+
+import json
+import os
+import random
+import uuid
+from pathlib import Path
+
+from MLDataProcessing import lionc_to_description, save_to_json
+
+SNOMED_REFERENCE = 'http://snomed.info/sct'
+RXNORM_REFERENCE = 'http://www.nlm.nih.gov/research/umls/rxnorm'
+LOINC_REFERENCE = 'http://loinc.org'
+
+DEFAULT_RESOURCE_MIX = {'Condition': 0.5, 'MedicationStatement': 0.3, 'FamilyMemberHistory': 0.1, 'Procedure': 0.1}
+DEFAULT_TASKS = ['Obesity', 'Diabetes', 'Hypertension', 'Asthma', 'CAD', 'GERD']
+ATC_FIRST_LEVEL = 'ABCDGHJLMNPRSV'
+FILLER_WORDS = ['patient', 'reports', 'denies', 'history', 'of', 'pain', 'daily', 'with', 'no', 'noted', 'today',
+                'stable', 'follow', 'up', 'in', 'weeks', 'mild', 'chronic', 'started', 'on']
+
+
+class SyntheticVocabulary():
+    """Deterministic Snomed-CT and RxNorm code vocabularies with made up descriptions and a local ontology."""
+    def __init__(self, n_snomed=2000, n_rxnorm=500, seed=0):
+        rng = random.Random(seed)
+        self.snomed = [str(x) for x in rng.sample(range(100000, 999999999), n_snomed)]
+        self.rxnorm = [str(x) for x in rng.sample(range(100, 9999999), n_rxnorm)]
+        self.descriptions = {code: 'finding ' + code for code in self.snomed}
+        self.descriptions.update({code: 'drug ' + code + ' 10 MG Oral Tablet' for code in self.rxnorm})
+
+        # ontology: snomed parents form a tree over the first 5% of codes, drugs have 1-2 ingredients from a
+        # smaller set of ingredient codes, each ingredient has 1-2 ATC level 4 classes
+        n_roots = max(1, n_snomed // 20)
+        self.snomed_parents = {}
+        for i, code in enumerate(self.snomed):
+            if i >= n_roots:
+                self.snomed_parents[code] = [self.snomed[rng.randrange(0, min(i, n_roots * 4))]]
+            else:
+                self.snomed_parents[code] = []
+        ingredients = [str(x) for x in rng.sample(range(10000000, 19999999), max(1, n_rxnorm // 4))]
+        self.ingredients = {}
+        for code in self.rxnorm:
+            self.ingredients[code] = rng.sample(ingredients, rng.choice([1, 1, 1, 2]))
+        for code in ingredients:
+            self.ingredients[code] = [code]
+        self.atc = {}
+        for code in ingredients:
+            self.atc[code] = [random_atc(rng) for _ in range(rng.choice([1, 1, 2]))]
+        for code in self.rxnorm:
+            self.atc[code] = sorted({atc for ingredient in self.ingredients[code] for atc in self.atc[ingredient]})
+
+    def ancestors(self, sctid, depth=10):
+        results = []
+        for parent in self.snomed_parents.get(sctid, []):
+            results.append(parent)
+            if depth > 1:
+                results += self.ancestors(parent, depth - 1)
+        return results
+
+
+def random_atc(rng):
+    return (rng.choice(ATC_FIRST_LEVEL) + '%02d' % rng.randint(1, 20) + rng.choice('ABCDEFGH') +
+            rng.choice('ABCDEFGHX'))
+
+
+def coded_concept(system, code, text):
+    return {'coding': [{'system': system, 'code': code, 'display': text}], 'text': text}
+
+
+def generate_bundle(rng, vocabulary, n_sections=8, resources_per_section=6, resource_mix=None, negation_rate=0.1):
+    """Returns one synthetic bundle: a Composition followed by the resources referenced by its sections."""
+    resource_mix = resource_mix or DEFAULT_RESOURCE_MIX
+    types = list(resource_mix.keys())
+    weights = [resource_mix[t] for t in types]
+    section_codes = [code for code in lionc_to_description.keys() if code != '00000-0']
+
+    sections = []
+    resources = []
+    for section_code in rng.sample(section_codes, min(n_sections, len(section_codes))):
+        title = lionc_to_description[section_code]
+        references = []
+        for _ in range(rng.randint(max(0, resources_per_section // 2), resources_per_section * 3 // 2)):
+            resource_type = rng.choices(types, weights)[0]
+            resource_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            resource = {'resourceType': resource_type, 'id': resource_id}
+            if resource_type == 'MedicationStatement':
+                code = rng.choice(vocabulary.rxnorm)
+                resource['medicationCodeableConcept'] = coded_concept(RXNORM_REFERENCE, code,
+                                                                      vocabulary.descriptions[code])
+            else:
+                code = rng.choice(vocabulary.snomed)
+                concept = coded_concept(SNOMED_REFERENCE, code, vocabulary.descriptions[code])
+                if resource_type == 'FamilyMemberHistory':
+                    resource['relationship'] = {'text': 'mother'}
+                    resource['condition'] = [{'code': concept}]
+                else:
+                    resource['code'] = concept
+            if rng.random() < negation_rate:
+                resource['abatementString'] = 'negated'
+            resources.append(resource)
+            references.append({'reference': 'urn:uuid:' + resource_id})
+
+        body = ' '.join(rng.choice(FILLER_WORDS) for _ in range(rng.randint(10, 80)))
+        sections.append({'title': title,
+                         'code': {'coding': [{'system': LOINC_REFERENCE, 'code': section_code, 'display': title}]},
+                         'text': {'status': 'generated', 'div': '<div>' + title + ': ' + body + '</div>'},
+                         'entry': references})
+
+    composition = {'resourceType': 'Composition', 'id': str(uuid.UUID(int=rng.getrandbits(128))),
+                   'status': 'final', 'title': 'Discharge summary', 'section': sections}
+    return {'resourceType': 'Bundle', 'type': 'collection',
+            'entry': [{'resource': composition}] + [{'resource': r} for r in resources]}
+
+
+def generate_corpus(out_dir, n_reports, vocabulary=None, seed=0, indent=None, **bundle_settings):
+    """Writes REPORT1.json ... REPORTn.json to out_dir."""
+    out_dir = Path(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    vocabulary = vocabulary or SyntheticVocabulary(seed=seed)
+    rng = random.Random(seed)
+    for report_id in range(1, n_reports + 1):
+        bundle = generate_bundle(rng, vocabulary, **bundle_settings)
+        with open(out_dir / ('REPORT' + str(report_id) + '.json'), 'w') as fp:
+            json.dump(bundle, fp, indent=indent)
+    return vocabulary
+
+
+def generate_gold(gold_csv, n_reports, tasks=None, test_fraction=0.3, seed=0):
+    """Writes a gold standard csv with Y/N/Q/U labels (and some blanks) plus train/test columns."""
+    tasks = tasks or DEFAULT_TASKS
+    rng = random.Random(seed)
+    with open(gold_csv, 'w') as fp:
+        fp.write(',' + ','.join(tasks) + ',train,test\n')
+        for report_id in range(1, n_reports + 1):
+            labels = [rng.choices(['Y', 'N', 'Q', 'U', ''], [40, 45, 3, 7, 5])[0] for _ in tasks]
+            is_test = rng.random() < test_fraction
+            fp.write('%d,%s,%d,%d\n' % (report_id, ','.join(labels), int(not is_test), int(is_test)))
+
+
+def install_local_lookups(vocabulary):
+    """Replaces the remote API queries of SnomedOntologyLookup and RxOntologyLookup with the local ontology."""
+    import SnomedOntologyLookup
+    from OntologyBackend import LocalBackend, set_backend
+
+    SnomedOntologyLookup.base_uri = SnomedOntologyLookup.base_uri or 'local'
+    set_backend(LocalBackend(ingredients=vocabulary.ingredients, atc=vocabulary.atc,
+                             snomed_parents=vocabulary.snomed_parents, descriptions=vocabulary.descriptions,
+                             ingredient_names={code: 'ingredient ' + code for ingredients in
+                                               vocabulary.ingredients.values() for code in ingredients}))
+
+
+def save_local_ontology(vocabulary, work_dir, depth=10):
+    """Writes the lookup outputs (as SnomedOntologyLookup/RxOntologyLookup would) for the whole vocabulary."""
+    data = Path(work_dir) / 'data'
+    save_to_json(vocabulary.ingredients, data / 'rxcui_ingredient.json')
+    save_to_json(vocabulary.atc, data / 'rxcui_atc.json')
+    save_to_json(vocabulary.snomed_parents, data / 'snomed_parents_inferred.json')
+    save_to_json({code: sorted(set(vocabulary.ancestors(code, depth))) for code in vocabulary.snomed},
+                 data / 'snomed_ancestor_inferred.json')
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3:
+        exit("usage: python SyntheticBundles.py <output dir> <number of reports> [gold csv]")
+    generate_corpus(sys.argv[1], int(sys.argv[2]), indent=2)
+    if len(sys.argv) > 3:
+        generate_gold(sys.argv[3], int(sys.argv[2]))